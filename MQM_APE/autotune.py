@@ -0,0 +1,163 @@
+"""
+Engine auto-tuner: search the engine profile (tp, gpu_memory_utilization, max_num_seqs,
+max_num_batched_tokens, swap_space) of each engine of a config on a calibration batch.
+
+Each trial loads the engine with one profile and runs the full pipeline (evaluator, APE,
+verifier) on the calibration segments, so the engine serves real prompts of all stages routed
+to it. Trials are scored by the tokens (prompt and generated) of those stages per GPU-second
+(`--objective gpu_throughput`, default) or per second (`--objective throughput`). Profiles that
+fail to load (out of memory, no KV cache blocks, too few GPUs) are recorded and skipped.
+
+The knobs are searched one at a time, in the order above, keeping the best value of each
+(`--passes` repeats the sweep). The best profile is written into the engine's section of a copy
+of the config YAML at `--out`. configs/llmconfig_simulated.yaml runs the same search on the stand-in backend
+with a simulated engine profile.
+"""
+
+import argparse
+import copy
+import os.path as osp
+from typing import Any, Dict, List, Optional
+
+from engines import DEFAULT_ENGINE
+from main import MQM_APE
+from records import Corpus
+from utils import load_yaml, readlines_txt, save_json, save_yaml
+
+KNOBS = ('tp', 'gpu_memory_utilization', 'max_num_seqs', 'max_num_batched_tokens', 'swap_space')
+PROFILE_DEFAULTS = {'tp': 1, 'gpu_memory_utilization': 0.8, 'max_num_seqs': None, 'max_num_batched_tokens': None, 'swap_space': None}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="Path of configuration yaml.")
+    parser.add_argument("--src", type=str, default="./test/srcs_zh.txt", help="Path of calibration src.")
+    parser.add_argument("--tgt", type=str, default="./test/tgts_en.txt", help="Path of calibration tgt.")
+    parser.add_argument("--srclang", type=str, default="Chinese", help="Source Language, such as English, German, Chinese.")
+    parser.add_argument("--tgtlang", type=str, default="English", help="Target Language, such as English, German, Chinese.")
+    parser.add_argument("--num_segments", type=int, default=64, help="Calibration segments, the input is cycled if shorter.")
+    parser.add_argument("--engines", type=str, nargs='*', default=None, help="Engines to tune, all engines used by a stage by default.")
+
+    parser.add_argument("--tp", type=int, nargs='*', default=[1, 2, 4, 8], help="Tensor parallel sizes to search.")
+    parser.add_argument("--gpu_memory_utilization", type=float, nargs='*', default=[0.8, 0.85, 0.9, 0.95], help="Memory fractions to search.")
+    parser.add_argument("--max_num_seqs", type=int, nargs='*', default=[64, 128, 256, 512], help="Sequences per step to search.")
+    parser.add_argument("--max_num_batched_tokens", type=int, nargs='*', default=[4096, 8192, 16384, 32768], help="Tokens per step to search.")
+    parser.add_argument("--swap_space", type=float, nargs='*', default=[0, 4, 16], help="CPU swap GiB per GPU to search.")
+    parser.add_argument("--objective", type=str, default='gpu_throughput', choices=['gpu_throughput', 'throughput'],
+                        help="Tokens per GPU-second or tokens per second.")
+    parser.add_argument("--passes", type=int, default=1, help="Sweeps over the knobs.")
+
+    parser.add_argument("--out", type=str, required=True, help="Path of the tuned config, another file than --config, whose comments would be lost.")
+    parser.add_argument("--report", type=str, default=None, help="Path of a JSON report of all trials.")
+
+    args = parser.parse_args()
+    if osp.abspath(args.out) == osp.abspath(args.config):
+        parser.error("--out should not overwrite --config.")
+    return args
+
+
+def cycle_lines(lines: List[str], num_lines: int) -> List[str]:
+    assert len(lines) > 0, "calibration inputs should not be empty!"
+    return [lines[idx % len(lines)] for idx in range(num_lines)]
+
+
+def engine_section(configs: Dict[str, Any], engine_name: str) -> Dict[str, Any]:
+    return configs['inference'] if engine_name == DEFAULT_ENGINE else configs['engines'][engine_name]
+
+
+class AutoTuner():
+
+    def __init__(self,
+                 configs: Dict[Any, Any],
+                 calibration: List[Any], # srcs, tgts, src_lang, tgt_lang of Corpus.from_texts
+                 objective: str='gpu_throughput'):
+
+        self.configs = configs
+        self.calibration = calibration
+        self.objective = objective
+        self.trials: List[Dict[str, Any]] = []
+
+
+    def stage_engines(self) -> Dict[str, str]:
+        return {stage: self.configs[stage].get('engine') or DEFAULT_ENGINE for stage in ('evaluator', 'ape', 'verifier')}
+
+
+    def run_trial(self, engine_name: str, profile: Dict[str, Any]) -> Optional[float]:
+        """objective of one profile of an engine, None if the engine fails to load."""
+        for trial in self.trials:
+            if trial['engine'] == engine_name and trial['profile'] == profile:
+                return trial['score']
+
+        configs = copy.deepcopy(self.configs)
+        section = engine_section(configs, engine_name)
+        for knob, value in profile.items():
+            if value is None:
+                section.pop(knob, None)
+            else:
+                section[knob] = value
+
+        trial = {'engine': engine_name, 'profile': profile, 'score': None}
+        mqm_ape = MQM_APE(configs)
+        try:
+            mqm_ape.eval_records(Corpus.from_texts(*self.calibration))
+        except (RuntimeError, ValueError) as error: # out of memory, no cache blocks, too few GPUs, ...
+            trial['error'] = str(error)
+            print(f"[INFO] Profile {profile} of engine {engine_name} failed: {error}")
+        else:
+            stage_costs = [costs for costs in mqm_ape.engines.cost_report().values() if costs['engine'] == engine_name]
+            tokens = sum(costs['prompt_tokens'] + costs['generated_tokens'] for costs in stage_costs)
+            seconds = sum(costs['gpu_seconds' if self.objective == 'gpu_throughput' else 'seconds'] for costs in stage_costs)
+            trial.update({'tokens': tokens, 'seconds': seconds, 'score': tokens / seconds if seconds > 0 else 0.0})
+            print(f"[INFO] Profile {profile} of engine {engine_name}: {trial['score']:.1f} tokens per "
+                  f"{'GPU-second' if self.objective == 'gpu_throughput' else 'second'}.")
+        finally:
+            mqm_ape.engines.release()
+
+        self.trials.append(trial)
+        return trial['score']
+
+
+    def tune(self, engine_name: str, grid: Dict[str, List[Any]], passes: int=1) -> Dict[str, Any]:
+        """best profile of an engine, searching one knob at a time from its configured profile."""
+        section = engine_section(self.configs, engine_name)
+        best = {knob: section.get(knob, PROFILE_DEFAULTS[knob]) for knob in KNOBS}
+        best_score = self.run_trial(engine_name, best)
+
+        for _ in range(passes):
+            for knob in KNOBS:
+                for value in grid[knob]:
+                    profile = {**best, knob: value}
+                    score = self.run_trial(engine_name, profile)
+                    if score is not None and (best_score is None or score > best_score):
+                        best, best_score = profile, score
+
+        if best_score is None:
+            raise RuntimeError(f"No profile of engine {engine_name} could be loaded.")
+        print(f"[INFO] Best profile of engine {engine_name}: {best}, {best_score:.1f} tokens per "
+              f"{'GPU-second' if self.objective == 'gpu_throughput' else 'second'}.")
+        return best
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    configs = load_yaml(args.config)
+    srcs, tgts = readlines_txt(args.src), readlines_txt(args.tgt)
+    assert len(srcs) == len(tgts), "length of src and tgt should be the same!"
+    calibration = [cycle_lines(srcs, args.num_segments), cycle_lines(tgts, args.num_segments), args.srclang, args.tgtlang]
+
+    tuner = AutoTuner(configs, calibration, args.objective)
+    grid = {knob: getattr(args, knob) for knob in KNOBS}
+
+    for engine_name in args.engines or sorted(set(tuner.stage_engines().values())):
+        best = tuner.tune(engine_name, grid, args.passes)
+        section = engine_section(configs, engine_name)
+        for knob, value in best.items():
+            if value is None:
+                section.pop(knob, None)
+            else:
+                section[knob] = value
+
+    save_yaml(configs, args.out)
+    if args.report is not None:
+        save_json(tuner.trials, args.report)
@@ -1,4 +1,8 @@
 from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, List
+
+from overlap import OverlapRunner
+from records import index_responses
 
 class BaseModule(ABC):
     def __init__(self, ):
@@ -15,3 +19,68 @@ class BaseModule(ABC):
     @abstractmethod
     def postprocess(self, *args, **kwargs):
         pass
+
+    def generate(self,
+                 build_prompts: Callable[[List[Dict[str, str]]], List[Any]],
+                 inputs: Iterable[Dict[str, str]],
+                 parse: Callable[[List[Dict[str, Any]]], Dict[str, Any]]=None,
+                 **kwargs) -> List[Dict[str, Any]]:
+        """
+        build the prompts of inputs and generate them with kwargs of inference.
+        With self.overlap, inputs go in batches whose prompts are built, and whose responses are
+        parsed by parse into self.parsed (by text), while the engine generates the neighbouring batch.
+        return: responses in the order of inputs.
+        """
+        if getattr(self, 'overlap', None) is None:
+            return self.inference.inference(build_prompts(inputs), **kwargs)
+
+        outputs, parsed = self.overlap.run(list(inputs), build_prompts, self.inference.inference, parse, **kwargs)
+        for batch_parsed in parsed:
+            self.parsed.update(batch_parsed)
+        return outputs
+
+
+    def retry_malformed(self,
+                        responses: Dict[str, Dict[str, Any]],
+                        request_ids: List[str],
+                        malformed: Callable[[Dict[str, Any]], bool],
+                        requery: Callable[[List[str]], List[Dict[str, Any]]]) -> List[str]:
+        """
+        re-query malformed responses of request_ids as one batch per round, up to self.retries rounds.
+        requery: outputs of the given request ids, with a stricter format reminder.
+        Recovered responses replace the malformed ones in responses (with `retries`: rounds taken);
+        responses still malformed are kept and flagged with `malformed: True`.
+        Counts are accumulated in self.retry_stats. return: request ids still malformed.
+        """
+        pending = [rid for rid in request_ids if rid in responses and malformed(responses[rid])]
+        num_malformed = len(pending)
+
+        for retry in range(self.retries):
+            if len(pending) == 0:
+                break
+            outputs = index_responses(requery(pending))
+            self.retry_stats['requeried'] += len(pending)
+            recovered = {rid for rid in pending if rid in outputs and malformed(outputs[rid]) is False}
+            for rid in recovered:
+                responses[rid] = {**outputs[rid], 'retries': retry + 1}
+            pending = [rid for rid in pending if rid not in recovered]
+
+        for rid in pending:
+            responses[rid]['malformed'] = True
+
+        self.retry_stats['malformed'] += num_malformed
+        self.retry_stats['recovered'] += num_malformed - len(pending)
+        if num_malformed > 0:
+            print(f"[INFO] {type(self).__name__}: {num_malformed} malformed responses, "
+                  f"{num_malformed - len(pending)} recovered by re-query.")
+        return pending
+
+
+def build_overlap(overlap: Dict[str, Any]=None) -> OverlapRunner:
+    """batch runner of an `overlap` stage config, None to build and generate all prompts at once."""
+    return OverlapRunner(**overlap) if overlap else None
+
+
+def new_retry_stats() -> Dict[str, int]:
+    """counts of malformed responses, re-queried requests, and responses recovered by re-query."""
+    return {'malformed': 0, 'requeried': 0, 'recovered': 0}
@@ -0,0 +1,68 @@
+"""
+Microbenchmark of prompt construction: plain templates vs. compiled templates.
+
+The plain path formats every conversation turn, applies the chat template and tokenizes the
+whole prompt, as the engine does for string prompts. The compiled path splices fields into
+precompiled chunks and tokenizes only the uncached tail. Only the tokenizer is loaded.
+"""
+
+import argparse
+import os.path as osp
+import time
+
+from transformers import AutoTokenizer
+
+from prompts.prompts import TEMPLATE_GEMBA_MQM_FEWSHOT, TEMPLATE_POSTEDIT, TEMPLATE_VERIFIER
+from template_compiler import CompiledTemplate, chat_prompt
+from utils import apply_template, readlines_txt
+
+
+def parse_args():
+    current_dir = osp.dirname(osp.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, required=True, help="Path of tokenizer (model path).")
+    parser.add_argument("--src", type=str, default=osp.join(current_dir, "test/srcs_zh.txt"), help="Path of src.")
+    parser.add_argument("--tgt", type=str, default=osp.join(current_dir, "test/tgts_en.txt"), help="Path of tgt.")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of passes over the test set.")
+
+    args = parser.parse_args()
+    return args
+
+
+def bench(fn, inputs, repeat):
+    step_timer = time.perf_counter()
+    for _ in range(repeat):
+        for _input in inputs:
+            fn(_input)
+    return (time.perf_counter() - step_timer) / (repeat * len(inputs)) * 1e6
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    srcs = readlines_txt(args.src)
+    tgts = readlines_txt(args.tgt)
+
+    inputs = [{
+        'source_lang': 'Chinese',
+        'source_seg': src,
+        'target_lang': 'English',
+        'target_seg': tgt,
+        'error_category': 'accuracy/mistranslation',
+        'error_content': tgt.split(' ')[0],
+        'transA_seg': tgt,
+        'transB_seg': tgt,
+    } for src, tgt in zip(srcs, tgts)]
+
+    for name, template in ('evaluator', TEMPLATE_GEMBA_MQM_FEWSHOT), ('ape', TEMPLATE_POSTEDIT), ('verifier', TEMPLATE_VERIFIER):
+
+        step_timer = time.perf_counter()
+        compiled = CompiledTemplate(template, tokenizer)
+        compile_ms = (time.perf_counter() - step_timer) * 1e3
+
+        plain_us = bench(lambda _input: tokenizer.encode(chat_prompt(tokenizer, apply_template(template, _input))), inputs, args.repeat)
+        compiled_us = bench(compiled.tokenize, inputs, args.repeat)
+
+        print(f"[{name}] valid={compiled.valid} edge_safe={compiled.edge_safe} cached prefix tokens={len(compiled.prefix_ids)} compile={compile_ms:.1f}ms "
+              f"plain={plain_us:.1f}us/prompt compiled={compiled_us:.1f}us/prompt speedup={plain_us / compiled_us:.1f}x")
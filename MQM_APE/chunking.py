@@ -0,0 +1,137 @@
+"""
+Token-length guard of evaluator, APE and verifier prompts, with sentence chunking of long segments.
+
+The prompt budget of a stage is `max_prompt_tokens` of its config, or the context length of
+its engine (`max_model_len`) minus the tokens it generates. Prompts are measured with the
+engine's tokenizer. A segment whose prompt is over budget is split into chunks of consecutive
+sentences, source and target into the same number of chunks of balanced length, with as few
+chunks as keep the prompts within budget. Chunks keep the offsets of their target text, so
+error spans and post-edits of chunks are stitched back into the segment. Requests still over
+budget (a single long sentence) are not sent to the engine, and their segments are marked.
+"""
+
+import os.path as osp
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# a sentence ends at . ! ? before a space and a word not in lowercase (not after an abbreviation such as "Dr."),
+# or at CJK sentence punctuation
+SENTENCE = re.compile(r'.+?(?:(?:(?<!\b[A-Z])(?<!\b[A-Z][a-z])\.+|[!?]+)["”’)\]]*(?=\s+[^\sa-z]|\s*$)|[。！？；]+["”’）」]*|$)\s*',
+                      flags=re.S)
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """[begin, end) of the sentences of text, covering it; trailing whitespace stays with a sentence."""
+    spans = [match.span() for match in SENTENCE.finditer(text) if match.group().strip() != '']
+    if len(spans) > 0: # leading whitespace joins the first sentence
+        spans[0] = (0, spans[0][1])
+    return spans
+
+
+def group_spans(spans: List[Tuple[int, int]], num_groups: int) -> List[Tuple[int, int]]:
+    """num_groups runs of consecutive spans with balanced total length, each non-empty."""
+    total = spans[-1][1] - spans[0][0]
+    groups, begin = [], 0
+    for group in range(1, num_groups):
+        end = begin + 1
+        # extend while the group ends before its share, leaving a span for each later group
+        while end < len(spans) - (num_groups - group) and spans[end - 1][1] - spans[0][0] < group * total / num_groups:
+            end += 1
+        groups.append((spans[begin][0], spans[end - 1][1]))
+        begin = end
+    groups.append((spans[begin][0], spans[-1][1]))
+    return groups
+
+
+def stripped(text: str, begin: int, end: int) -> Tuple[int, int]:
+    """offsets of text[begin:end] without surrounding whitespace."""
+    chunk = text[begin:end]
+    return begin + len(chunk) - len(chunk.lstrip()), end - len(chunk) + len(chunk.rstrip())
+
+
+def split_fields(fields: Dict[str, str], num_chunks: int) -> List[Tuple[Dict[str, str], Tuple[int, int]]]:
+    """
+    fields of each chunk of a segment, with source_seg and target_seg replaced by the chunk,
+    and the [begin, end) offsets of the target chunk in target_seg.
+    """
+    src, tgt = fields['source_seg'], fields['target_seg']
+    src_spans, tgt_spans = sentence_spans(src), sentence_spans(tgt)
+    num_chunks = min(num_chunks, len(src_spans), len(tgt_spans))
+
+    chunks = []
+    for (src_begin, src_end), (tgt_begin, tgt_end) in zip(group_spans(src_spans, num_chunks), group_spans(tgt_spans, num_chunks)):
+        tgt_begin, tgt_end = stripped(tgt, tgt_begin, tgt_end)
+        chunks.append(({**fields, 'source_seg': src[src_begin:src_end].strip(), 'target_seg': tgt[tgt_begin:tgt_end]},
+                       (tgt_begin, tgt_end)))
+    return chunks
+
+
+def max_chunks(fields: Dict[str, str]) -> int:
+    """most chunks a segment splits into: its sentences, in the shorter of source and target."""
+    return min(len(sentence_spans(fields['source_seg'])), len(sentence_spans(fields['target_seg'])))
+
+
+def holding_chunk(chunks: List[Tuple[Dict[str, str], Tuple[int, int]]], span: str) -> int:
+    """index of the chunk whose target holds span, else the chunk sharing most of its words."""
+    for idx, (chunk_fields, _) in enumerate(chunks):
+        if span != '' and span in chunk_fields['target_seg']:
+            return idx
+    words = set(span.lower().split())
+    return max(range(len(chunks)), key=lambda idx: (len(words & set(chunks[idx][0]['target_seg'].lower().split())), -idx))
+
+
+def edited_region(target: str, post_edit: str) -> Tuple[int, int]:
+    """[begin, end) offsets of target outside its common prefix and suffix with post_edit."""
+    begin = len(osp.commonprefix([target, post_edit]))
+    suffix = len(osp.commonprefix([target[begin:][::-1], post_edit[begin:][::-1]]))
+    return begin, len(target) - suffix
+
+
+def prompt_budget(inference, max_prompt_tokens: Optional[int], max_tokens: int) -> Optional[int]:
+    """max_prompt_tokens, or the context length of the engine minus generated tokens, None if neither is known."""
+    if max_prompt_tokens is not None:
+        return max_prompt_tokens
+    max_model_len = getattr(inference, 'max_model_len', None)
+    return None if max_model_len is None else max_model_len - max_tokens
+
+
+class LengthGuard():
+    """measure built prompts against a token budget, and split over-budget segments into sentence chunks."""
+
+    def __init__(self,
+                 inference: Any, # backend with build_prompts and num_tokens
+                 build_prompts: Callable[[List[Dict[str, str]]], List[Any]], # prompts of template fields
+                 max_prompt_tokens: int):
+
+        self.inference = inference
+        self.build_prompts = build_prompts
+        self.max_prompt_tokens = max_prompt_tokens
+
+
+    def over_budget(self, inputs: List[Dict[str, str]]) -> List[bool]:
+        inputs = list(inputs)
+        if len(inputs) == 0:
+            return []
+        return [self.inference.num_tokens(prompt) > self.max_prompt_tokens for prompt in self.build_prompts(inputs)]
+
+
+    def split(self, fields: Dict[str, str], span: str=None) -> List[Tuple[Dict[str, str], Tuple[int, int]]]:
+        """
+        chunks of an over-budget segment, doubling their number until all prompts (with span, the
+        prompt of the chunk holding it) fit. Sentences that do not fit alone stay over budget.
+        return: (fields, target offsets) of each chunk, or of the chunk holding span, and whether
+        each is still over budget; [], [] if the segment is a single sentence.
+        """
+        limit = max_chunks(fields)
+        if limit < 2:
+            return [], []
+
+        num_chunks = 2
+        while True:
+            chunks = split_fields(fields, num_chunks)
+            if span is not None:
+                chunks = [chunks[holding_chunk(chunks, span)]]
+            over = self.over_budget([chunk_fields for chunk_fields, _ in chunks])
+            if num_chunks >= limit or not any(over):
+                return chunks, over
+            num_chunks = min(num_chunks * 2, limit)
@@ -0,0 +1,289 @@
+"""
+CPU path of WMT22-cometkiwi-da: export the Lightning checkpoint to an ONNX or TorchScript
+graph, optionally with int8 dynamic quantization of its linear layers, and serve it on CPU
+behind the `cometkiwi_eval` API of cometkiwi.COMETKiwi.
+
+    python3 cometkiwi_cpu.py export --checkpoint /path/to/model.ckpt --export_dir ./cometkiwi_cpu --format onnx --quantize
+    python3 cometkiwi_cpu.py drift --checkpoint /path/to/model.ckpt --export_dir ./cometkiwi_cpu \
+        --src ./test/srcs_zh.txt --tgt ./test/tgts_en.txt --results ./test/outs/metric_verifier/results.json
+
+The export directory holds the graph, the tokenizer of the encoder and export.json. The
+runtime only needs onnxruntime (or torch for TorchScript) and transformers, not comet: inputs
+are tokenized as "<s> mt </s></s> src </s>" pairs, which export checks against comet's own
+inputs. Inputs are batched in order of length to keep padding low, and intra-op threads are
+set with `num_threads`.
+
+The drift report scores the test set with the original model and the export and reports the
+score differences, correlations, speed, and with --results the share of errors whose metric
+verifier decision (post-edit better than target by metric_threshold) is unchanged.
+"""
+
+import argparse
+import json
+import os
+import os.path as osp
+import time
+from typing import Any, Dict, List, Tuple
+
+from utils import read_json, readlines_txt, save_json
+
+EXPORT_META = "export.json"
+INPUT_NAMES = ('input_ids', 'attention_mask')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, choices=['export', 'drift'])
+    parser.add_argument("--checkpoint", type=str, required=True, help="Path of the cometkiwi Lightning checkpoint.")
+    parser.add_argument("--export_dir", type=str, required=True, help="Directory of the exported graph and tokenizer.")
+
+    # export
+    parser.add_argument("--format", type=str, default='onnx', choices=['onnx', 'torchscript'], help="Runtime graph format.")
+    parser.add_argument("--quantize", action="store_true", default=False, help="Whether to quantize linear layers to int8.")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum tokens of a (mt, src) pair.")
+    parser.add_argument("--opset", type=int, default=14, help="ONNX opset version.")
+
+    # drift
+    parser.add_argument("--src", type=str, default="./test/srcs_zh.txt", help="Path of src.")
+    parser.add_argument("--tgt", type=str, default="./test/tgts_en.txt", help="Path of tgt.")
+    parser.add_argument("--results", type=str, default=None, help="results.json whose post-edits are scored and compared as the metric verifier does.")
+    parser.add_argument("--metric_threshold", type=float, default=0.03, help="Score threshold of the metric verifier.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of the export, all cores by default.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Pairs per batch.")
+    parser.add_argument("--gpus", type=int, default=0, help="GPUs of the original model in the drift report.")
+    parser.add_argument("--out", type=str, default=None, help="Path of the JSON drift report.")
+    return parser.parse_args()
+
+
+def pair_ids(tokenizer, src: str, mt: str, max_length: int) -> List[int]:
+    """token ids of a (mt, src) pair as input of the cometkiwi encoder."""
+    return tokenizer(mt, src, truncation=True, max_length=max_length)['input_ids']
+
+
+def export_model(checkpoint: str,
+                 export_dir: str,
+                 fmt: str='onnx',
+                 quantize: bool=False,
+                 max_length: int=512,
+                 opset: int=14) -> Dict[str, Any]:
+    """export the checkpoint into export_dir. return: export metadata."""
+    import torch
+    from comet import load_from_checkpoint
+
+    model = load_from_checkpoint(checkpoint, reload_hparams=True)
+    model.eval()
+    tokenizer = model.encoder.tokenizer
+
+    class ScoreGraph(torch.nn.Module): # the regression score only
+        def __init__(self, model) -> None:
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).score
+
+    # tokenization of the runtime must match comet's own inputs
+    samples = [{'src': "曼德拉成为南非第一位黑人总统。", 'mt': "Mandela became South Africa's first black president."},
+               {'src': "The display never glitches.", 'mt': "Die Anzeige stört nie."}]
+    model_inputs = model.prepare_for_inference(samples)[0]
+    for sample, input_ids, attention_mask in zip(samples, model_inputs['input_ids'], model_inputs['attention_mask']):
+        if input_ids[attention_mask.bool()].tolist() != pair_ids(tokenizer, sample['src'], sample['mt'], max_length):
+            raise RuntimeError("Encoder inputs of the checkpoint differ from (mt, src) pairs of its tokenizer, can not export.")
+
+    if osp.exists(export_dir) is False:
+        os.makedirs(export_dir)
+    tokenizer.save_pretrained(export_dir)
+
+    graph = ScoreGraph(model)
+    example = tuple(model_inputs[name] for name in INPUT_NAMES)
+    with torch.no_grad():
+        reference = graph(*example)
+
+    if fmt == 'onnx':
+        graph_file = "model.onnx"
+        torch.onnx.export(graph, example, osp.join(export_dir, graph_file),
+                          input_names=list(INPUT_NAMES),
+                          output_names=['score'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'length'},
+                                        'attention_mask': {0: 'batch', 1: 'length'},
+                                        'score': {0: 'batch'}},
+                          opset_version=opset)
+        if quantize is True:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(osp.join(export_dir, graph_file), osp.join(export_dir, "model.int8.onnx"),
+                             weight_type=QuantType.QInt8,
+                             use_external_data_format=True) # weights of the large encoder exceed 2 GB in fp32
+            graph_file = "model.int8.onnx"
+
+    elif fmt == 'torchscript':
+        graph_file = "model.int8.pt" if quantize is True else "model.pt"
+        if quantize is True:
+            graph = torch.ao.quantization.quantize_dynamic(graph, {torch.nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            traced = torch.jit.trace(graph, example, strict=False)
+        torch.jit.save(traced, osp.join(export_dir, graph_file))
+
+    else:
+        raise ValueError(f"Unknown export format {fmt}")
+
+    meta = {
+        'checkpoint': checkpoint,
+        'format': fmt,
+        'graph': graph_file,
+        'quantized': quantize,
+        'max_length': max_length,
+        'example_scores': reference.tolist(),
+    }
+    save_json(meta, osp.join(export_dir, EXPORT_META))
+    return meta
+
+
+class COMETKiwiCPU():
+    """exported cometkiwi on CPU, with the cometkiwi_eval API of cometkiwi.COMETKiwi."""
+
+    def __init__(self,
+                 model_path: str, # export directory of export_model
+                 num_threads: int=None # intra-op threads, all cores by default
+                 ) -> None:
+
+        from transformers import AutoTokenizer
+
+        self.model_path = model_path
+        self.meta = read_json(osp.join(model_path, EXPORT_META))
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.num_threads = num_threads or os.cpu_count()
+
+        graph_path = osp.join(model_path, self.meta['graph'])
+        if self.meta['format'] == 'onnx':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.num_threads
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = ort.InferenceSession(graph_path, options, providers=['CPUExecutionProvider'])
+        else:
+            import torch
+            torch.set_num_threads(self.num_threads)
+            self.session = torch.jit.load(graph_path, map_location='cpu')
+            self.session.eval()
+
+
+    def run_batch(self, batch_ids: List[List[int]]) -> List[float]:
+        padded = self.tokenizer.pad({'input_ids': batch_ids}, return_tensors='np' if self.meta['format'] == 'onnx' else 'pt')
+        if self.meta['format'] == 'onnx':
+            outputs = self.session.run(['score'], {name: padded[name].astype('int64') for name in INPUT_NAMES})
+            return outputs[0].reshape(-1).tolist()
+
+        import torch
+        with torch.inference_mode():
+            return self.session(*(padded[name] for name in INPUT_NAMES)).reshape(-1).tolist()
+
+
+    def cometkiwi_eval(self,
+                       srcs: List[str],
+                       hyps: List[str],
+                       batch_size: int=8,
+                       gpus: int=0 # accepted for the API of COMETKiwi, the export runs on CPU
+                       ) -> Tuple[List[float], float]:
+
+        assert len(srcs) == len(hyps), "length of srcs and hyps should be the same!"
+
+        input_ids = [pair_ids(self.tokenizer, src, mt, self.meta['max_length']) for src, mt in zip(srcs, hyps)]
+        order = sorted(range(len(input_ids)), key=lambda idx: len(input_ids[idx]), reverse=True)
+
+        scores = [0.0] * len(input_ids)
+        for begin in range(0, len(order), batch_size):
+            batch = order[begin:begin + batch_size]
+            for idx, score in zip(batch, self.run_batch([input_ids[idx] for idx in batch])):
+                scores[idx] = score
+
+        return scores, sum(scores) / len(scores) if len(scores) > 0 else 0.0
+
+
+def pearson(xs: List[float], ys: List[float]) -> float:
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    var_y = sum((y - mean_y) ** 2 for y in ys)
+    return cov / (var_x * var_y) ** 0.5 if var_x > 0 and var_y > 0 else 0.0
+
+
+def ranks(xs: List[float]) -> List[float]:
+    """ranks with ties averaged."""
+    order = sorted(range(len(xs)), key=lambda idx: xs[idx])
+    ranked = [0.0] * len(xs)
+    begin = 0
+    while begin < len(order):
+        end = begin
+        while end + 1 < len(order) and xs[order[end + 1]] == xs[order[begin]]:
+            end += 1
+        for position in range(begin, end + 1):
+            ranked[order[position]] = (begin + end) / 2
+        begin = end + 1
+    return ranked
+
+
+def drift_report(reference, export, pairs: List[Tuple[str, str]], batch_size: int=8, gpus: int=0,
+                 decisions: List[Tuple[int, int]]=None, metric_threshold: float=0.03) -> Dict[str, Any]:
+    """
+    scores of (src, mt) pairs by the original model (reference) and the export, compared.
+    decisions: (target pair, post-edit pair) indices whose verifier decision is compared.
+    """
+    srcs, hyps = [src for src, _ in pairs], [mt for _, mt in pairs]
+    timings, scores = {}, {}
+    for name, scorer in ('reference', reference), ('export', export):
+        timer = time.time()
+        scores[name], _ = scorer.cometkiwi_eval(srcs, hyps, batch_size=batch_size, gpus=gpus)
+        timings[name] = time.time() - timer
+
+    diffs = [abs(a - b) for a, b in zip(scores['reference'], scores['export'])]
+    report = {
+        'pairs': len(pairs),
+        'mean_abs_diff': sum(diffs) / len(diffs) if len(diffs) > 0 else 0.0,
+        'max_abs_diff': max(diffs, default=0.0),
+        'pearson': pearson(scores['reference'], scores['export']),
+        'spearman': pearson(ranks(scores['reference']), ranks(scores['export'])),
+        'system_score_diff': (sum(scores['export']) - sum(scores['reference'])) / len(pairs) if len(pairs) > 0 else 0.0,
+        'seconds': timings,
+        'pairs_per_second': {name: len(pairs) / seconds if seconds > 0 else None for name, seconds in timings.items()},
+    }
+
+    if decisions:
+        agree = sum((scores['reference'][ape] - scores['reference'][tgt] > metric_threshold) ==
+                    (scores['export'][ape] - scores['export'][tgt] > metric_threshold) for tgt, ape in decisions)
+        report['verifier_decisions'] = len(decisions)
+        report['verifier_agreement'] = agree / len(decisions)
+
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.command == 'export':
+        meta = export_model(args.checkpoint, args.export_dir, args.format, args.quantize, args.max_length, args.opset)
+        print(f"[INFO] Exported {args.checkpoint} to {osp.join(args.export_dir, meta['graph'])}.")
+
+    else:
+        from cometkiwi import COMETKiwi
+
+        srcs, tgts = readlines_txt(args.src), readlines_txt(args.tgt)
+        assert len(srcs) == len(tgts), "length of src and tgt should be the same!"
+        pairs, decisions = list(zip(srcs, tgts)), []
+        if args.results is not None: # post-edits of each error, against the target of its segment
+            for seg_id, result in enumerate(read_json(args.results)):
+                for errors in result['error_dict'].values():
+                    for error in errors:
+                        if error.get('post_edit'):
+                            decisions.append((seg_id, len(pairs)))
+                            pairs.append((result['source_seg'], error['post_edit']))
+
+        report = drift_report(COMETKiwi(args.checkpoint), COMETKiwiCPU(args.export_dir, args.num_threads), pairs,
+                              args.batch_size, args.gpus, decisions, args.metric_threshold)
+        print(f"[INFO] Drift of {args.export_dir} on {report['pairs']} pairs: "
+              f"mean |diff| {report['mean_abs_diff']:.4f}, max |diff| {report['max_abs_diff']:.4f}, "
+              f"pearson {report['pearson']:.4f}, spearman {report['spearman']:.4f}"
+              + (f", verifier agreement {report['verifier_agreement']:.2%}" if 'verifier_agreement' in report else '') + ".")
+        print(f"[INFO] Pairs per second: {json.dumps(report['pairs_per_second'])}")
+
+        if args.out is not None:
+            save_json(report, args.out)
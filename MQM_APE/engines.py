@@ -0,0 +1,159 @@
+"""
+Build the inference backend named by `backend` in the inference config.
+
+vllm (default): inference.Inference, LLM inference using VLLM.
+standin: inference_standin.StandinInference, deterministic responses without a model, for tests.
+
+Stages (evaluator, ape, verifier) may route to different engines. The `inference` section is
+the default engine; further engines are named in an `engines` section and chosen per stage
+with `engine: <name>`. Engines with the same config are loaded once, on first use, and each
+stage accounts its own calls, tokens and GPU seconds. With a journal path, a stage appends
+the responses of each call to it as JSON lines, so a crashed run can resume from them.
+"""
+
+import gc
+import json
+import time
+from typing import Any, Dict, List
+
+from utils import append_jsonl
+
+DEFAULT_ENGINE = 'default'
+
+
+def build_inference(config: Dict[str, Any]):
+    config = dict(config)
+    backend = config.pop('backend', 'vllm')
+
+    if backend == 'vllm':
+        from inference import Inference
+        return Inference(**config)
+
+    if backend == 'standin':
+        from inference_standin import StandinInference
+        return StandinInference(**config)
+
+    raise ValueError(f"Unknown inference backend {backend}")
+
+
+def build_prompt_engine(config: Dict[str, Any]):
+    """tokenizer and prompt building of the backend, without loading model weights."""
+    config = dict(config)
+    backend = config.pop('backend', 'vllm')
+
+    if backend == 'vllm':
+        from template_compiler import PromptEngine
+        return PromptEngine(**config)
+
+    if backend == 'standin': # holds no weights
+        from inference_standin import StandinInference
+        return StandinInference(**config)
+
+    raise ValueError(f"Unknown inference backend {backend}")
+
+
+class StageEngine():
+    """
+    engine handle of one stage: loads the shared engine on first use and accounts the stage's
+    requests. Other attributes (tokenizer, speculative, ...) are those of the engine.
+    """
+
+    def __init__(self, pool: 'EnginePool', stage: str, engine_name: str) -> None:
+        self.pool = pool
+        self.stage = stage
+        self.engine_name = engine_name
+        self.costs = {'calls': 0, 'requests': 0, 'prompt_tokens': 0, 'generated_tokens': 0, 'seconds': 0.0}
+        self.journal = None # JSON lines file the responses of each call are appended to
+
+    @property
+    def engine(self):
+        return self.pool.load(self.engine_name)
+
+    def __getattr__(self, name: str):
+        if name in ('pool', 'stage', 'engine_name', 'costs', 'journal'): # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+    def build_prompts(self, template, inputs) -> List[Any]:
+        inputs = list(inputs)
+        if len(inputs) == 0: # nothing to query, keep the engine unloaded
+            return []
+        return self.engine.build_prompts(template, inputs)
+
+    def inference(self, inputs, temperature: float=0, max_tokens: int=256, return_token_ids: bool=False, **kwargs) -> List[Dict[str, Any]]:
+        if len(inputs) == 0:
+            return []
+
+        engine = self.engine
+        timer = time.time()
+        outputs = engine.inference(inputs, temperature, max_tokens, return_token_ids=True, **kwargs)
+
+        self.costs['calls'] += 1
+        self.costs['requests'] += len(outputs)
+        self.costs['seconds'] += time.time() - timer
+        for _output in outputs:
+            self.costs['prompt_tokens'] += len(_output['prompt_token_ids'])
+            self.costs['generated_tokens'] += sum(map(len, _output.get('samples_token_ids', [_output['token_ids']])))
+            if return_token_ids is False:
+                _output.pop('prompt_token_ids')
+                _output.pop('token_ids')
+                _output.pop('samples_token_ids', None)
+
+        if self.journal is not None:
+            append_jsonl([{key: value for key, value in _output.items() if not key.endswith('token_ids')}
+                          for _output in outputs if 'request_id' in _output], self.journal)
+        return outputs
+
+
+class EnginePool():
+    """engines of a config, built lazily and shared by stages whose engine configs are equal."""
+
+    def __init__(self, configs: Dict[str, Any]) -> None:
+        self.engine_configs = {DEFAULT_ENGINE: configs['inference'], **(configs.get('engines') or {})}
+        self.engines = {} # canonical engine config -> engine
+        self.stages: Dict[str, StageEngine] = {}
+
+    def engine_key(self, engine_name: str) -> str:
+        if engine_name not in self.engine_configs:
+            raise ValueError(f"Unknown engine {engine_name}, expected one of {list(self.engine_configs)}")
+        return json.dumps(self.engine_configs[engine_name], sort_keys=True)
+
+    def load(self, engine_name: str):
+        key = self.engine_key(engine_name)
+        if key not in self.engines:
+            print(f"[INFO] Loading engine {engine_name}: {self.engine_configs[engine_name].get('model_path')}")
+            self.engines[key] = build_inference(self.engine_configs[engine_name])
+        return self.engines[key]
+
+    def release(self) -> None:
+        """drop loaded engines and free their GPU memory, so another engine profile can be loaded."""
+        self.engines.clear()
+        gc.collect()
+        try:
+            import torch
+            from vllm.distributed.parallel_state import destroy_distributed_environment, destroy_model_parallel
+        except ImportError: # no vllm engine was loaded
+            return
+        destroy_model_parallel()
+        destroy_distributed_environment()
+        torch.cuda.empty_cache()
+
+    def stage(self, stage: str, engine_name: str=None) -> StageEngine:
+        """engine handle of a stage, on the default engine unless engine_name is given."""
+        engine_name = engine_name or DEFAULT_ENGINE
+        self.engine_key(engine_name) # fail early on unknown engines
+        self.stages[stage] = StageEngine(self, stage, engine_name)
+        return self.stages[stage]
+
+    def cost_report(self) -> Dict[str, Dict[str, Any]]:
+        """per-stage costs, with GPU seconds (seconds x tensor parallel size) of the stage's engine."""
+        report = {}
+        for stage, handle in self.stages.items():
+            config = self.engine_configs[handle.engine_name]
+            report[stage] = {
+                'engine': handle.engine_name,
+                'model_path': config.get('model_path'),
+                **handle.costs,
+                'gpu_seconds': handle.costs['seconds'] * config.get('tp', 1),
+            }
+        return report
@@ -0,0 +1,119 @@
+"""
+Language-pair-aware few-shot selection for the GEMBA-MQM evaluator.
+
+Examples come from a bank: GEMBA_MQM_FEW_SHOTS_PROMPT, extended with examples from a JSON / YAML
+file. For a language pair, examples are ranked by match (same pair, then same target language,
+then same source language) and added while the evaluator template stays within a prompt-token
+budget, measured with the tokenizer of the active inference backend. Selected examples keep
+their bank order, so the default bank without a budget reproduces TEMPLATE_GEMBA_MQM_FEWSHOT.
+The template of each pair is built once and cached.
+"""
+
+from string import Formatter
+from typing import Any, Dict, List, Tuple, Union
+
+from prompts.prompt_contexts import GEMBA_MQM_FEW_SHOTS_PROMPT
+from prompts.prompts import gemba_mqm_fewshot, gemba_mqm_packed_fewshot, with_reminder
+from utils import apply_template, load_yaml
+
+EXAMPLE_KEYS = ('source_lang', 'source_seg', 'target_lang', 'target_seg', 'answer')
+
+
+def load_examples(path: str) -> Dict[str, Dict[str, str]]:
+    """examples of a JSON / YAML file, a dict of named examples or a list."""
+    examples = load_yaml(path)
+    if isinstance(examples, list):
+        examples = {f"{path}:{idx}": example for idx, example in enumerate(examples)}
+
+    for name, example in examples.items():
+        for key in EXAMPLE_KEYS:
+            if key not in example:
+                raise ValueError(f"Few-shot example {name} misses '{key}'.")
+    return examples
+
+
+def escape_example(example: Dict[str, str]) -> Dict[str, str]:
+    """escape braces, since every turn of a template is formatted again with the inputs."""
+    return {key: str(value).replace('{', '{{').replace('}', '}}') for key, value in example.items()}
+
+
+class FewShotSelector():
+
+    def __init__(self,
+                 inference: 'Inference', # inference.Inference or a backend with the same interface
+                 max_shots: int=3,
+                 token_budget: int=None, # prompt tokens of the template without the segment, None for no budget
+                 bank: Union[str, List[str]]=None): # example files added to GEMBA_MQM_FEW_SHOTS_PROMPT
+
+        self.inference = inference
+        self.max_shots = max_shots
+        self.token_budget = token_budget
+
+        self.examples = dict(GEMBA_MQM_FEW_SHOTS_PROMPT)
+        for path in [bank] if isinstance(bank, str) else bank or []:
+            self.examples.update(load_examples(path))
+
+        self.templates: Dict[Tuple[str, str, bool], List[Dict[str, str]]] = {}
+
+
+    def relevance(self, name: str, source_lang: str, target_lang: str) -> int:
+        example = self.examples[name]
+        same_source = example['source_lang'] == source_lang
+        same_target = example['target_lang'] == target_lang
+        return 4 * (same_source and same_target) + 2 * same_target + same_source
+
+
+    def num_tokens(self, template: List[Dict[str, str]]) -> int:
+        """prompt tokens of the template with empty fields."""
+        fields = {name: '' for turn in template for _, name, _, _ in Formatter().parse(turn['content']) if name}
+        prompt = self.inference.input2prompt(apply_template(template, fields))
+        return len(self.inference.tokenizer.encode(prompt))
+
+
+    def build(self, names: List[str], packed: bool=False) -> List[Dict[str, str]]:
+        names = [name for name in self.examples if name in names] # bank order
+        shots = [escape_example(self.examples[name]) for name in names]
+        return gemba_mqm_packed_fewshot(shots) if packed else gemba_mqm_fewshot(shots)
+
+
+    def select(self, source_lang: str, target_lang: str, packed: bool=False) -> List[str]:
+        """names of the most relevant examples that fit max_shots and the token budget."""
+        ranked = sorted(self.examples, key=lambda name: self.relevance(name, source_lang, target_lang), reverse=True)
+
+        selected = []
+        for name in ranked:
+            if len(selected) == self.max_shots:
+                break
+            if self.token_budget is not None and self.num_tokens(self.build(selected + [name], packed)) > self.token_budget:
+                continue
+            selected.append(name)
+
+        return [name for name in self.examples if name in selected]
+
+
+    def template(self, source_lang: str, target_lang: str, packed: bool=False) -> List[Dict[str, str]]:
+        """evaluator template of a language pair, built on first use."""
+        key = (source_lang, target_lang, packed)
+        if key not in self.templates:
+            names = self.select(source_lang, target_lang, packed)
+            self.templates[key] = self.build(names, packed)
+            print(f"[INFO] Few-shot examples of {source_lang}-{target_lang}{' (packed)' if packed else ''}: "
+                  f"{names}, {self.num_tokens(self.templates[key])} prompt tokens.")
+        return self.templates[key]
+
+
+    def build_prompts(self, inputs: List[Dict[str, Any]], packed: bool=False, reminder: str=None) -> List[Any]:
+        """prompts of inputs with the template of each language pair, in the order of inputs, optionally ending with a format reminder."""
+        groups = {}
+        for idx, _input in enumerate(inputs):
+            groups.setdefault((_input['source_lang'], _input['target_lang']), []).append(idx)
+
+        prompts = [None] * len(inputs)
+        for (source_lang, target_lang), indices in groups.items():
+            template = self.template(source_lang, target_lang, packed)
+            if reminder is not None:
+                template = with_reminder(template, reminder)
+            for idx, prompt in zip(indices, self.inference.build_prompts(template, [inputs[idx] for idx in indices])):
+                prompts[idx] = prompt
+
+        return prompts
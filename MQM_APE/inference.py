@@ -3,28 +3,52 @@ LLM Inference using VLLM.
 """
 
 import time
-from typing import List, Dict
+from typing import Any, List, Dict
 
 from transformers import AutoTokenizer
 from vllm import LLM, SamplingParams
 
+from speculative import DEFAULT_SPECULATIVE, speculative_engine_kwargs
+from template_compiler import TemplateCache, TokenizedPrompt, chat_prompt
+from utils import apply_template
+
 class Inference():
 
     def __init__(self, 
                  model_path: str,
                  tp: int=1,
+                 speculative: Dict[str, int]=None, # prompt-lookup speculative decoding, e.g. {'num_speculative_tokens': 5}
+                 compile_templates: bool=True, # render and tokenize static template parts once
+                 scheduling_policy: str='fcfs', # 'priority' lets the engine preempt lower priority requests (vllm>=0.6.3)
+                 gpu_memory_utilization: float=0.8, # fraction of GPU memory for weights, activations and KV cache
+                 max_num_seqs: int=None, # sequences per engine step, None for the vllm default
+                 max_num_batched_tokens: int=None, # tokens per engine step, None for the vllm default
+                 swap_space: float=None, # GiB of CPU swap per GPU for preempted sequences, None for the vllm default
+                 max_model_len: int=None, # context length of the engine, None for that of the model config
                  ) -> None:
         
+        self.speculative = {**DEFAULT_SPECULATIVE, **speculative} if speculative else None
+        self.scheduling_policy = scheduling_policy
+
         # load model
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.compile_templates = compile_templates
+        self.template_cache = TemplateCache(self.tokenizer)
         self.model = LLM(
             model=model_path,
             tokenizer=model_path,
             tensor_parallel_size=tp,
-            gpu_memory_utilization=0.8,
-            trust_remote_code=True
+            gpu_memory_utilization=gpu_memory_utilization,
+            trust_remote_code=True,
+            **speculative_engine_kwargs(speculative),
+            **{key: value for key, value in (('max_num_seqs', max_num_seqs),
+                                             ('max_num_batched_tokens', max_num_batched_tokens),
+                                             ('swap_space', swap_space),
+                                             ('max_model_len', max_model_len)) if value is not None},
+            **({'scheduling_policy': scheduling_policy} if scheduling_policy != 'fcfs' else {})
         )
+        self.max_model_len = self.model.llm_engine.model_config.max_model_len # prompt and generated tokens of a request
         
     def input2prompt(self, sample):
         """
@@ -41,59 +65,117 @@ class Inference():
             {"role": "user", "content": "Post edit the translation."}
         ]
         """
-        if isinstance(sample, str): # input format 1
-            return sample
-        
-        try: # input format 2
-            return self.tokenizer.apply_chat_template(
-                sample,
-                tokenize=False,
-                add_generation_prompt=True
-            )
-        except: # input format 3
-            return 'system:' + sample[0]['content'] + self.tokenizer.apply_chat_template(
-                sample[1:],
-                tokenize=False,
-                add_generation_prompt=True
-            )
+        return chat_prompt(self.tokenizer, sample)
+
+
+    def build_prompts(self, template, inputs: List[Dict[str, Any]]) -> List[Any]:
+        """
+        fill template with each input.
+        return: TokenizedPrompt list if templates are compiled, else formatted templates.
+        """
+        if self.compile_templates is False:
+            return [apply_template(template, _input) for _input in inputs]
+        return self.template_cache.build_prompts(template, inputs)
+
+    def num_tokens(self, prompt) -> int:
+        """tokens of a built prompt."""
+        if isinstance(prompt, TokenizedPrompt):
+            return len(prompt.prompt_token_ids)
+        return len(self.tokenizer.encode(self.input2prompt(prompt)))
     
     def inference(self, 
                   inputs,
                   temperature: float=0,
-                  max_tokens: int=256) -> List[Dict[str, str]]:
+                  max_tokens: int=256,
+                  return_token_ids: bool=False,
+                  request_ids: List[str]=None,
+                  priorities: List[int]=None,
+                  n: int=1) -> List[Dict[str, Any]]:
         """
         inputs: List of input with prompt formats.
         return: [{'prompt': ..., 'generated_text': ...}, {'prompt': ..., 'generated_text': ...}, ...]
+        return_token_ids: also return 'prompt_token_ids' and 'token_ids' of each response.
+        request_ids: ids attached to responses as 'request_id', used by modules to route responses.
+        priorities: priority of each input, lower first. Inputs are submitted in priority order,
+        so the engine schedules them first; responses keep the order of inputs.
+        n: samples per input, sharing the prefill of the prompt. With n > 1 responses also hold
+        'generated_texts' (and 'samples_token_ids' with return_token_ids) of every sample.
         """
         
         self.sampling_params = SamplingParams(
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            n=n
         )
 
         step_timer = time.time()
 
-        inference_inputs_str = [self.input2prompt(_input) for _input in inputs]
+        if len(inputs) == 0:
+            return []
 
-        # VLLM generate
-        outputs = self.model.generate(
-            prompts=inference_inputs_str,
-            sampling_params=self.sampling_params,
-            use_tqdm=False,
-        )
+        order = None
+        if priorities is not None:
+            order = sorted(range(len(inputs)), key=priorities.__getitem__) # stable within a priority
+            inputs = [inputs[idx] for idx in order]
+            request_ids = None if request_ids is None else [request_ids[idx] for idx in order]
+            priorities = [priorities[idx] for idx in order]
+        priority_kwargs = {'priority': priorities} if priorities is not None and self.scheduling_policy == 'priority' else {}
+
+        if len(inputs) > 0 and all(isinstance(_input, TokenizedPrompt) for _input in inputs):
+            inference_inputs_str = [_input.prompt for _input in inputs]
+            inference_inputs_ids = [_input.prompt_token_ids for _input in inputs]
+
+            # VLLM generate from token ids
+            outputs = self.model.generate(
+                prompt_token_ids=inference_inputs_ids,
+                sampling_params=self.sampling_params,
+                use_tqdm=False,
+                **priority_kwargs
+            )
+        else:
+            inference_inputs_str = [_input.prompt if isinstance(_input, TokenizedPrompt) else self.input2prompt(_input) 
+                                    for _input in inputs]
+            inference_inputs_ids = None
+
+            # VLLM generate
+            outputs = self.model.generate(
+                prompts=inference_inputs_str,
+                sampling_params=self.sampling_params,
+                use_tqdm=False,
+                **priority_kwargs
+            )
 
         # parse response
         responses = []
-        for prompt, output in zip(inference_inputs_str, outputs):
-            if prompt == output.prompt:
-                responses.append(
-                    {
-                        'prompt': prompt,
-                        'generated_text': output.outputs[0].text
-                    }
-                )
+        for idx, (prompt, output) in enumerate(zip(inference_inputs_str, outputs)):
+            if inference_inputs_ids is not None:
+                aligned = list(output.prompt_token_ids) == inference_inputs_ids[idx]
+            else:
+                aligned = prompt == output.prompt
+
+            if aligned:
+                response = {
+                    'prompt': prompt,
+                    'generated_text': output.outputs[0].text
+                }
+                if request_ids is not None:
+                    response['request_id'] = request_ids[idx]
+                if n > 1:
+                    response['generated_texts'] = [sample.text for sample in output.outputs]
+                if return_token_ids is True:
+                    response['prompt_token_ids'] = list(output.prompt_token_ids)
+                    response['token_ids'] = list(output.outputs[0].token_ids)
+                    if n > 1:
+                        response['samples_token_ids'] = [list(sample.token_ids) for sample in output.outputs]
+                responses.append(response)
             else:
                 raise ValueError("Can't align input prompt")
+
+        if order is not None: # back to the order of inputs
+            restored = [None] * len(responses)
+            for position, idx in enumerate(order):
+                restored[idx] = responses[position]
+            responses = restored
     
         print(f"[INFO] Generating {len(inference_inputs_str)} samples finished. Time passed {(time.time() - step_timer)/60} mins.")
 
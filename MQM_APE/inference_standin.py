@@ -0,0 +1,279 @@
+"""
+Stand-in inference backend: deterministic responses without loading a model.
+
+Responses follow the format each module parses, derived from the prompt alone:
+    evaluator: errors on the longest / last word of longer translations, no-error otherwise;
+        packed prompts are answered with one "Segment N:" section per translation. Sampled
+        answers (n > 1, temperature > 0) vary: some drop the minor error or demote the major one.
+    APE: the translation with the error span removed.
+    verifier: the same pick for both orders of a pair, so verifying twice is consistent;
+        listwise judgments agree with the pairwise picks.
+With malformed_rate > 0, a share of prompts is answered in a format the module can not parse,
+unless the prompt carries a retry reminder.
+An optional latency model (per batch, per prompt token, per decoding step) stands in for GPU time.
+With `gpu_memory_gb` set, the engine profile (tp, gpu_memory_utilization, max_num_seqs,
+max_num_batched_tokens, swap_space) is simulated as well: weights and activations must fit the
+GPU memory, the rest of the memory fraction holds the KV cache, sequences are scheduled in waves
+bounded by max_num_seqs and the KV cache, prompts are prefilled in chunks of
+max_num_batched_tokens, and KV cache overflow is swapped (within swap_space) or recomputed.
+"""
+
+import re
+import time
+import zlib
+from typing import Any, Dict, List
+
+from speculative import DEFAULT_SPECULATIVE
+from utils import apply_template
+
+
+class StandinTokenizer():
+    """word / punctuation / whitespace tokenizer with a vocabulary grown on the fly."""
+
+    def __init__(self) -> None:
+        self.vocab = {}
+        self.bos_token_id = self.vocab.setdefault('<s>', 0)
+
+    def encode(self, text: str, add_special_tokens: bool=True) -> List[int]:
+        ids = [self.vocab.setdefault(token, len(self.vocab)) for token in re.findall(r'\w+|[^\w\s]|\s+', text)]
+        return [self.bos_token_id] + ids if add_special_tokens is True else ids
+
+    def apply_chat_template(self, sample: List[Dict[str, str]], tokenize: bool=False, add_generation_prompt: bool=True) -> str:
+        prompt = ''.join(f"<|{turn['role']}|>\n{turn['content']}\n" for turn in sample)
+        return prompt + '<|assistant|>\n' if add_generation_prompt is True else prompt
+
+
+class StandinInference():
+
+    def __init__(self,
+                 model_path: str=None, # unused, keeps configs of the vllm backend valid
+                 tp: int=1,
+                 compile_templates: bool=False,
+                 speculative: Dict[str, int]=None,
+                 scheduling_policy: str='fcfs', # unused, responses do not depend on scheduling
+                 latency_per_batch: float=0.0, # seconds
+                 latency_per_prompt_token: float=0.0, # seconds of prefill per prompt token
+                 latency_per_step: float=0.0, # seconds per decoding step of the batch
+                 gpu_memory_utilization: float=0.8,
+                 max_num_seqs: int=256,
+                 max_num_batched_tokens: int=None, # None for unchunked prefill
+                 swap_space: float=4, # GiB of CPU swap per GPU
+                 gpu_memory_gb: float=None, # memory of one GPU, None to simulate no engine profile
+                 num_gpus: int=8, # GPUs available for tensor parallelism
+                 model_memory_gb: float=0.0, # weights, split over tp GPUs
+                 kv_cache_mb_per_token: float=0.0, # KV cache of one token over all layers, split over tp GPUs
+                 activation_mb_per_token: float=0.0, # peak activations per batched token, split over tp GPUs
+                 latency_allreduce: float=0.0, # seconds per forward pass and additional GPU
+                 latency_swap_per_token: float=0.0, # seconds to swap the KV cache of one token out and in
+                 malformed_rate: float=0.0, # share of prompts answered in a broken format, unless re-queried with a reminder
+                 max_model_len: int=None, # context length, longer prompts are rejected; None for no limit
+                 ) -> None:
+
+        self.model_path = model_path
+        self.tokenizer = StandinTokenizer()
+        self.compile_templates = False # templates are formatted, the stand-in has no chat template cache
+        self.speculative = {**DEFAULT_SPECULATIVE, **speculative} if speculative else None
+        self.latency_per_batch = latency_per_batch
+        self.latency_per_prompt_token = latency_per_prompt_token
+        self.latency_per_step = latency_per_step
+
+        self.tp = tp
+        self.gpu_memory_utilization = gpu_memory_utilization
+        self.max_num_seqs = max_num_seqs
+        self.max_num_batched_tokens = max_num_batched_tokens
+        self.swap_space = swap_space
+        self.gpu_memory_gb = gpu_memory_gb
+        self.num_gpus = num_gpus
+        self.model_memory_gb = model_memory_gb
+        self.kv_cache_mb_per_token = kv_cache_mb_per_token
+        self.activation_mb_per_token = activation_mb_per_token
+        self.latency_allreduce = latency_allreduce
+        self.latency_swap_per_token = latency_swap_per_token
+        self.kv_cache_tokens = self.simulated_kv_cache() if gpu_memory_gb is not None else None
+        self.malformed_rate = malformed_rate
+        self.max_model_len = max_model_len
+
+
+    def simulated_kv_cache(self) -> int:
+        """KV cache tokens of the simulated engine profile, raising like an engine that fails to load."""
+        if self.tp > self.num_gpus:
+            raise ValueError(f"tp {self.tp} exceeds the {self.num_gpus} available GPUs.")
+        if not 0 < self.gpu_memory_utilization <= 1:
+            raise ValueError(f"gpu_memory_utilization {self.gpu_memory_utilization} must be in (0, 1].")
+
+        batched_tokens = self.max_num_batched_tokens or 0
+        activation_gb = self.activation_mb_per_token * batched_tokens / 1024 / self.tp
+        if activation_gb > self.gpu_memory_gb * (1 - self.gpu_memory_utilization):
+            raise RuntimeError(f"CUDA out of memory: {activation_gb:.1f} GiB of activations for "
+                               f"{batched_tokens} batched tokens exceed the memory left by gpu_memory_utilization.")
+
+        free_gb = self.gpu_memory_gb * self.gpu_memory_utilization - self.model_memory_gb / self.tp
+        kv_cache_tokens = int(free_gb * 1024 * self.tp / self.kv_cache_mb_per_token) if self.kv_cache_mb_per_token > 0 else 1 << 30
+        if kv_cache_tokens <= 0:
+            raise ValueError("No available memory for the cache blocks. Try increasing gpu_memory_utilization or tp.")
+        return kv_cache_tokens
+
+
+    def simulated_seconds(self, sequences: List[List[int]]) -> float:
+        """
+        GPU time of a generate call on the simulated engine profile.
+        sequences: (prompt tokens, generated tokens) of each sequence, in order; samples of a prompt
+        after the first share its prefill and KV cache, with 0 prompt tokens.
+        """
+        forward = self.latency_per_batch + self.latency_allreduce * (self.tp - 1)
+        swap_tokens = self.swap_space * 1024 * self.tp / self.kv_cache_mb_per_token if self.kv_cache_mb_per_token > 0 else 0
+        seconds, begin = 0.0, 0
+        while begin < len(sequences):
+            # admit sequences while their prompts fit the KV cache
+            end, wave_prompt = begin, 0
+            while end < len(sequences) and end - begin < self.max_num_seqs \
+                    and (end == begin or wave_prompt + sequences[end][0] <= self.kv_cache_tokens):
+                wave_prompt += sequences[end][0]
+                end += 1
+            wave = sequences[begin:end]
+            begin = end
+
+            chunk = self.max_num_batched_tokens or wave_prompt
+            seconds += -(-wave_prompt // chunk) * forward + self.latency_per_prompt_token * wave_prompt / self.tp
+            seconds += max(generated for _, generated in wave) * (forward + self.latency_per_step / self.tp)
+
+            # generated tokens that outgrow the KV cache are preempted
+            overflow = max(0, sum(prompt + generated for prompt, generated in wave) - self.kv_cache_tokens)
+            if overflow <= swap_tokens:
+                seconds += overflow * self.latency_swap_per_token
+            else: # recompute
+                seconds += overflow * self.latency_per_prompt_token / self.tp + -(-overflow // chunk) * forward
+
+        return seconds
+
+
+    def input2prompt(self, sample) -> str:
+        if isinstance(sample, str):
+            return sample
+        return self.tokenizer.apply_chat_template(sample, tokenize=False, add_generation_prompt=True)
+
+
+    def build_prompts(self, template, inputs) -> List[Any]:
+        return [apply_template(template, _input) for _input in inputs]
+
+
+    def pick(self, trans_a: str, trans_b: str) -> str:
+        """the better of two translations, independent of their order."""
+        return min(trans_a, trans_b, key=lambda text: (zlib.crc32(text.encode('utf-8')), text))
+
+
+    def annotate(self, target: str, sample: int=0) -> str:
+        """GEMBA-MQM answer for one translation, varied for samples other than 0."""
+        words = target.split()
+        major = f'accuracy/mistranslation - "{max(words, key=len)}"' if len(words) >= 12 else 'no-error'
+        minor = f'style/awkward - "{words[-1]}"' if len(words) >= 4 else 'no-error'
+        if sample % 3 == 2: # misses the minor error
+            minor = 'no-error'
+        if sample % 4 == 3 and major != 'no-error': # rates the major error minor
+            major, minor = 'no-error', major if minor == 'no-error' else f"{major}\n{minor}"
+        return f"Critical:\nno-error\nMajor:\n{major}\nMinor:\n{minor}\n"
+
+
+    def num_tokens(self, prompt) -> int:
+        """tokens of a built prompt."""
+        return len(self.tokenizer.encode(self.input2prompt(prompt)))
+
+
+    def respond_malformed(self, content: str) -> str:
+        """a response the module of the prompt can not parse."""
+        if 'post-edit the translation' in content:
+            return 'Corrected Translation:'
+        if 'identify error types' in content:
+            return 'The translation reads fluently overall.'
+        return 'Hard to say.'
+
+
+    def respond(self, sample, index: int=0) -> str:
+        """response to one input, from the content of its last turn. index: sample of the input."""
+        content = sample if isinstance(sample, str) else sample[-1]['content']
+
+        if zlib.crc32(content.encode('utf-8')) % 1000 < self.malformed_rate * 1000 and 'Reminder:' not in content:
+            return self.respond_malformed(content)
+
+        if 'Which translation is better' in content:
+            trans_a = re.search(r'translation A: "(.*)"\n', content).group(1)
+            trans_b = re.search(r'translation B: "(.*)"\n', content).group(1)
+            return 'A' if self.pick(trans_a, trans_b) == trans_a else 'B'
+
+        if 'better or worse than the original' in content:
+            target = re.search(r'original translation: "(.*)"\n', content).group(1)
+            candidates = re.findall(r'^(\d+)\. "(.*)"$', content, flags=re.M)
+            return '\n'.join(f"{position}: {'better' if self.pick(target, candidate) == candidate else 'worse'}"
+                             for position, candidate in candidates)
+
+        if 'post-edit the translation' in content:
+            target = re.search(r'translation: "(.*)"\nPlease post-edit', content).group(1)
+            span = re.search(r'identified error: "(.*) - (.*)"\.', content).group(2)
+            post_edit = ' '.join(target.replace(span, '', 1).split()) if span != '' else target
+            return f"Corrected Translation: {post_edit or target}"
+
+        if 'identify error types' in content and 'Segment 1:' in content:
+            targets = re.findall(r'translation:\n```(.*?)```', content, flags=re.S)
+            return ''.join(f"Segment {idx + 1}:\n{self.annotate(target, index)}" for idx, target in enumerate(targets))
+
+        if 'identify error types' in content:
+            return self.annotate(re.findall(r'translation:\n```(.*?)```', content, flags=re.S)[-1], index)
+
+        return ''
+
+
+    def inference(self,
+                  inputs,
+                  temperature: float=0,
+                  max_tokens: int=256,
+                  return_token_ids: bool=False,
+                  request_ids: List[str]=None,
+                  priorities: List[int]=None,
+                  n: int=1) -> List[Dict[str, Any]]:
+        """same interface as inference.Inference.inference. priorities are accepted and ignored."""
+
+        step_timer = time.time()
+        inputs = list(inputs)
+
+        responses = []
+        for idx, _input in enumerate(inputs):
+            prompt = self.input2prompt(_input)
+            if self.max_model_len is not None and len(self.tokenizer.encode(prompt)) > self.max_model_len:
+                raise ValueError(f"The prompt (length {len(self.tokenizer.encode(prompt))}) is longer than "
+                                 f"the maximum model length of {self.max_model_len}.")
+            generated_texts = [self.respond(_input, index if temperature > 0 else 0) for index in range(n)]
+            response = {
+                'prompt': prompt,
+                'generated_text': generated_texts[0]
+            }
+            if n > 1:
+                response['generated_texts'] = generated_texts
+            if request_ids is not None:
+                response['request_id'] = request_ids[idx]
+            if return_token_ids is True or self.latency_per_prompt_token > 0 or self.latency_per_step > 0 or self.gpu_memory_gb is not None:
+                response['prompt_token_ids'] = self.tokenizer.encode(prompt)
+                response['token_ids'] = self.tokenizer.encode(generated_texts[0], add_special_tokens=False)[:max_tokens]
+                if n > 1:
+                    response['samples_token_ids'] = [self.tokenizer.encode(text, add_special_tokens=False)[:max_tokens]
+                                                     for text in generated_texts]
+            responses.append(response)
+
+        # simulated GPU time
+        if len(responses) > 0 and self.gpu_memory_gb is not None:
+            time.sleep(self.simulated_seconds([(len(response['prompt_token_ids']) if sample == 0 else 0, len(token_ids))
+                                               for response in responses
+                                               for sample, token_ids in enumerate(response.get('samples_token_ids', [response['token_ids']]))]))
+        elif len(responses) > 0:
+            prompt_tokens = sum(len(response.get('prompt_token_ids', [])) for response in responses)
+            decode_steps = max(max(map(len, response.get('samples_token_ids', [response.get('token_ids', [])]))) for response in responses)
+            time.sleep(self.latency_per_batch + self.latency_per_prompt_token * prompt_tokens + self.latency_per_step * decode_steps)
+
+        if return_token_ids is False:
+            for response in responses:
+                response.pop('prompt_token_ids', None)
+                response.pop('token_ids', None)
+                response.pop('samples_token_ids', None)
+
+        print(f"[INFO] Generating {len(inputs)} samples finished. Time passed {(time.time() - step_timer)/60} mins.")
+
+        return responses
@@ -1,117 +1,382 @@
 import argparse
+import hashlib
+import json
 import os
 import os.path as osp
-from typing import Dict, Any, Literal, List, Tuple
+from typing import Dict, Any, Iterable, Literal, List, Tuple
 
-from inference import Inference
+from engines import EnginePool
+from manifest import load_manifest, run_manifest
 from module_evaluator import Error_Analysis_Evaluator
 from module_ape import Automatic_Post_Editor
+from records import Corpus, SEVERITIES, segment_request_id
 from scorer import Scorer
 from utils import (
     save_json, 
     load_yaml, 
     readlines_txt, 
+    read_json,
+    read_jsonl,
     save_txt
 )
 
+STAGES = ('evaluator', 'ape', 'verifier')
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, required=True, help="Path of configuration yaml.")
-    parser.add_argument("--src", type=str, required=True, help="Path of src.")
-    parser.add_argument("--tgt", type=str, required=True, help="Path of tgt.")
-    parser.add_argument("--srclang", type=str, required=True, help="Source Language, such as English, German, Chinese.")
-    parser.add_argument("--tgtlang", type=str, required=True, help="Target Language, such as English, German, Chinese.")
-    parser.add_argument("--out", type=str, required=True, help="Save directory.")
+    parser.add_argument("--src", type=str, default=None, help="Path of src.")
+    parser.add_argument("--tgt", type=str, default=None, help="Path of tgt.")
+    parser.add_argument("--srclang", type=str, default=None, help="Source Language, such as English, German, Chinese.")
+    parser.add_argument("--tgtlang", type=str, default=None, help="Target Language, such as English, German, Chinese.")
+    parser.add_argument("--out", type=str, required=True, help="Save directory, or root of metric-scores with --manifest.")
+    parser.add_argument("--manifest", type=str, default=None, help="YAML/JSONL list of (system, lp, src, tgt) jobs run with one loaded engine.")
+    parser.add_argument("--metric_name", type=str, default=None, help="Metric name of score files in manifest mode.")
     
     parser.add_argument("--metric_verifier", action="store_true", default=False, help="Whether to replace verifier with cometkiwi.")
     parser.add_argument("--save_llm_response", action="store_true", default=False, help="Whether to save response of llm.")
+    parser.add_argument("--resume", action="store_true", default=False, help="Whether to reuse llm responses saved in the save directory and only query missing requests.")
+    parser.add_argument("--lazy_verify", action="store_true", default=False, help="Whether to post-edit and verify errors by severity, skipping errors once the score is clamped.")
 
     args = parser.parse_args()
+    if args.manifest is None and None in (args.src, args.tgt, args.srclang, args.tgtlang):
+        parser.error("--src, --tgt, --srclang and --tgtlang are required without --manifest.")
     return args
 
 
+def module_configs(config: Dict[str, Any], *keys: str) -> Dict[str, Any]:
+    """module arguments of a config section, without keys handled by MQM_APE."""
+    return {key: value for key, value in config.items() if key not in keys}
+
+
+def run_fingerprint(configs: Dict[str, Any], corpus: Corpus, verifier_type: str, lazy_verify: bool) -> Dict[str, str]:
+    """hashes of what saved responses depend on: the config (triage included), the inputs, and the pipeline flags."""
+    digest = lambda data: hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+    return {
+        'config': digest(configs),
+        'inputs': digest([corpus.segment_fields(seg_id) for seg_id in range(len(corpus.segments))]),
+        'pipeline': digest({'verifier_type': verifier_type, 'lazy_verify': lazy_verify}),
+    }
+
+
 class MQM_APE():
     
     def __init__(self,
                  configs: Dict[Any, Any],
                  verifier_type: Literal['metric', 'llm']='llm',
+                 lazy_verify: bool=False, # skip APE and verifier once the score can not change
                  ):
         
+        self.configs = configs
         self.verifer_type = verifier_type
-        self.inference = Inference(**configs['inference'])
-        self.evaluator_module = Error_Analysis_Evaluator(self.inference, **configs['evaluator'])
-        self.ape_module = Automatic_Post_Editor(self.inference, **configs['ape'])
+        self.lazy_verify = lazy_verify
+        self.engines = EnginePool(configs) # each stage may route to its own engine with `engine: <name>`
+        self.evaluator_module = Error_Analysis_Evaluator(self.engines.stage('evaluator', configs['evaluator'].get('engine')),
+                                                         **module_configs(configs['evaluator'], 'engine'))
+        self.ape_module = Automatic_Post_Editor(self.engines.stage('ape', configs['ape'].get('engine')),
+                                                **module_configs(configs['ape'], 'engine'))
         self.scorer = Scorer(scorer_type='MQM-APE')
 
         if verifier_type == 'llm': # init different verifier for llm or metrics
-            from module_verifier import Pairwise_Quality_Verifier
-            self.verifier_module = Pairwise_Quality_Verifier(self.inference, **configs['verifier'])
+            verifier_inference = self.engines.stage('verifier', configs['verifier'].get('engine'))
+            verifier_configs = module_configs(configs['verifier'], 'engine', 'listwise')
+            if configs['verifier'].get('listwise', False) is True: # all post-edits of a segment in one prompt
+                from module_verifier_listwise import Listwise_Quality_Verifier
+                self.verifier_module = Listwise_Quality_Verifier(verifier_inference, **verifier_configs)
+            else:
+                from module_verifier import Pairwise_Quality_Verifier
+                self.verifier_module = Pairwise_Quality_Verifier(verifier_inference, **verifier_configs)
         else:
             from module_verifier_metric import Pairwise_Quality_Verifier_Metric
             self.verifier_module = Pairwise_Quality_Verifier_Metric(**configs['verifier'])
 
+        self.triage_module = None
+        if configs.get('triage'): # only the uncertain middle band of QE scores goes through the LLM pipeline
+            from module_triage import QE_Triage
+            metric_scorer = None
+            if verifier_type == 'metric' and all(configs['triage'].get(key) == configs['verifier'].get(key)
+                                                 for key in ('metric_path', 'runtime', 'num_threads')):
+                metric_scorer = self.verifier_module.metric_scorer # one loaded COMETKiwi for triage and verifier
+            self.triage_module = QE_Triage(**configs['triage'], metric_scorer=metric_scorer)
+
 
     def eval(self, 
              srcs: List[str], 
              tgts: List[str], 
              src_lang: str, 
              tgt_lang: str,
-             save_llm_response_dir: str=None
+             save_llm_response_dir: str=None,
+             resume_dir: str=None
              ) -> Tuple[Dict[str, Any], List[float]]:
         
+        corpus = Corpus.from_texts(srcs, tgts, src_lang, tgt_lang)
+        self.eval_records(corpus, save_llm_response_dir, self.load_responses(resume_dir))
+
+        # score and serialize results
+        scores = self.scorer.score_corpus(corpus)
+        results = corpus.to_results(scores)
+        scores = [str(_score)+'\n' for _score in scores]
+        
+        return results, scores
+
+
+    def load_responses(self, resume_dir: str=None) -> Dict[str, List[Dict[str, str]]]:
+        """
+        load llm responses saved by an earlier run, keyed by module: those of finished stages, then
+        those appended per call by an interrupted stage. The fingerprint of the run is under 'fingerprint'.
+        """
+        completed = {}
+        if resume_dir is None:
+            return completed
+
+        for module in STAGES:
+            for path, read in ((osp.join(resume_dir, f"llm_responses_{module}.json"), read_json),
+                               (osp.join(resume_dir, f"llm_responses_{module}.jsonl"), read_jsonl)):
+                if osp.exists(path):
+                    responses = read(path)
+                    completed[module] = completed.get(module, []) + responses
+                    print(f"[INFO] Resume {len(responses)} {module} responses from {path}.")
+
+        path = osp.join(resume_dir, "triage_scores.json")
+        if osp.exists(path):
+            completed['triage'] = read_json(path)
+            print(f"[INFO] Resume {len(completed['triage'])} triage scores from {path}.")
+
+        path = osp.join(resume_dir, "run_fingerprint.json")
+        if osp.exists(path):
+            completed['fingerprint'] = read_json(path)
+        return completed
+
+
+    def check_fingerprint(self, corpus: Corpus, completed: Dict[str, Any]) -> Dict[str, str]:
+        """
+        refuse to resume responses of a run with another config, inputs or pipeline flags, whose
+        request ids would match responses to other prompts. return: fingerprint of this run.
+        """
+        fingerprint = run_fingerprint(self.configs, corpus, self.verifer_type, self.lazy_verify)
+        saved = completed.get('fingerprint')
+        if saved is not None:
+            changed = [key for key in fingerprint if saved.get(key) != fingerprint[key]]
+            if len(changed) > 0:
+                raise ValueError(f"Saved responses were made with another {', '.join(changed)}; "
+                                 f"run without --resume or with another --out.")
+        elif any(len(completed.get(key, [])) > 0 for key in (*STAGES, 'triage')):
+            print("[WARNING] Saved responses have no run_fingerprint.json, they are resumed unchecked.")
+        return fingerprint
+
+
+    def start_journals(self, save_llm_response_dir: str, resume: bool) -> None:
+        """append the responses of each engine call to llm_responses_<stage>.jsonl, emptied unless resuming."""
+        for stage, handle in self.engines.stages.items():
+            handle.journal = osp.join(save_llm_response_dir, f"llm_responses_{stage}.jsonl")
+            if resume is False and osp.exists(handle.journal):
+                os.remove(handle.journal)
+
+
+    def close_journals(self, *stages: str) -> None:
+        """drop the journals of stages (all by default) once their responses are saved."""
+        for stage, handle in self.engines.stages.items():
+            if len(stages) > 0 and stage not in stages:
+                continue
+            if handle.journal is not None and osp.exists(handle.journal):
+                os.remove(handle.journal)
+            handle.journal = None
+
+
+    def eval_records(self,
+                     corpus: Corpus,
+                     save_llm_response_dir: str=None,
+                     completed: Dict[str, List[Dict[str, str]]]=None) -> Corpus:
+        """
+        run evaluator, APE and verifier on the record model, storing errors and verdicts into corpus.
+        completed: earlier responses of each module keyed by 'evaluator', 'ape' and 'verifier',
+        routed back by request_id so that only missing requests are queried, checked against the
+        fingerprint of the run that saved them.
+        With a triage stage, the LLM stages run on the segments of the middle band only.
+        """
+        completed = completed or {}
+        seg_ids = range(len(corpus.segments))
+
+        if len(completed) > 0 or save_llm_response_dir is not None:
+            fingerprint = self.check_fingerprint(corpus, completed)
+        if save_llm_response_dir is not None:
+            save_json(fingerprint, osp.join(save_llm_response_dir, "run_fingerprint.json"))
+            self.start_journals(save_llm_response_dir, resume=len(completed) > 0)
+
+        # QE triage, the tails get their default outcome
+        if self.triage_module is not None:
+            costs_before = self.engines.cost_report()
+            seg_ids = self.triage_module.pipeline_records(corpus, completed.get('triage'))
+
         # identify errors
-        inputs, outputs, errors, messages = self.evaluator_module.pipeline(srcs, tgts, src_lang, tgt_lang)
+        outputs, messages = self.evaluator_module.pipeline_records(corpus, completed.get('evaluator'), seg_ids)
 
         if save_llm_response_dir is not None:
             save_json(outputs, osp.join(save_llm_response_dir, "llm_responses_evaluator.json"))
             save_txt(messages, osp.join(save_llm_response_dir, "llm_evaluator_omitted_messages.json"))
+            self.close_journals('evaluator')
+
+        if self.lazy_verify is True:
+            outputs_ape, outputs_verifier = self.lazy_ape_verify(corpus, completed, seg_ids)
+
+        else:
+            error_ids = list(corpus.iter_error_ids(seg_ids=seg_ids))
 
-        # post-edit
-        outputs_ape, errors_ape = self.ape_module.pipeline(inputs, errors)
+            # post-edit
+            outputs_ape = self.ape_module.pipeline_records(corpus, error_ids, completed.get('ape'))
+
+            # verifier
+            if self.verifer_type == 'llm':
+                outputs_verifier = self.verifier_module.pipeline_records(corpus, error_ids, completed.get('verifier'))
+            else:
+                outputs_verifier = []
+                self.verifier_module.pipeline_records(corpus, error_ids, seg_ids=seg_ids)
 
         if save_llm_response_dir is not None:
             save_json(outputs_ape, osp.join(save_llm_response_dir, "llm_responses_ape.json"))
-
-        # verifier
-        if self.verifer_type == 'llm':
-            outputs_verifier, errors_w_scores = self.verifier_module.pipeline(sample_inputs=inputs, errors_ape=errors_ape)
-            
-            if save_llm_response_dir is not None:
+            if self.verifer_type == 'llm':
                 save_json(outputs_verifier, osp.join(save_llm_response_dir, "llm_responses_verifier.json"))
-                
-        else:
-            inputs, errors_w_scores = self.verifier_module.pipeline(sample_inputs=inputs, 
-                                                                    errors_ape=errors_ape)
+            if self.ape_module.speculative is True:
+                save_json(self.ape_module.speculative_stats, osp.join(save_llm_response_dir, "ape_speculative_stats.json"))
 
-        # concatenate results
-        results = [{**_input, 'error_dict': _error} for _input, _error in zip(inputs, errors_w_scores)]
+        stage_costs = self.engines.cost_report()
+        for stage, costs in stage_costs.items():
+            print(f"[INFO] Stage {stage} on engine {costs['engine']}: {costs['requests']} requests, "
+                  f"{costs['prompt_tokens']} prompt / {costs['generated_tokens']} generated tokens, "
+                  f"{costs['gpu_seconds']:.1f} GPU seconds.")
+        if save_llm_response_dir is not None:
+            save_json(stage_costs, osp.join(save_llm_response_dir, "stage_costs.json"))
 
-        # score
-        scores = self.scorer.score_list(errors_w_scores)
-        
-        results = [{**_res, 'MQM_APE_score': _score} for _res, _score in zip(results, scores)]
-        scores = [str(_score)+'\n' for _score in scores]
-        
-        return results, scores
+        retry_stats = {stage: module.retry_stats for stage, module in (('evaluator', self.evaluator_module),
+                                                                        ('ape', self.ape_module),
+                                                                        ('verifier', self.verifier_module))
+                       if hasattr(module, 'retry_stats')}
+        for stage, stats in retry_stats.items():
+            if stats['malformed'] > 0:
+                print(f"[INFO] Stage {stage}: {stats['malformed']} malformed responses, {stats['recovered']} recovered "
+                      f"({stats['recovered'] / stats['malformed']:.0%}) with {stats['requeried']} re-queries.")
+        if save_llm_response_dir is not None:
+            save_json(retry_stats, osp.join(save_llm_response_dir, "retry_stats.json"))
+
+        chunk_stats = {stage: module.chunk_stats for stage, module in (('evaluator', self.evaluator_module),
+                                                                       ('ape', self.ape_module),
+                                                                       ('verifier', self.verifier_module))
+                       if hasattr(module, 'chunk_stats')}
+        if save_llm_response_dir is not None and any(count > 0 for stats in chunk_stats.values() for count in stats.values()):
+            save_json(chunk_stats, osp.join(save_llm_response_dir, "chunk_stats.json"))
+
+        if self.triage_module is not None:
+            self.report_triage(corpus, seg_ids, costs_before, save_llm_response_dir)
+
+        self.close_journals()
+        return corpus
+
+
+    def report_triage(self,
+                      corpus: Corpus,
+                      middle: List[int],
+                      costs_before: Dict[str, Dict[str, Any]],
+                      save_llm_response_dir: str=None) -> None:
+        """
+        print the LLM requests saved by QE triage, and save triage scores (reused on resume, so the
+        same segments are triaged) and savings. Savings of a run that re-ran nothing keep those saved before.
+        """
+        from module_triage import saved_requests
+
+        triage_stats = saved_requests(costs_before, self.engines.cost_report(), len(middle), len(corpus.segments) - len(middle))
+        if triage_stats['saved_requests'] is None and triage_stats['saved_fraction'] is not None:
+            print("[INFO] QE triage saved all LLM requests.")
+        elif triage_stats['saved_fraction'] is not None:
+            print(f"[INFO] QE triage saved an estimated {triage_stats['saved_requests']:.0f} LLM requests "
+                  f"({triage_stats['saved_fraction']:.0%}), {triage_stats['requests']} were made.")
+
+        if save_llm_response_dir is not None:
+            save_json([{'request_id': segment_request_id(seg_id), 'cometkiwi_score': segment.cometkiwi_score, 'triage': segment.triage}
+                       for seg_id, segment in enumerate(corpus.segments)],
+                      osp.join(save_llm_response_dir, "triage_scores.json"))
+            stats_path = osp.join(save_llm_response_dir, "triage_stats.json")
+            if triage_stats['requests'] > 0 or len(middle) == 0 or osp.exists(stats_path) is False:
+                save_json(triage_stats, stats_path)
+
+
+    def lazy_ape_verify(self,
+                        corpus: Corpus,
+                        completed: Dict[str, List[Dict[str, str]]]=None,
+                        seg_ids: Iterable[int]=None
+                        ) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+        """
+        post-edit and verify errors one severity at a time (critical -> major -> minor).
+
+        The MQM-APE score is clamped at -25 and pe_valid_score is never negative, so once the
+        verified errors of a segment reach the clamp its remaining errors can not change the score.
+        Those errors are skipped and marked with `skipped: True` and `pe_valid_score: None`.
+        seg_ids: segments whose errors are post-edited and verified, all by default. With the
+        metric verifier, targets of segments without errors to verify are scored as well, as in
+        the full pipeline.
+        return: APE outputs, verifier outputs (empty for metric verifier).
+        """
+        completed = completed or {}
+        seg_ids = range(len(corpus.segments)) if seg_ids is None else seg_ids
+        outputs_ape, outputs_verifier = [], []
+        num_skipped = 0
+
+        for severity in SEVERITIES:
+            error_ids = []
+            for seg_id in seg_ids:
+                seg_error_ids = list(corpus.iter_error_ids(severity, [seg_id]))
+                if len(seg_error_ids) == 0:
+                    continue
+                if self.scorer.is_segment_clamped(corpus, seg_id):
+                    for error_id in seg_error_ids:
+                        corpus.errors[error_id].skipped = True
+                    num_skipped += len(seg_error_ids)
+                else:
+                    error_ids += seg_error_ids
+
+            if len(error_ids) == 0:
+                continue
+
+            outputs_ape += self.ape_module.pipeline_records(corpus, error_ids, completed.get('ape'))
+
+            if self.verifer_type == 'llm':
+                outputs_verifier += self.verifier_module.pipeline_records(corpus, error_ids, completed.get('verifier'))
+            else:
+                self.verifier_module.pipeline_records(corpus, error_ids)
+
+        if self.verifer_type != 'llm': # targets not scored with errors of any severity
+            self.verifier_module.pipeline_records(corpus, [], seg_ids=seg_ids)
+
+        print(f"[INFO] Lazy verification skipped {num_skipped} errors of clamped segments.")
+
+        return outputs_ape, outputs_verifier
     
     
 if __name__ == "__main__":
     args = parse_args()
     
     configs = load_yaml(args.config)
-    srcs = readlines_txt(args.src)
-    tgts = readlines_txt(args.tgt)
     
     # check dir exist
     if osp.exists(args.out) is False:
         os.makedirs(args.out)
 
-    mqm_ape = MQM_APE(configs, 'llm' if args.metric_verifier is False else 'metric')
+    mqm_ape = MQM_APE(configs, 'llm' if args.metric_verifier is False else 'metric', args.lazy_verify)
     
     save_llm_response_dir = args.out if args.save_llm_response is True else None
     
-    results, scores = mqm_ape.eval(srcs, tgts, args.srclang, args.tgtlang, save_llm_response_dir)
+    resume_dir = args.out if args.resume is True else None
+
+    if args.manifest is not None: # many jobs with one engine
+        jobs, defaults = load_manifest(args.manifest)
+        metric = args.metric_name or defaults.get('metric', 'MQM-APE')
+        run_manifest(mqm_ape, jobs, args.out, metric, save_llm_response_dir, mqm_ape.load_responses(resume_dir))
+
+    else:
+        srcs = readlines_txt(args.src)
+        tgts = readlines_txt(args.tgt)
+    
+        results, scores = mqm_ape.eval(srcs, tgts, args.srclang, args.tgtlang, save_llm_response_dir, resume_dir)
     
-    save_json(results, osp.join(args.out, "results.json"))
-    save_txt(scores, osp.join(args.out, "scores.txt"))
+        save_json(results, osp.join(args.out, "results.json"))
+        save_txt(scores, osp.join(args.out, "scores.txt"))
@@ -0,0 +1,121 @@
+"""
+Multi-corpus manifest mode: run many (system, language pair) jobs against one loaded engine.
+
+A manifest is a YAML file (a list of jobs, or a dict with `jobs` and defaults such as `metric`
+and `testset`) or a JSONL file with one job per line:
+
+    {"system": "JDExploreAcademy", "testset": "wmt22", "lp": "en-de", "src": "...", "tgt": "..."}
+
+Segments of all jobs are merged into one corpus, so every module queries the engine with
+shared large batches. Scores are written per job in the layout of ./results:
+    <out>/<testset>/metric-scores/<lp>/<metric>-src.seg.score   (system \t segment score)
+    <out>/<testset>/metric-scores/<lp>/<metric>-src.sys.score   (system \t mean score)
+"""
+
+import json
+import os
+import os.path as osp
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+from records import PRIORITIES, Corpus
+from utils import load_yaml, readlines_txt, save_json, save_txt
+
+LANG_NAMES = {
+    'en': 'English', 'de': 'German', 'ru': 'Russian', 'zh': 'Chinese', 'cs': 'Czech',
+    'ja': 'Japanese', 'uk': 'Ukrainian', 'hr': 'Croatian', 'hi': 'Hindi', 'gu': 'Gujarati',
+    'mr': 'Marathi', 'ta': 'Tamil', 'ml': 'Malayalam',
+}
+
+
+def load_manifest(path: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    return: jobs and manifest-level defaults.
+    Each job needs system, lp, src and tgt. testset defaults to "default"; srclang / tgtlang
+    default to the language names of the lp codes (e.g. en-de -> English, German); priority
+    is a lane of records.PRIORITIES, "interactive" by default.
+    """
+    if path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            jobs, defaults = [json.loads(line) for line in f if line.strip() != ''], {}
+    else:
+        manifest = load_yaml(path)
+        if isinstance(manifest, list):
+            jobs, defaults = manifest, {}
+        else:
+            jobs, defaults = manifest['jobs'], {key: value for key, value in manifest.items() if key != 'jobs'}
+
+    for job in jobs:
+        for key in 'system', 'lp', 'src', 'tgt':
+            if key not in job:
+                raise ValueError(f"Manifest job {job} misses '{key}'.")
+        job.setdefault('testset', defaults.get('testset', 'default'))
+        job.setdefault('priority', defaults.get('priority', PRIORITIES[0]))
+        if job['priority'] not in PRIORITIES:
+            raise ValueError(f"Manifest job {job} has unknown priority, expected one of {PRIORITIES}.")
+        src_code, tgt_code = job['lp'].split('-')
+        job.setdefault('srclang', LANG_NAMES.get(src_code, src_code))
+        job.setdefault('tgtlang', LANG_NAMES.get(tgt_code, tgt_code))
+
+    return jobs, defaults
+
+
+def build_corpus(jobs: List[Dict[str, Any]]) -> Tuple[Corpus, List[range]]:
+    """merge segments of all jobs into one corpus. return: corpus and the segment range of each job."""
+    corpus, job_ranges = Corpus(), []
+    for job in jobs:
+        srcs = readlines_txt(job['src'])
+        tgts = readlines_txt(job['tgt'])
+        assert len(srcs) == len(tgts), f"length of src and tgt of {job['system']} {job['lp']} should be the same!"
+
+        begin = len(corpus.segments)
+        for src, tgt in zip(srcs, tgts):
+            corpus.add_segment(job['srclang'], src.strip(), job['tgtlang'], tgt.strip(), PRIORITIES.index(job['priority']))
+        job_ranges.append(range(begin, len(corpus.segments)))
+        print(f"[INFO] Job {job['testset']} {job['lp']} {job['system']}: {len(srcs)} segments.")
+
+    return corpus, job_ranges
+
+
+def save_job_scores(jobs: List[Dict[str, Any]],
+                    job_scores: List[List[float]],
+                    out: str,
+                    metric: str) -> None:
+    """write seg/sys score files, one pair per (testset, lp) holding all of its systems."""
+    grouped = defaultdict(list)
+    for job, scores in zip(jobs, job_scores):
+        grouped[(job['testset'], job['lp'])].append((job['system'], scores))
+
+    for (testset, lp), systems in grouped.items():
+        score_dir = osp.join(out, testset, 'metric-scores', lp)
+        if osp.exists(score_dir) is False:
+            os.makedirs(score_dir)
+
+        seg_lines = [f"{system}\t{score}\n" for system, scores in systems for score in scores]
+        sys_lines = [f"{system}\t{sum(scores) / len(scores) if len(scores) > 0 else 0}\n" for system, scores in systems]
+
+        save_txt(seg_lines, osp.join(score_dir, f"{metric}-src.seg.score"))
+        save_txt(sys_lines, osp.join(score_dir, f"{metric}-src.sys.score"))
+
+
+def run_manifest(mqm_ape,
+                 jobs: List[Dict[str, Any]],
+                 out: str,
+                 metric: str,
+                 save_llm_response_dir: str=None,
+                 completed: Dict[str, List[Dict[str, str]]]=None) -> Corpus:
+    """evaluate all jobs in one corpus with a loaded MQM_APE and write per-job outputs."""
+    corpus, job_ranges = build_corpus(jobs)
+    mqm_ape.eval_records(corpus, save_llm_response_dir, completed)
+
+    job_scores = []
+    for job, job_range in zip(jobs, job_ranges):
+        scores = [mqm_ape.scorer.score_segment(corpus, seg_id) for seg_id in job_range]
+        job_scores.append(scores)
+
+        if job.get('results') is not None: # optional results.json of the job
+            save_json(corpus.to_results(scores, job_range), job['results'])
+
+    save_job_scores(jobs, job_scores, out, metric)
+
+    return corpus
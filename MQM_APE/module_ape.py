@@ -1,11 +1,13 @@
 import os.path as osp
-from typing import List, Dict, Tuple
-
-from basemodule import BaseModule
-from inference import Inference
-from prompts.prompts import TEMPLATE_POSTEDIT
+from typing import Any, Iterable, Iterator, List, Dict, Set, Tuple
+
+from basemodule import BaseModule, build_overlap, new_retry_stats
+from chunking import LengthGuard, prompt_budget
+from engines import build_inference
+from prompts.prompts import TEMPLATE_POSTEDIT, TEMPLATE_POSTEDIT_RETRY
+from records import Corpus, index_responses, parse_request_id
+from speculative import DEFAULT_SPECULATIVE, acceptance_report, simulate_prompt_lookup
 from utils import (
-    apply_template, 
     truncate_response, 
     load_yaml,
     read_json,
@@ -16,13 +18,25 @@ from utils import (
 class Automatic_Post_Editor(BaseModule):
 
     def __init__(self, 
-                 inference: Inference,
+                 inference: 'Inference', # inference.Inference or a backend with the same interface
                  max_tokens: int=512,
-                 temperature: float=0):
+                 temperature: float=0,
+                 speculative: bool=False, # report prompt-lookup draft acceptance of post-edits
+                 retries: int=0, # rounds re-querying empty post-edits with a format reminder
+                 max_prompt_tokens: int=None, # prompt budget, max_model_len of the engine minus max_tokens by default
+                 overlap: Dict[str, Any]=None): # batches built while others generate, see overlap.OverlapRunner
         
         self.inference = inference
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.speculative = speculative
+        self.speculative_totals = {} # replay counts per language pair, accumulated over pipeline calls
+        self.speculative_stats = {}
+        self.retries = retries
+        self.retry_stats = new_retry_stats()
+        self.max_prompt_tokens = max_prompt_tokens
+        self.chunk_stats = {'errors': 0, 'segments': 0, 'unsplit': 0, 'over_budget': 0}
+        self.overlap = build_overlap(overlap)
 
 
     def pipeline(self,
@@ -31,82 +45,183 @@ class Automatic_Post_Editor(BaseModule):
                  ) -> Tuple[List[Dict[str, str]], List[Dict[str, Dict[str, str]]]]:
         
         """pipeline of ape."""
-        inputs_ape = self.preprocess(sample_inputs=sample_inputs, errors=errors)
-        outputs_ape = self.query(inputs_ape)
-        errors_ape = self.postprocess(errors=errors, outputs=outputs_ape)
+        corpus = Corpus.from_dicts(sample_inputs, errors)
+        outputs_ape = self.pipeline_records(corpus, range(len(corpus.errors)))
+        errors_ape = [corpus.error_dict(seg_id) for seg_id in range(len(corpus.segments))]
 
         return outputs_ape, errors_ape
 
 
-    def preprocess(self, 
-                   sample_inputs: List[Dict[str, str]],
-                   errors: List[Dict[str, Dict[str, str]]]) -> List[Dict[str, str]]:
+    def pipeline_records(self,
+                         corpus: Corpus,
+                         error_ids: Iterable[int],
+                         completed: List[Dict[str, str]]=None) -> List[Dict[str, str]]:
         
-        """return inputs dict with errors"""
+        """
+        pipeline of ape on the record model. Post-edits are stored into corpus.
+        completed: earlier responses carrying request_id (e.g. saved llm_responses_ape.json);
+        only errors without a completed response are queried.
+        Errors of segments whose prompt is over the token budget are post-edited in the sentence
+        chunk holding their span, and the post-edited chunk is stitched back into the target.
+        Errors whose chunk is still over budget are not post-edited, and their segments are
+        marked over_budget.
+        return: responses of error_ids in request order.
+        """
+        responses = index_responses(completed or [])
+        chunks, over_ids = self.chunk_errors(corpus, list(error_ids))
+        error_ids = [error_id for error_id in error_ids if error_id not in over_ids]
+        pending_ids = [error_id for error_id in error_ids if corpus.request_id(error_id) not in responses]
+
+        inputs_ape = self.preprocess(corpus=corpus, error_ids=pending_ids, chunks=chunks)
+        request_ids = [corpus.request_id(error_id) for error_id in pending_ids]
+        outputs_ape = self.query(inputs_ape, request_ids, corpus.request_priorities(request_ids))
+
+        if self.speculative is True:
+            self.speculative_report(corpus, outputs_ape)
+
+        responses.update(index_responses(outputs_ape))
+
+        # re-query empty post-edits
+        rid_errors = {corpus.request_id(error_id): error_id for error_id in error_ids}
+        self.retry_malformed(responses, list(rid_errors), self.malformed,
+                             lambda rids: self.query(self.preprocess(corpus, [rid_errors[rid] for rid in rids], chunks),
+                                                     rids, corpus.request_priorities(rids), retry=True))
+
+        self.postprocess(corpus=corpus, error_ids=error_ids, responses=responses, chunks=chunks)
+
+        return [responses[rid] for rid in map(corpus.request_id, error_ids) if rid in responses]
+
+
+    def chunk_errors(self, corpus: Corpus, error_ids: List[int]) -> Tuple[Dict[int, Tuple[Dict[str, str], Tuple[int, int]]], Set[int]]:
+        """
+        template fields and target offsets of the sentence chunk of each error whose prompt is over
+        the token budget, and the errors whose chunk (or single sentence) is still over budget.
+        """
+        if len(error_ids) == 0:
+            return {}, set()
+        budget = prompt_budget(self.inference, self.max_prompt_tokens, self.max_tokens)
+        if budget is None:
+            return {}, set()
+
+        guard = LengthGuard(self.inference, lambda inputs: self.inference.build_prompts(TEMPLATE_POSTEDIT, inputs), budget)
+        chunks, over_ids, num_unsplit = {}, set(), 0
+        for error_id, over in zip(error_ids, guard.over_budget(corpus.error_fields(error_id) for error_id in error_ids)):
+            if over is False:
+                continue
+            error_chunks, chunks_over = guard.split(corpus.error_fields(error_id), span=corpus.pool[corpus.errors[error_id].span])
+            if len(error_chunks) == 0 or chunks_over[0] is True: # a sentence over budget, not post-edited
+                num_unsplit += len(error_chunks) == 0
+                over_ids.add(error_id)
+                corpus.segments[corpus.errors[error_id].segment].over_budget = True
+                continue
+            chunks[error_id] = error_chunks[0]
+
+        num_segments = len(set(corpus.errors[error_id].segment for error_id in chunks))
+        self.chunk_stats['errors'] += len(chunks)
+        self.chunk_stats['segments'] += num_segments
+        self.chunk_stats['unsplit'] += num_unsplit
+        self.chunk_stats['over_budget'] += len(over_ids)
+        if len(chunks) > 0 or len(over_ids) > 0:
+            print(f"[INFO] APE post-edits {len(chunks)} errors of {num_segments} segments over the budget of {budget} "
+                  f"prompt tokens in sentence chunks, {len(over_ids)} errors in sentences over budget are not post-edited.")
+        return chunks, over_ids
+
 
-        inputs = []
-        for sample_input, error_dict in zip(sample_inputs, errors):
-            for _error in error_dict['critical'] + error_dict['major'] + error_dict['minor']:
-                
-                inputs.append({
-                    'source_lang': sample_input['source_lang'],
-                    'source_seg': sample_input['source_seg'],
-                    'target_lang': sample_input['target_lang'],
-                    'target_seg': sample_input['target_seg'],
-                    'error_category': _error['category'],
-                    'error_content': _error['span']
-                })
+    def preprocess(self, 
+                   corpus: Corpus,
+                   error_ids: List[int],
+                   chunks: Dict[int, Tuple[Dict[str, str], Tuple[int, int]]]=None) -> Iterator[Dict[str, str]]:
+        
+        """return template fields of each error, built on the fly; errors in chunks get the fields of their chunk"""
 
-        return inputs
+        chunks = chunks or {}
+        return (chunks[error_id][0] if error_id in chunks else corpus.error_fields(error_id) for error_id in error_ids)
 
 
     def query(self, 
-              inputs: List[Dict[str, str]]) -> List[Dict[str, str]]:
+              inputs: Iterable[Dict[str, str]],
+              request_ids: List[str]=None,
+              priorities: List[int]=None,
+              retry: bool=False) -> List[Dict[str, str]]:
         
         """
-        inputs: [{'source_lang', 'source_seg', 'target_lang', 'target_seg'}, {...}, ...]
-        return: [{'prompt', 'generated_text'}, {...}, ...]
+        inputs: [{'source_lang', 'source_seg', 'target_lang', 'target_seg', 'error_category', 'error_content'}, {...}, ...]
+        request_ids: ids attached to the responses.
+        priorities: scheduling priority of each input, lower first.
+        retry: re-query of malformed responses, with a format reminder.
+        return: [{'prompt', 'generated_text', 'request_id'}, {...}, ...]
         """
 
         # generate query
-        query_list = [apply_template(TEMPLATE_POSTEDIT, _input) for _input in inputs]
-
-        outputs = self.inference.inference(query_list, 
-                                           self.temperature,
-                                           self.max_tokens)
+        outputs = self.generate(lambda batch: self.inference.build_prompts(TEMPLATE_POSTEDIT_RETRY if retry else TEMPLATE_POSTEDIT, batch),
+                                inputs,
+                                temperature=self.temperature,
+                                max_tokens=self.max_tokens,
+                                return_token_ids=self.speculative and retry is False,
+                                request_ids=request_ids,
+                                priorities=priorities)
         
         return outputs
 
 
-    def postprocess(self, 
-                    errors: List[Dict[str, Dict[str, str]]], 
-                    outputs: List[Dict[str, str]]) -> List[Dict[str, Dict[str, str]]]:
+    def speculative_report(self,
+                           corpus: Corpus,
+                           outputs: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+        """
+        replay prompt-lookup speculative decoding of each post-edit, where the target segment
+        in the prompt serves as the draft, and report acceptance rates per language pair
+        over all post-edits so far. Token ids are dropped from outputs afterwards.
         """
-        extract error spans from generated text.
+        speculative = self.inference.speculative or DEFAULT_SPECULATIVE
 
-        errors: A List of error annotations from Evaluator.
-        outputs: APE outputs list
-        return: A List of error annotations, with APE translation for each error annotation.
+        lang_pairs = [corpus.lang_pair(parse_request_id(_output['request_id'])[0]) for _output in outputs]
+        records = [simulate_prompt_lookup(_output.pop('prompt_token_ids'), _output.pop('token_ids'), **speculative)
+                   for _output in outputs]
+
+        self.speculative_stats = acceptance_report(lang_pairs, records, self.speculative_totals)
+        for lang_pair, lang_stats in self.speculative_stats.items():
+            print(f"[INFO] APE draft acceptance {lang_pair}: {lang_stats['acceptance_rate']:.3f}, "
+                  f"speedup upper bound {lang_stats['speedup']:.2f}x.")
+
+        return self.speculative_stats
+
+
+    def postprocess(self, 
+                    corpus: Corpus,
+                    error_ids: List[int],
+                    responses: Dict[str, Dict[str, str]],
+                    chunks: Dict[int, Tuple[Dict[str, str], Tuple[int, int]]]=None) -> Corpus:
+        """
+        extract post-edited translations from generated text.
+
+        corpus: record model holding error annotations from Evaluator.
+        error_ids: errors to fill in.
+        responses: APE outputs indexed by request_id, which may be partial or in any order.
+        chunks: chunk of errors post-edited in a sentence chunk, whose post-edit replaces the chunk in the target;
+        the chunk is kept in corpus.error_chunks for the verifier.
+        return: corpus, with APE translation for each error that has a response.
         """
-        def list_generator(my_list):
-            for item in my_list:
-                yield item
 
-        # truncate error spans
-        ape_texts = [truncate_response(_output['generated_text'], ['<|eot_id|>', ]) for _output in outputs]
+        chunks = chunks or {}
+        for error_id in error_ids:
+            _output = responses.get(corpus.request_id(error_id))
+            if _output is None: # not completed yet
+                continue
+            ape_text = truncate_response(_output['generated_text'], ['<|eot_id|>', ])
+            post_edit = self.response2ape_translation(ape_text)
+            if error_id in chunks:
+                target = corpus.pool[corpus.segments[corpus.errors[error_id].segment].target_seg]
+                begin, end = chunks[error_id][1]
+                post_edit = target[:begin] + post_edit + target[end:]
+                corpus.error_chunks[error_id] = (chunks[error_id][0]['source_seg'], begin, end)
+            corpus.set_post_edit(error_id, post_edit)
 
-        # extract ape from error_list
-        apes_generator = list_generator(self.response2ape_translation(_text) for _text in ape_texts)
+        return corpus
 
-        # parse post-edited translation to error annotation
-        for error_dict in errors:
-            for severity in 'critical', 'major', 'minor':
-                if len(error_dict[severity]) == 0:
-                        continue                
-                for _error in error_dict[severity]:
-                    _error['post_edit'] = next(apes_generator)
 
-        return errors
+    def malformed(self, _output: Dict[str, str]) -> bool:
+        """the response yields an empty post-edit."""
+        return self.response2ape_translation(truncate_response(_output['generated_text'], ['<|eot_id|>', ])) == ''
 
 
     def response2ape_translation(self, 
@@ -149,8 +264,8 @@ if __name__ == "__main__":
     errors = [_input['error_dict'] for _input in inputs]
 
     # init Inference
-    inference = Inference(**configs['inference'])
-    ape_module = Automatic_Post_Editor(inference=inference, **configs['evaluator'])
+    inference = build_inference(configs['inference'])
+    ape_module = Automatic_Post_Editor(inference=inference, **configs['ape'])
 
     # evaluate samples
     outputs, errors = ape_module.pipeline(inputs, errors)
@@ -1,12 +1,16 @@
 import os.path as osp
 import re
-from typing import List, Dict, Tuple
-
-from basemodule import BaseModule
-from inference import Inference
-from prompts.prompts import TEMPLATE_GEMBA_MQM_FEWSHOT
+from collections import Counter
+from typing import Any, Iterable, List, Dict, Optional, Tuple
+
+from basemodule import BaseModule, build_overlap, new_retry_stats
+from chunking import LengthGuard, prompt_budget
+from engines import build_inference
+from fewshot import FewShotSelector
+from prompts.prompts import TEMPLATE_GEMBA_MQM_FEWSHOT, TEMPLATE_GEMBA_MQM_FEWSHOT_RETRY, TEMPLATE_GEMBA_MQM_PACKED_FEWSHOT
+from prompts.prompt_contexts import GEMBA_MQM_PACKED_SEGMENT_PROMPT, GEMBA_MQM_RETRY_REMINDER
+from records import SEVERITIES, Corpus, chunk_request_id, index_responses, packed_request_id, request_segment, segment_request_id
 from utils import (
-    apply_template,
     save_json,
     save_txt, 
     truncate_response, 
@@ -16,12 +20,31 @@ from utils import (
 
 class Error_Analysis_Evaluator(BaseModule):
     def __init__(self, 
-                 inference: Inference,
+                 inference: 'Inference', # inference.Inference or a backend with the same interface
                  max_tokens: int=512,
-                 temperature: float=0):
+                 temperature: float=0,
+                 pack_size: int=1, # consecutive segments per prompt, 1 for one prompt per segment
+                 fewshot: Dict[str, Any]=None, # few-shot selection per language pair, see fewshot.FewShotSelector
+                 num_samples: int=1, # annotations sampled per prompt, sharing its prefill, merged into one
+                 sample_temperature: float=0.7, # temperature when num_samples > 1
+                 min_agreement: float=0.5, # fraction of samples that must report an error to keep it
+                 retries: int=0, # rounds re-querying malformed annotations with a format reminder
+                 max_prompt_tokens: int=None, # prompt budget, max_model_len of the engine minus max_tokens by default
+                 overlap: Dict[str, Any]=None): # batches built and parsed while others generate, see overlap.OverlapRunner
         self.inference = inference
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.pack_size = pack_size
+        self.fewshot_selector = FewShotSelector(inference, **fewshot) if fewshot else None
+        self.num_samples = num_samples
+        self.sample_temperature = sample_temperature
+        self.min_agreement = min_agreement
+        self.retries = retries
+        self.retry_stats = new_retry_stats()
+        self.max_prompt_tokens = max_prompt_tokens
+        self.chunk_stats = {'segments': 0, 'chunks': 0, 'unsplit': 0, 'over_budget': 0}
+        self.overlap = build_overlap(overlap)
+        self.parsed = {} # annotations parsed during generation, by sample text
 
 
     def pipeline(self, 
@@ -37,10 +60,171 @@ class Error_Analysis_Evaluator(BaseModule):
         inputs = self.preprocess(srcs, tgts, src_lang, tgt_lang)
         outputs = self.query(inputs)
         errors, messages = self.postprocess(outputs)
+        self.parsed.clear()
 
         return inputs, outputs, errors, messages
 
 
+    def pipeline_records(self,
+                         corpus: Corpus,
+                         completed: List[Dict[str, str]]=None,
+                         seg_ids: Iterable[int]=None) -> Tuple[List[Dict[str, str]], List[str]]:
+        """
+        pipeline of evaluator on the record model. Errors are stored into corpus.
+        completed: earlier responses carrying request_id (e.g. saved llm_responses_evaluator.json);
+        only segments without a completed response are queried.
+        seg_ids: segments to annotate, all by default; request ids keep the ids of the corpus.
+        With pack_size > 1, segments are first annotated in packed prompts; segments whose
+        section of the packed answer fails to parse fall back to single-segment prompts.
+        Segments whose prompt is over the token budget are annotated in sentence chunks instead,
+        and the errors of their chunks are merged. Sentences still over budget are not queried,
+        and their segments are marked over_budget.
+        return: packed responses, then single-segment responses in segment order, then chunk
+        responses; messages.
+        """
+        responses = index_responses(completed or [])
+        seg_ids = range(len(corpus.segments)) if seg_ids is None else list(seg_ids)
+
+        # over-budget segments, annotated in sentence chunks
+        chunks = self.chunk_segments(corpus, [seg_id for seg_id in seg_ids if segment_request_id(seg_id) not in responses])
+        chunk_fields = {chunk_request_id(seg_id, idx): fields
+                        for seg_id, seg_chunks in chunks.items() for idx, (fields, _) in enumerate(seg_chunks)}
+
+        # packed prompts
+        sections, packs = {}, []
+        if self.pack_size > 1:
+            skip = set(chunks) | (set(range(len(corpus.segments))) - set(seg_ids)) # chunked and unselected segments
+            packs = [pack for pack in self.packs(corpus, skip=skip) if len(pack) > 1
+                     and any(segment_request_id(seg_id) not in responses for seg_id in pack)]
+            pending_packs = [pack for pack in packs if packed_request_id(pack) not in responses]
+
+            request_ids = [packed_request_id(pack) for pack in pending_packs]
+            outputs = self.query_packed((self.packed_fields(corpus, pack) for pack in pending_packs),
+                                        request_ids,
+                                        corpus.request_priorities(request_ids))
+            responses.update(index_responses(outputs))
+
+            for pack in packs:
+                _output = responses.get(packed_request_id(pack))
+                if _output is None:
+                    continue
+                samples = [self.split_packed(text, len(pack)) for text in self.sample_texts(_output)]
+                for idx, seg_id in enumerate(pack):
+                    seg_sections = [sample[idx] for sample in samples if sample[idx] is not None]
+                    if len(seg_sections) > 0:
+                        sections[seg_id] = seg_sections
+
+            num_packed = sum(len(pack) for pack in packs)
+            print(f"[INFO] Evaluator packed {num_packed} segments into {len(packs)} prompts, "
+                  f"{num_packed - sum(seg_id in sections for pack in packs for seg_id in pack)} fall back to single prompts.")
+
+        # single-segment prompts
+        pending_ids = [seg_id for seg_id in seg_ids
+                       if segment_request_id(seg_id) not in responses and seg_id not in sections and seg_id not in chunks]
+        pending_chunks = [rid for rid in chunk_fields if rid not in responses]
+
+        request_ids = [segment_request_id(seg_id) for seg_id in pending_ids] + pending_chunks
+        outputs = self.query([corpus.segment_fields(seg_id) for seg_id in pending_ids] + [chunk_fields[rid] for rid in pending_chunks],
+                             request_ids,
+                             corpus.request_priorities(request_ids))
+        responses.update(index_responses(outputs))
+
+        # re-query malformed single-segment and chunk annotations
+        self.retry_malformed(responses, [segment_request_id(seg_id) for seg_id in seg_ids
+                                         if seg_id not in sections and seg_id not in chunks] + list(chunk_fields),
+                             self.malformed,
+                             lambda rids: self.query((chunk_fields.get(rid) or corpus.segment_fields(request_segment(rid)) for rid in rids),
+                                                     rids, corpus.request_priorities(rids), retry=True))
+
+        # responses in segment order, segments without a response keep no errors
+        outputs = [responses[rid] for rid in map(segment_request_id, seg_ids) if rid in responses]
+        errors, messages = self.postprocess(outputs)
+
+        for _output, error_dict in zip(outputs, errors):
+            corpus.add_errors(int(_output['request_id']), error_dict)
+
+        for seg_id, seg_sections in sections.items():
+            if segment_request_id(seg_id) not in responses:
+                corpus.add_errors(seg_id, self.merge_samples([self.error_text2dict(section, messages) for section in seg_sections]))
+
+        # errors of the chunks of a segment, stitched in chunk order; spans are substrings of the segment's target
+        chunk_outputs = []
+        for seg_id, seg_chunks in chunks.items():
+            seg_outputs = [responses[rid] for rid in (chunk_request_id(seg_id, idx) for idx in range(len(seg_chunks))) if rid in responses]
+            chunk_errors, chunk_messages = self.postprocess(seg_outputs)
+            messages += chunk_messages
+            corpus.add_errors(seg_id, {severity: [_error for error_dict in chunk_errors for _error in error_dict[severity]]
+                                       for severity in SEVERITIES})
+            chunk_outputs += seg_outputs
+
+        outputs = [responses[rid] for rid in map(packed_request_id, packs) if rid in responses] + outputs + chunk_outputs
+        self.parsed.clear()
+
+        return outputs, messages
+
+
+    def chunk_segments(self, corpus: Corpus, seg_ids: List[int]) -> Dict[int, List[Tuple[Dict[str, str], Tuple[int, int]]]]:
+        """
+        sentence chunks of the segments among seg_ids whose prompt is over the token budget, without
+        the chunks still over budget; a single-sentence segment gets no chunk. Segments losing
+        chunks are marked over_budget.
+        """
+        if len(seg_ids) == 0:
+            return {}
+        budget = prompt_budget(self.inference, self.max_prompt_tokens, self.max_tokens)
+        if budget is None:
+            return {}
+
+        guard = LengthGuard(self.inference, lambda inputs: self.build_prompts(inputs), budget)
+        chunks, num_unsplit, num_over = {}, 0, 0
+        for seg_id, over in zip(seg_ids, guard.over_budget(corpus.segment_fields(seg_id) for seg_id in seg_ids)):
+            if over is False:
+                continue
+            seg_chunks, chunks_over = guard.split(corpus.segment_fields(seg_id))
+            chunks[seg_id] = [chunk for chunk, chunk_over in zip(seg_chunks, chunks_over) if chunk_over is False]
+            if len(seg_chunks) == 0: # a single sentence, not queried
+                num_unsplit += 1
+            if len(seg_chunks) == 0 or any(chunks_over):
+                corpus.segments[seg_id].over_budget = True
+                num_over += 1
+            if len(seg_chunks) > 0:
+                self.chunk_stats['segments'] += 1
+                self.chunk_stats['chunks'] += len(chunks[seg_id])
+
+        self.chunk_stats['unsplit'] += num_unsplit
+        self.chunk_stats['over_budget'] += num_over
+        if len(chunks) > 0:
+            print(f"[INFO] Evaluator split {len(chunks) - num_unsplit} segments over the budget of {budget} prompt tokens into "
+                  f"{sum(map(len, chunks.values()))} sentence chunks; sentences over budget in {num_over} segments are not annotated.")
+        return chunks
+
+
+    def packs(self, corpus: Corpus, skip: Iterable[int]=()) -> List[List[int]]:
+        """consecutive segments of the same language pair and priority, at most pack_size per pack; skip: segments left out."""
+        packs, skip = [], set(skip)
+        for seg_id in range(len(corpus.segments)):
+            if seg_id in skip:
+                continue
+            if len(packs) > 0 and packs[-1][-1] == seg_id - 1 and len(packs[-1]) < self.pack_size \
+                    and corpus.lang_pair(seg_id) == corpus.lang_pair(packs[-1][-1]) \
+                    and corpus.segments[seg_id].priority == corpus.segments[packs[-1][-1]].priority:
+                packs[-1].append(seg_id)
+            else:
+                packs.append([seg_id])
+        return packs
+
+
+    def packed_fields(self, corpus: Corpus, pack: List[int]) -> Dict[str, str]:
+        """template fields of a packed prompt: numbered segments and their count, with the language pair."""
+        return {
+            'source_lang': corpus.pool[corpus.segments[pack[0]].source_lang],
+            'target_lang': corpus.pool[corpus.segments[pack[0]].target_lang],
+            'segments': '\n\n'.join(GEMBA_MQM_PACKED_SEGMENT_PROMPT.format(index=idx + 1, **corpus.segment_fields(seg_id))
+                                     for idx, seg_id in enumerate(pack)),
+            'num_segments': str(len(pack)),
+        }
+
+
     def preprocess(self, 
                    srcs: List[str], 
                    tgts: List[str], 
@@ -61,23 +245,110 @@ class Error_Analysis_Evaluator(BaseModule):
 
 
     def query(self, 
-              inputs: List[Dict[str, str]]) -> List[Dict[str, str]]:
+              inputs: Iterable[Dict[str, str]],
+              request_ids: List[str]=None,
+              priorities: List[int]=None,
+              retry: bool=False) -> List[Dict[str, str]]:
         
         """
         inputs: [{'source_lang', 'source_seg', 'target_lang', 'target_seg'}, {...}, ...]
-        return: [{'prompt', 'generated_text'}, {...}, ...]
+        request_ids: ids attached to the responses.
+        priorities: scheduling priority of each input, lower first.
+        retry: re-query of malformed responses, with a format reminder.
+        return: [{'prompt', 'generated_text', 'request_id'}, {...}, ...]
         """
 
-        # generate query
-        query_list = [apply_template(TEMPLATE_GEMBA_MQM_FEWSHOT, _input) for _input in inputs]
-
-        outputs = self.inference.inference(query_list, 
-                                           self.temperature,
-                                           self.max_tokens)
+        # generate query, annotations are parsed as they come with overlap
+        outputs = self.generate(lambda batch: self.build_prompts(batch, packed=False, retry=retry),
+                                inputs,
+                                parse_annotations,
+                                temperature=self.sample_temperature if self.num_samples > 1 else self.temperature,
+                                max_tokens=self.max_tokens,
+                                request_ids=request_ids,
+                                priorities=priorities,
+                                **self.sampling_kwargs())
         
         return outputs
 
 
+    def build_prompts(self, inputs: Iterable[Dict[str, str]], packed: bool=False, retry: bool=False) -> List[Any]:
+        """prompts with the three GEMBA examples, or with the examples selected for each language pair."""
+        if self.fewshot_selector is None:
+            if packed is True:
+                return self.inference.build_prompts(TEMPLATE_GEMBA_MQM_PACKED_FEWSHOT, inputs)
+            return self.inference.build_prompts(TEMPLATE_GEMBA_MQM_FEWSHOT_RETRY if retry else TEMPLATE_GEMBA_MQM_FEWSHOT, inputs)
+        return self.fewshot_selector.build_prompts(list(inputs), packed, GEMBA_MQM_RETRY_REMINDER if retry else None)
+
+
+    def sampling_kwargs(self) -> Dict[str, int]:
+        """n samples per prompt for ensembles, nothing for a single sample."""
+        return {'n': self.num_samples} if self.num_samples > 1 else {}
+
+
+    def sample_texts(self, _output: Dict[str, Any]) -> List[str]:
+        """truncated texts of every sample of a response."""
+        return sample_texts(_output)
+
+
+    def query_packed(self,
+                     inputs: Iterable[Dict[str, str]],
+                     request_ids: List[str]=None,
+                     priorities: List[int]=None) -> List[Dict[str, str]]:
+
+        """
+        inputs: [{'source_lang', 'target_lang', 'segments', 'num_segments'}, {...}, ...]
+        request_ids: ids attached to the responses.
+        priorities: scheduling priority of each input, lower first.
+        return: [{'prompt', 'generated_text', 'request_id'}, {...}, ...]
+        """
+
+        # generate query, packed answers are split before parsing
+        outputs = self.generate(lambda batch: self.build_prompts(batch, packed=True),
+                                inputs,
+                                temperature=self.sample_temperature if self.num_samples > 1 else self.temperature,
+                                max_tokens=self.max_tokens * self.pack_size,
+                                request_ids=request_ids,
+                                priorities=priorities,
+                                **self.sampling_kwargs())
+
+        return outputs
+
+
+    def split_packed(self, error_text: str, num_segments: int) -> List[Optional[str]]:
+
+        """
+        split a packed answer into the sections of each segment, by lines "Segment N:".
+        return: section text of each segment, None if its section is missing, repeated,
+        holds no severity, or repeats a severity (e.g. absorbing a malformed next section).
+        """
+
+        sections = [[] for _ in range(num_segments)]
+        found = [0] * num_segments
+        current = None
+        for line in error_text.split('\n'):
+            match = re.match(r'^\W*segment\s*(\d+)\b[\s:.)*#-]*(.*)$', line.strip(), flags=re.I)
+            if match:
+                index = int(match.group(1)) - 1
+                current = index if 0 <= index < num_segments else None
+                if current is not None:
+                    found[current] += 1
+                    if match.group(2) != '': # e.g. "Segment 2: no-error"
+                        sections[current].append(match.group(2))
+                continue
+            if current is not None:
+                sections[current].append(line)
+
+        parsed = []
+        for lines, count in zip(sections, found):
+            text = '\n'.join(lines)
+            has_severity = re.search(r'critical|major|minor|no-error|no error', text, flags=re.I) is not None
+            repeats_severity = any(sum(f'{severity}:' in line.lower() for line in lines) > 1
+                                   for severity in ('critical', 'major', 'minor'))
+            parsed.append(text if count == 1 and has_severity and repeats_severity is False else None)
+
+        return parsed
+
+
     def postprocess(self, 
                     outputs: List[Dict[str, str]]) -> Tuple[List[Dict[str, Dict[str, str]]], List[str]]:
         
@@ -87,16 +358,75 @@ class Error_Analysis_Evaluator(BaseModule):
         return: A List of error annotations, and messages about omitted lines.
         """
 
-        # truncate error spans
-        error_texts = [truncate_response(_output['generated_text'], ['<|eot_id|>', ]) for _output in outputs]
+        # truncate error spans of each sample
+        error_texts = [self.sample_texts(_output) for _output in outputs]
 
-        # extract error category and span
+        # extract error category and span, merge samples
         messages = []        
-        error_list = [self.error_text2dict(_text, messages) for _text in error_texts]
+        error_list = [self.merge_samples([self.error_text2dict(_text, messages) for _text in _texts]) for _texts in error_texts]
 
         return error_list, messages
 
 
+    def malformed(self, _output: Dict[str, Any]) -> bool:
+        """no sample of the response parses cleanly: lines are omitted, or no severity is given at all."""
+        for text in self.sample_texts(_output):
+            messages = []
+            self.error_text2dict(text, messages)
+            omitted = [message for message in messages if message[len("This line will omit: "):].strip() != '']
+            if len(omitted) == 0 and re.search(r'critical|major|minor|no-error|no error', text, flags=re.I) is not None:
+                return False
+        return True
+
+
+    def spans_agree(self, span_a: str, span_b: str) -> bool:
+        """normalized spans agree if equal, or if one contains the other and covers half of it."""
+        if span_a == span_b:
+            return True
+        if span_a == '' or span_b == '':
+            return False
+        return (span_a in span_b or span_b in span_a) and min(len(span_a), len(span_b)) / max(len(span_a), len(span_b)) >= 0.5
+
+
+    def merge_samples(self, error_dicts: List[Dict[str, List[Dict[str, str]]]]) -> Dict[str, List[Dict[str, str]]]:
+
+        """
+        merge sampled annotations of a segment into one error_dict.
+
+        Spans are clustered across samples by agreement. A cluster is kept if at least min_agreement
+        of the samples report it, with the majority severity (ties go to the less severe), the
+        majority category and the most frequent span text. Each cluster becomes one error, so a span
+        reported by several samples is post-edited once.
+        """
+
+        if len(error_dicts) == 1:
+            return error_dicts[0]
+
+        clusters = [] # [(normalized span, {sample: (severity, error)}), ...]
+        for sample, error_dict in enumerate(error_dicts):
+            for severity in SEVERITIES:
+                for _error in error_dict[severity]:
+                    span = ' '.join(_error['span'].lower().split())
+                    votes = next((votes for key, votes in clusters if self.spans_agree(key, span)), None)
+                    if votes is None:
+                        votes = {}
+                        clusters.append((span, votes))
+                    votes.setdefault(sample, (severity, _error)) # one vote per sample, its most severe report
+
+        merged = {severity: [] for severity in SEVERITIES}
+        for _, votes in clusters:
+            if len(votes) < self.min_agreement * len(error_dicts):
+                continue
+            severity_votes = Counter(severity for severity, _ in votes.values())
+            severity = max(reversed(SEVERITIES), key=lambda severity: severity_votes[severity])
+            merged[severity].append({
+                'category': Counter(_error['category'] for _, _error in votes.values()).most_common(1)[0][0],
+                'span': Counter(_error['span'] for _, _error in votes.values()).most_common(1)[0][0],
+            })
+
+        return merged
+
+
     def error_text2dict(self, 
                         error_text: str, 
                         message: List[str]=[]) -> Dict[str, Dict[str, str]]:
@@ -114,47 +444,73 @@ class Error_Analysis_Evaluator(BaseModule):
         Note: The number of errors from each category can be zero.
         """
 
-        errors_dict = {
-            'critical': [],
-            'major': [],
-            'minor': []
-        }
-
-        error_level = 'minor'
-        for line in error_text.split('\n'):
-            if 'critical:' in line.lower() or 'critical error' in line.lower():
-                error_level = 'critical'
-                continue
-            if 'major:' in line.lower() or 'major error' in line.lower():
-                error_level = 'major'
-                continue
-            if 'minor:' in line.lower() or 'minor error' in line.lower():
-                error_level = 'minor'
-                continue
-
-            if 'no-error' in line.lower() or "no error" in line.lower():
-                continue
-
-            if " - " not in line:
-                # print(f"This line will omit: {line}")
-                message.append(f"This line will omit: {line}\n")
-                continue
-
-            category = line.split(' - ')[0] # match categories
-            match = re.search(r'["”](.*?)["”]', line) # match errorspan within "" or “”
-
-            if match:
-                error_span = match.group(1)
-            else:
-                message.append(f"This line will omit: {line}\n") # record omit lines
-                continue
-
-            errors_dict[error_level].append({
-                'category': category,
-                'span': error_span
-            })
-        
-        return errors_dict
+        if error_text in self.parsed: # parsed while later batches generated
+            errors_dict, omitted = self.parsed[error_text]
+            message.extend(omitted)
+            return errors_dict
+        return error_text2dict(error_text, message)
+
+
+def sample_texts(_output: Dict[str, Any]) -> List[str]:
+    """truncated texts of every sample of a response."""
+    return [truncate_response(text, ['<|eot_id|>', ]) for text in _output.get('generated_texts', [_output['generated_text']])]
+
+
+def error_text2dict(error_text: str, message: List[str]) -> Dict[str, Dict[str, str]]:
+    """errors of a truncated response, recording omitted lines in message; see Error_Analysis_Evaluator.error_text2dict."""
+
+    errors_dict = {
+        'critical': [],
+        'major': [],
+        'minor': []
+    }
+
+    error_level = 'minor'
+    for line in error_text.split('\n'):
+        if 'critical:' in line.lower() or 'critical error' in line.lower():
+            error_level = 'critical'
+            continue
+        if 'major:' in line.lower() or 'major error' in line.lower():
+            error_level = 'major'
+            continue
+        if 'minor:' in line.lower() or 'minor error' in line.lower():
+            error_level = 'minor'
+            continue
+
+        if 'no-error' in line.lower() or "no error" in line.lower():
+            continue
+
+        if " - " not in line:
+            # print(f"This line will omit: {line}")
+            message.append(f"This line will omit: {line}\n")
+            continue
+
+        category = line.split(' - ')[0] # match categories
+        match = re.search(r'["”](.*?)["”]', line) # match errorspan within "" or “”
+
+        if match:
+            error_span = match.group(1)
+        else:
+            message.append(f"This line will omit: {line}\n") # record omit lines
+            continue
+
+        errors_dict[error_level].append({
+            'category': category,
+            'span': error_span
+        })
+    
+    return errors_dict
+
+
+def parse_annotations(outputs: List[Dict[str, Any]]) -> Dict[str, Tuple[Dict[str, Dict[str, str]], List[str]]]:
+    """errors and omitted lines of every sample of outputs, by sample text."""
+    parsed = {}
+    for _output in outputs:
+        for text in sample_texts(_output):
+            if text not in parsed:
+                messages = []
+                parsed[text] = (error_text2dict(text, messages), messages)
+    return parsed
 
 
 if __name__ == "__main__":
@@ -169,7 +525,7 @@ if __name__ == "__main__":
     src_lang, tgt_lang = 'zh', 'en'
 
     # init Inference
-    inference = Inference(**configs['inference'])
+    inference = build_inference(configs['inference'])
     evaluator_module = Error_Analysis_Evaluator(inference=inference, **configs['evaluator'])
 
     # evaluate samples
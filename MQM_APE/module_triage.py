@@ -0,0 +1,172 @@
+"""
+QE triage in front of the evaluator: COMETKiwi scores every target, and only the uncertain
+middle band goes through evaluator, APE and verifier. Targets scoring at least good_threshold
+get good_outcome, targets scoring at most bad_threshold get bad_outcome, without LLM calls.
+
+An outcome gives the number of errors per severity assigned to a triaged segment, e.g.
+{critical: 1} for a score of -25; they are verified errors (pe_valid_score 1) with category
+"Triage" and an empty span, so both MQM and MQM-APE count them. Triaged segments are marked
+with `triage: good` / `triage: bad` in results.
+"""
+
+import os.path as osp
+from typing import Any, Dict, List
+
+from basemodule import BaseModule
+from module_verifier_metric import build_metric_scorer
+from records import SEVERITIES, Corpus, segment_request_id
+from utils import (
+    load_yaml,
+    readlines_txt,
+    save_json,
+)
+
+TRIAGE_CATEGORY = 'Triage'
+
+
+class QE_Triage(BaseModule):
+    def __init__(self,
+                 metric_path: str=None,
+                 runtime: str='comet', # "cpu": export of cometkiwi_cpu.py, metric_path is the export directory
+                 num_threads: int=None, # intra-op threads of the cpu runtime
+                 batch_size: int=8,
+                 good_threshold: float=None, # targets scoring at least this get good_outcome, None to triage no good tail
+                 bad_threshold: float=None, # targets scoring at most this get bad_outcome, None to triage no bad tail
+                 good_outcome: Dict[str, int]=None, # errors per severity of good segments, none by default
+                 bad_outcome: Dict[str, int]=None, # errors per severity of bad segments, one critical by default
+                 metric_scorer: Any=None): # loaded scorer to share, e.g. that of the metric verifier
+
+        if good_threshold is not None and bad_threshold is not None and bad_threshold >= good_threshold:
+            raise ValueError(f"bad_threshold {bad_threshold} should be below good_threshold {good_threshold}.")
+        for outcome in good_outcome or {}, bad_outcome or {}:
+            for severity in outcome:
+                if severity not in SEVERITIES:
+                    raise ValueError(f"Unknown severity {severity} in triage outcome, expected one of {SEVERITIES}.")
+
+        self.batch_size = batch_size
+        self.good_threshold = good_threshold
+        self.bad_threshold = bad_threshold
+        self.outcomes = {'good': good_outcome or {}, 'bad': bad_outcome if bad_outcome is not None else {'critical': 1}}
+        self.metric_scorer = metric_scorer or build_metric_scorer(metric_path, runtime, num_threads)
+        self.stats = {'segments': 0, 'good': 0, 'bad': 0}
+
+
+    def pipeline_records(self,
+                         corpus: Corpus,
+                         completed: List[Dict[str, Any]]=None) -> List[int]:
+        """
+        score the targets of corpus and give the tails their default outcome.
+        completed: earlier target scores carrying request_id (e.g. saved triage_scores.json),
+        reused so that a resumed run triages the same segments.
+        return: segments of the middle band, for the LLM pipeline.
+        """
+        for _score in completed or []:
+            corpus.segments[int(_score['request_id'])].cometkiwi_score = _score['cometkiwi_score']
+
+        inputs = self.preprocess(corpus)
+        scores = self.query(inputs)
+        return self.postprocess(corpus, scores)
+
+
+    def preprocess(self, corpus: Corpus) -> List[Dict[str, str]]:
+        """return inputs dict of targets not scored yet, each with its request_id"""
+        return [{'request_id': segment_request_id(seg_id),
+                 'source_seg': corpus.pool[segment.source_seg],
+                 'target_seg': corpus.pool[segment.target_seg]}
+                for seg_id, segment in enumerate(corpus.segments) if segment.cometkiwi_score is None]
+
+
+    def query(self, inputs: List[Dict[str, str]]) -> Dict[str, float]:
+        """
+        inputs: [{'request_id', 'source_seg', 'target_seg'}, {...}, ...]
+        return: {request_id: score, ...}
+        """
+        if len(inputs) == 0:
+            return {}
+
+        scores, _ = self.metric_scorer.cometkiwi_eval(srcs=[_input['source_seg'] for _input in inputs],
+                                                      hyps=[_input['target_seg'] for _input in inputs],
+                                                      batch_size=self.batch_size)
+
+        return {_input['request_id']: score for _input, score in zip(inputs, scores)}
+
+
+    def postprocess(self, corpus: Corpus, scores: Dict[str, float]) -> List[int]:
+        """
+        store target scores, and errors of the default outcome into triaged segments.
+        return: segments of the middle band.
+        """
+        for rid, score in scores.items():
+            corpus.segments[int(rid)].cometkiwi_score = score
+
+        middle = []
+        for seg_id, segment in enumerate(corpus.segments):
+            segment.triage = self.triage(segment.cometkiwi_score)
+            if segment.triage is None:
+                middle.append(seg_id)
+                continue
+            corpus.add_errors(seg_id, {severity: [{'category': TRIAGE_CATEGORY, 'span': '', 'pe_valid_score': 1}
+                                                  for _ in range(self.outcomes[segment.triage].get(severity, 0))]
+                                       for severity in SEVERITIES})
+            self.stats[segment.triage] += 1
+        self.stats['segments'] += len(corpus.segments)
+
+        print(f"[INFO] QE triage: {len(corpus.segments) - len(middle)} of {len(corpus.segments)} segments "
+              f"({(len(corpus.segments) - len(middle)) / max(len(corpus.segments), 1):.0%}) skip the LLM pipeline.")
+        return middle
+
+
+    def triage(self, score: float) -> str:
+        """'good', 'bad', or None for the middle band."""
+        if self.good_threshold is not None and score >= self.good_threshold:
+            return 'good'
+        if self.bad_threshold is not None and score <= self.bad_threshold:
+            return 'bad'
+        return None
+
+
+def saved_requests(costs_before: Dict[str, Dict[str, Any]],
+                   costs_after: Dict[str, Dict[str, Any]],
+                   num_middle: int,
+                   num_triaged: int) -> Dict[str, Any]:
+    """
+    LLM requests of each stage for the middle band, and those saved on triaged segments, estimated
+    at the requests per segment of the middle band (None if no segment went through the pipeline,
+    when all requests are saved).
+    """
+    stats = {'segments': num_middle + num_triaged, 'triaged': num_triaged, 'stages': {}}
+    total, saved = 0, 0.0
+    for stage, costs in costs_after.items():
+        requests = costs['requests'] - costs_before.get(stage, {}).get('requests', 0)
+        stage_saved = requests / num_middle * num_triaged if num_middle > 0 else None
+        stats['stages'][stage] = {'requests': requests, 'saved_requests': stage_saved}
+        total += requests
+        saved = None if stage_saved is None or saved is None else saved + stage_saved
+
+    stats['requests'] = total
+    stats['saved_requests'] = saved
+    if saved is None:
+        stats['saved_fraction'] = 1.0 if num_triaged > 0 else None
+    else:
+        stats['saved_fraction'] = saved / (saved + total) if saved + total > 0 else None
+    return stats
+
+
+if __name__ == "__main__":
+
+    # current dir settings
+    current_dir = osp.dirname(osp.abspath(__file__))
+
+    # read files
+    configs = load_yaml(osp.join(current_dir, "configs/llmconfig_metric.yaml"))
+    if not configs.get('triage'):
+        raise SystemExit("[ERROR] No triage section in configs/llmconfig_metric.yaml, uncomment `triage:` and set metric_path.")
+    srcs = readlines_txt(osp.join(current_dir, "test/srcs_zh.txt"))
+    tgts = readlines_txt(osp.join(current_dir, "test/tgts_en.txt"))
+
+    # triage targets
+    triage_module = QE_Triage(**configs['triage'])
+    corpus = Corpus.from_texts(srcs, tgts, 'Chinese', 'English')
+    middle = triage_module.pipeline_records(corpus)
+
+    save_json(corpus.to_results(), osp.join(current_dir, "test/triage.json"))
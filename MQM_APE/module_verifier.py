@@ -1,11 +1,12 @@
 import os.path as osp
-from typing import Any, List, Dict, Tuple
+from typing import Any, Iterable, Iterator, List, Dict, Optional, Set, Tuple
 
-from basemodule import BaseModule
-from inference import Inference
-from prompts.prompts import TEMPLATE_VERIFIER
+from basemodule import BaseModule, build_overlap, new_retry_stats
+from chunking import LengthGuard, edited_region, max_chunks, prompt_budget, split_fields
+from engines import build_inference
+from prompts.prompts import TEMPLATE_VERIFIER, TEMPLATE_VERIFIER_RETRY
+from records import Corpus, index_responses
 from utils import (
-    apply_template, 
     truncate_response,
     read_json, 
     save_json,
@@ -14,15 +15,23 @@ from utils import (
 
 class Pairwise_Quality_Verifier(BaseModule):
     def __init__(self, 
-                 inference: Inference,
+                 inference: 'Inference', # inference.Inference or a backend with the same interface
                  use_twice_verify: bool=True, # verify twice to avoid positional bias
                  max_tokens: int=512,
-                 temperature: float=0):
+                 temperature: float=0,
+                 retries: int=0, # rounds re-querying unparseable judgments with a format reminder
+                 max_prompt_tokens: int=None, # prompt budget, max_model_len of the engine minus max_tokens by default
+                 overlap: Dict[str, Any]=None): # batches built while others generate, see overlap.OverlapRunner
         
         self.use_twice_verify = use_twice_verify
         self.inference = inference
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.retries = retries
+        self.retry_stats = new_retry_stats()
+        self.max_prompt_tokens = max_prompt_tokens
+        self.chunk_stats = {'errors': 0, 'over_budget': 0}
+        self.overlap = build_overlap(overlap)
 
     
     def pipeline(self,
@@ -31,116 +40,234 @@ class Pairwise_Quality_Verifier(BaseModule):
                  ) -> Tuple[List[Dict[str, str]], List[Dict[str, Dict[str, Any]]]]:
 
         # evaluate samples
-        inputs = self.preprocess(sample_inputs=sample_inputs, errors_ape=errors_ape)
-        outputs = self.query(inputs)
-        errors = self.postprocess(errors_ape=errors_ape, outputs=outputs)
+        corpus = Corpus.from_dicts(sample_inputs, errors_ape)
+        outputs = self.pipeline_records(corpus, range(len(corpus.errors)))
+        errors = [corpus.error_dict(seg_id) for seg_id in range(len(corpus.segments))]
 
         return outputs, errors
 
 
+    def pipeline_records(self,
+                         corpus: Corpus,
+                         error_ids: Iterable[int],
+                         completed: List[Dict[str, str]]=None) -> List[Dict[str, str]]:
+
+        """
+        pipeline of verifier on the record model. pe_valid_score is stored into corpus.
+        completed: earlier responses carrying request_id (e.g. saved llm_responses_verifier.json);
+        only requests without a completed response are queried.
+        Errors post-edited in a sentence chunk are verified on the chunk; see guard_errors for
+        errors left unverified.
+        return: responses of error_ids in request order.
+        """
+        error_ids = self.guard_errors(corpus, error_ids)
+        responses = index_responses(completed or [])
+        pending_requests = [(error_id, order) for error_id in error_ids for order in self.orders()
+                            if corpus.request_id(error_id, order) not in responses]
+
+        inputs = self.preprocess(corpus=corpus, requests=pending_requests)
+        request_ids = [corpus.request_id(error_id, order) for error_id, order in pending_requests]
+        outputs = self.query(inputs, request_ids, corpus.request_priorities(request_ids))
+
+        responses.update(index_responses(outputs))
+
+        # re-query judgments that only the last-resort guess could parse
+        rid_requests = {corpus.request_id(error_id, order): (error_id, order) for error_id in error_ids for order in self.orders()}
+        self.retry_malformed(responses, list(rid_requests), self.malformed,
+                             lambda rids: self.query(self.preprocess(corpus, [rid_requests[rid] for rid in rids]),
+                                                     rids, corpus.request_priorities(rids), retry=True))
+
+        self.postprocess(corpus=corpus, error_ids=error_ids, responses=responses)
+
+        return [responses[rid] for error_id in error_ids for order in self.orders()
+                for rid in [corpus.request_id(error_id, order)] if rid in responses]
+
+
+    def guard_errors(self, corpus: Corpus, error_ids: Iterable[int]) -> List[int]:
+        """
+        errors of error_ids to verify. Errors whose verifier prompt is over the token budget are
+        verified on the sentence chunk holding their edit. Errors without a post-edit (over the APE
+        budget) or whose chunk is still over budget keep pe_valid_score 1, counted as annotated;
+        segments of the latter are marked over_budget.
+        """
+        error_ids = list(error_ids)
+        for error_id in error_ids:
+            if corpus.errors[error_id].post_edit is None:
+                corpus.errors[error_id].pe_valid_score = 1
+        error_ids = [error_id for error_id in error_ids if corpus.errors[error_id].post_edit is not None]
+
+        budget = prompt_budget(self.inference, self.max_prompt_tokens, self.max_tokens)
+        if budget is None or len(error_ids) == 0:
+            return error_ids
+
+        over_ids = self.over_budget(corpus, error_ids, budget)
+        localized = [error_id for error_id in sorted(over_ids) if self.localize(corpus, error_id, budget) is not None]
+        over_ids = (over_ids - set(localized)) | self.over_budget(corpus, localized, budget)
+        for error_id in over_ids:
+            corpus.errors[error_id].pe_valid_score = 1
+            corpus.segments[corpus.errors[error_id].segment].over_budget = True
+
+        self.chunk_stats['errors'] += len(localized)
+        self.chunk_stats['over_budget'] += len(over_ids)
+        if len(localized) > 0 or len(over_ids) > 0:
+            print(f"[INFO] Verifier compares {len(localized)} errors over the budget of {budget} prompt tokens in the "
+                  f"sentence chunk of their edit, skips {len(over_ids)} errors still over budget, counted as annotated.")
+        return [error_id for error_id in error_ids if error_id not in over_ids]
+
+
+    def localize(self, corpus: Corpus, error_id: int, budget: int) -> Optional[Tuple[str, int, int]]:
+        """
+        sentence chunk of the segment holding the edit of an error, in as few chunks as fit the
+        budget, stored into corpus.error_chunks. None if the edit spans chunks or its sentences
+        do not fit.
+        """
+        fields = corpus.segment_fields(corpus.errors[error_id].segment)
+        begin, end = edited_region(fields['target_seg'], corpus.post_edit(error_id))
+        previous = corpus.error_chunks.get(error_id)
+
+        limit, num_chunks = max_chunks(fields), 2
+        while num_chunks <= limit:
+            holding = [(chunk_fields['source_seg'], chunk_begin, chunk_end)
+                       for chunk_fields, (chunk_begin, chunk_end) in split_fields(fields, num_chunks)
+                       if chunk_begin <= begin and end <= chunk_end]
+            if len(holding) == 0:
+                break
+            corpus.error_chunks[error_id] = holding[0]
+            if len(self.over_budget(corpus, [error_id], budget)) == 0:
+                return holding[0]
+            if num_chunks == limit:
+                break
+            num_chunks = min(num_chunks * 2, limit)
+
+        if previous is None:
+            corpus.error_chunks.pop(error_id, None)
+        else:
+            corpus.error_chunks[error_id] = previous
+        return None
+
+
+    def over_budget(self, corpus: Corpus, error_ids: List[int], budget: int) -> Set[int]:
+        """errors whose verifier prompt is over budget; swapped orderings have the same length."""
+        guard = LengthGuard(self.inference, lambda inputs: self.inference.build_prompts(TEMPLATE_VERIFIER, inputs), budget)
+        overs = guard.over_budget(self.preprocess(corpus, [(error_id, 0) for error_id in error_ids]))
+        return {error_id for error_id, over in zip(error_ids, overs) if over is True}
+
+
+    def orders(self) -> Tuple[int, ...]:
+        """request orderings of an error: 0 compares (target, post-edit), 1 the swapped pair."""
+        return (0, 1) if self.use_twice_verify is True else (0, )
+
+
     def preprocess(self, 
-                   sample_inputs: List[Dict[str, str]],
-                   errors_ape: List[Dict[str, Dict[str, str]]]) -> List[Dict[str, str]]:
+                   corpus: Corpus,
+                   requests: List[Tuple[int, int]]) -> Iterator[Dict[str, str]]:
         
-        """return inputs dict with comparative translations"""
+        """
+        return template fields with comparative translations of (error_id, order) requests, built on
+        the fly; errors post-edited in a sentence chunk compare the chunk
+        """
 
-        inputs = []
-        for sample_input, error_dict in zip(sample_inputs, errors_ape):
-            for _error in error_dict['critical'] + error_dict['major'] + error_dict['minor']:
-                inputs.append({
+        for error_id, order in requests:
+            sample_input = corpus.comparison_fields(error_id)
+            post_edit = sample_input['post_edit']
+            if order == 0:
+                yield {
                     'source_lang': sample_input['source_lang'],
                     'source_seg': sample_input['source_seg'],
                     'target_lang': sample_input['target_lang'],
                     'transA_seg': sample_input['target_seg'],
-                    'transB_seg': _error['post_edit'],
-                })
-                if self.use_twice_verify is True:
-                    inputs.append({ # swap transA and transB
-                        'source_lang': sample_input['source_lang'],
-                        'source_seg': sample_input['source_seg'],
-                        'target_lang': sample_input['target_lang'],
-                        'transA_seg': _error['post_edit'], 
-                        'transB_seg': sample_input['target_seg'], 
-                    })
-
-        return inputs
+                    'transB_seg': post_edit,
+                }
+            else:
+                yield { # swap transA and transB
+                    'source_lang': sample_input['source_lang'],
+                    'source_seg': sample_input['source_seg'],
+                    'target_lang': sample_input['target_lang'],
+                    'transA_seg': post_edit, 
+                    'transB_seg': sample_input['target_seg'], 
+                }
 
 
     def query(self, 
-              inputs: List[Dict[str, str]]) -> List[Dict[str, str]]:
+              inputs: Iterable[Dict[str, str]],
+              request_ids: List[str]=None,
+              priorities: List[int]=None,
+              retry: bool=False) -> List[Dict[str, str]]:
         
         """
-        inputs: [{'source_lang', 'source_seg', 'target_lang', 'target_seg'}, {...}, ...]
-        return: [{'prompt', 'generated_text'}, {...}, ...] or [{'transA': score, 'transB': score}]
+        inputs: [{'source_lang', 'source_seg', 'target_lang', 'transA_seg', 'transB_seg'}, {...}, ...]
+        request_ids: ids attached to the responses.
+        priorities: scheduling priority of each input, lower first.
+        retry: re-query of malformed responses, with a format reminder.
+        return: [{'prompt', 'generated_text', 'request_id'}, {...}, ...]
         """
 
         # generate query
-        query_list = [apply_template(TEMPLATE_VERIFIER, _input) for _input in inputs]
-
-        outputs = self.inference.inference(query_list, 
-                                           self.temperature,
-                                           self.max_tokens)
+        outputs = self.generate(lambda batch: self.inference.build_prompts(TEMPLATE_VERIFIER_RETRY if retry else TEMPLATE_VERIFIER, batch),
+                                inputs,
+                                temperature=self.temperature,
+                                max_tokens=self.max_tokens,
+                                request_ids=request_ids,
+                                priorities=priorities)
         
         return outputs
 
 
     def postprocess(self, 
-                    errors_ape: List[Dict[str, Dict[str, str]]], 
-                    outputs: List[Dict[str, Any]]) -> List[Dict[str, Dict[str, Any]]]:
+                    corpus: Corpus,
+                    error_ids: List[int],
+                    responses: Dict[str, Dict[str, Any]]) -> Corpus:
         
         """
-        extract error spans from generated text.
+        extract verifier judgments from generated text.
         
-        errors: A List of error annotations from Evaluator.
-        outputs: pairwise outputs list
-        return: A List of error annotations, with APE translation, pairwise score for each error annotation.
+        corpus: record model holding error annotations with APE translations.
+        error_ids: errors to fill in.
+        responses: pairwise outputs indexed by request_id, which may be partial or in any order.
+        return: corpus, with pairwise score for each error whose requests are all completed.
         """
 
-        def list_generator(my_list):
-            for item in my_list:
-                yield item
-
-        # truncate error spans
-        verifier_texts = [truncate_response(_output['generated_text'], ['<|eot_id|>', ]) for _output in outputs]
-
-        # extract verifier results from error_list
-        verifier_results_generator = list_generator(self.verifier_pairwise(_text) for _text in verifier_texts)
-
-        # parse verifier judgments to error annotation
-        for error_dict in errors_ape:
-            for severity in 'critical', 'major', 'minor':
-                if len(error_dict[severity]) == 0:
-                    continue
-
-                for _error in error_dict[severity]:
+        for error_id in error_ids:
+            _outputs = [responses.get(corpus.request_id(error_id, order)) for order in self.orders()]
+            if any(_output is None for _output in _outputs): # not completed yet
+                continue
+
+            # truncate and extract verifier results
+            verifier_results = [self.verifier_pairwise(truncate_response(_output['generated_text'], ['<|eot_id|>', ])) 
+                                for _output in _outputs]
+            error = corpus.errors[error_id]
+
+            if self.use_twice_verify is True:
+                res1, res2 = verifier_results # tgt vs. ape, ape vs. tgt
+
+                if res1 == 'A' and res2 == 'B': # target best
+                    error.pe_valid_score = 0
+                elif res1 == 'B' and res2 == 'A': # pe best
+                    error.pe_valid_score = 1
+                else: # tie
+                    error.pe_valid_score = 0.5
+            
+            else:
+                res = verifier_results[0] # tgt vs. ape
+                if res == 'A':
+                    error.pe_valid_score = 0
+                elif res == 'B':
+                    error.pe_valid_score = 1
+                else:
+                    error.pe_valid_score = 0.5
 
-                    if self.use_twice_verify is True:
-                        res1 = next(verifier_results_generator) # tgt vs. ape
-                        res2 = next(verifier_results_generator) # ape vs. tgt
+        return corpus
 
-                        if res1 == 'A' and res2 == 'B': # target best
-                            _error['pe_valid_score'] = 0
-                        elif res1 == 'B' and res2 == 'A': # pe best
-                            _error['pe_valid_score'] = 1
-                        else: # tie
-                            _error['pe_valid_score'] = 0.5
-                    
-                    else:
-                        res = next(verifier_results_generator) # tgt vs. ape
-                        if res == 'A':
-                            _error['pe_valid_score'] = 0
-                        elif res == 'B':
-                            _error['pe_valid_score'] = 1
-                        else:
-                            _error['pe_valid_score'] = 0.5
 
-        return errors_ape
+    def malformed(self, _output: Dict[str, str]) -> bool:
+        """the judgment can only be guessed."""
+        return self.verifier_pairwise(truncate_response(_output['generated_text'], ['<|eot_id|>', ]), strict=True) is None
 
 
-    def verifier_pairwise(self, response: str) -> str: 
+    def verifier_pairwise(self, response: str, strict: bool=False) -> Optional[str]: 
 
         """
-        return 'A' or 'B'
+        return 'A' or 'B', or None instead of the last-resort guess when strict
         """
 
         def paircheck(text: str, a_key: str, b_key: str):
@@ -162,8 +289,7 @@ class Pairwise_Quality_Verifier(BaseModule):
 
         response = response.split('<|eot_id|>')[0]
         response_lines = [r.strip() for r in response.split('\n') if r.strip() != ""]
-        text = response_lines[0]
-        # for llama
+        # for llama (an empty response falls through to the last resort)
         text = '\n'.join(response_lines)
 
         if text in ['A', 'B']: # direct A or B
@@ -185,6 +311,8 @@ class Pairwise_Quality_Verifier(BaseModule):
             return 'B'
         
         # other situations
+        if strict is True:
+            return None
         num_a = text.lower().find('A')
         num_b = text.lower().find('B')
         if num_a < num_b:
@@ -203,8 +331,9 @@ if __name__ == "__main__":
     errors = [_input['error_dict'] for _input in inputs]
 
     # init Inference
-    inference = Inference(**configs['inference'])
-    verifier_module = Pairwise_Quality_Verifier(inference=inference, **configs['verifier'])
+    inference = build_inference(configs['inference'])
+    verifier_configs = {key: value for key, value in configs['verifier'].items() if key != 'listwise'}
+    verifier_module = Pairwise_Quality_Verifier(inference=inference, **verifier_configs)
 
     # evaluate samples
     outputs, errors = verifier_module.pipeline(inputs, errors)
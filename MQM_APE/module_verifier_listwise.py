@@ -0,0 +1,242 @@
+import os.path as osp
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from chunking import LengthGuard, prompt_budget
+from engines import build_inference
+from module_verifier import Pairwise_Quality_Verifier
+from prompts.prompts import TEMPLATE_VERIFIER_LISTWISE, TEMPLATE_VERIFIER_LISTWISE_RETRY
+from records import Corpus, index_responses
+from utils import (
+    truncate_response,
+    read_json,
+    save_json,
+    load_yaml,
+)
+
+
+class Listwise_Quality_Verifier(Pairwise_Quality_Verifier):
+    """
+    verify all post-edits of a segment in one prompt: the original translation and k candidates,
+    each judged better or worse than the original. One call per segment (two with use_twice_verify,
+    the second with the candidate list rotated, unless the segment has a single candidate) instead
+    of one or two per error.
+    """
+
+    def pipeline_records(self,
+                         corpus: Corpus,
+                         error_ids: Iterable[int],
+                         completed: List[Dict[str, str]]=None) -> List[Dict[str, str]]:
+
+        """
+        pipeline of listwise verifier on the record model. pe_valid_score is stored into corpus.
+        completed: earlier responses carrying request_id (e.g. saved llm_responses_verifier.json);
+        only requests without a completed response are queried.
+        Candidates post-edited in a sentence chunk are listed with the other candidates of the chunk,
+        and lists over the token budget are halved until they fit.
+        return: responses of error_ids in request order.
+        """
+        groups = self.fit_groups(corpus, self.group_errors(corpus, self.guard_errors(corpus, error_ids)))
+        responses = index_responses(completed or [])
+        pending_requests = [(candidates, order) for candidates in groups for order in self.list_orders(candidates)
+                            if self.request_id(corpus, candidates, order) not in responses]
+
+        inputs = self.preprocess(corpus=corpus, requests=pending_requests)
+        request_ids = [self.request_id(corpus, candidates, order) for candidates, order in pending_requests]
+        outputs = self.query(inputs, request_ids, corpus.request_priorities(request_ids))
+
+        responses.update(index_responses(outputs))
+
+        # re-query lists with candidates left unjudged
+        rid_requests = {self.request_id(corpus, candidates, order): (candidates, order) for candidates in groups for order in self.list_orders(candidates)}
+        self.retry_malformed(responses, list(rid_requests),
+                             lambda _output: self.malformed(_output, len(rid_requests[_output['request_id']][0])),
+                             lambda rids: self.query(self.preprocess(corpus, [rid_requests[rid] for rid in rids]),
+                                                     rids, corpus.request_priorities(rids), retry=True))
+
+        self.postprocess(corpus=corpus, groups=groups, responses=responses)
+
+        return [responses[rid] for candidates in groups for order in self.list_orders(candidates)
+                for rid in [self.request_id(corpus, candidates, order)] if rid in responses]
+
+
+    def over_budget(self, corpus: Corpus, error_ids: List[int], budget: int) -> Set[int]:
+        """errors whose prompt is over budget even as the only candidate."""
+        guard = LengthGuard(self.inference, lambda inputs: self.inference.build_prompts(TEMPLATE_VERIFIER_LISTWISE, inputs), budget)
+        overs = guard.over_budget(self.preprocess(corpus, [([error_id], 0) for error_id in error_ids]))
+        return {error_id for error_id, over in zip(error_ids, overs) if over is True}
+
+
+    def fit_groups(self, corpus: Corpus, groups: List[List[int]]) -> List[List[int]]:
+        """candidate lists halved until their prompt is within the token budget, in order."""
+        budget = prompt_budget(self.inference, self.max_prompt_tokens, self.max_tokens)
+        if budget is None:
+            return groups
+
+        guard = LengthGuard(self.inference, lambda inputs: self.inference.build_prompts(TEMPLATE_VERIFIER_LISTWISE, inputs), budget)
+        fitted = []
+        while len(groups) > 0:
+            overs = guard.over_budget(self.preprocess(corpus, [(candidates, 0) for candidates in groups]))
+            fitted += [candidates for candidates, over in zip(groups, overs) if over is False or len(candidates) == 1]
+            groups = [half for candidates, over in zip(groups, overs) if over is True and len(candidates) > 1
+                      for half in (candidates[:len(candidates) // 2], candidates[len(candidates) // 2:])]
+        return sorted(fitted, key=lambda candidates: candidates[0])
+
+
+    def group_errors(self, corpus: Corpus, error_ids: Iterable[int]) -> List[List[int]]:
+        """candidates of each segment: error_ids grouped by segment, and by sentence chunk if post-edited in one, in order."""
+        groups = {}
+        for error_id in error_ids:
+            groups.setdefault((corpus.errors[error_id].segment, corpus.error_chunks.get(error_id)), []).append(error_id)
+        return list(groups.values())
+
+
+    def request_id(self, corpus: Corpus, candidates: List[int], order: int) -> str:
+        """
+        segment, rotation, and the candidate errors (severity.index), so rounds verifying
+        different errors of a segment (e.g. lazy verification) get different ids.
+        """
+        errors = [corpus.request_id(error_id).split(':')[1:3] for error_id in candidates]
+        return f"{corpus.errors[candidates[0]].segment}:list:{order}:" + ','.join('.'.join(error) for error in errors)
+
+
+    def list_orders(self, candidates: List[int]) -> Tuple[int, ...]:
+        """orderings of a candidate list; a single candidate has no rotation, so it gets one request."""
+        return self.orders() if len(candidates) > 1 else (0, )
+
+
+    def rotation(self, num_candidates: int, order: int) -> int:
+        """offset of the candidate list of an ordering, spread evenly over the orderings."""
+        return (order * num_candidates) // len(self.orders())
+
+
+    def preprocess(self,
+                   corpus: Corpus,
+                   requests: List[Tuple[List[int], int]]) -> Iterator[Dict[str, str]]:
+
+        """return template fields with the numbered candidates of (candidates, order) requests, built on the fly"""
+
+        for candidates, order in requests:
+            offset = self.rotation(len(candidates), order)
+            rotated = candidates[offset:] + candidates[:offset]
+            fields = [corpus.comparison_fields(error_id) for error_id in rotated]
+            yield {
+                **{key: value for key, value in fields[0].items() if key != 'post_edit'},
+                'candidates': '\n'.join(f'{position + 1}. "{_fields["post_edit"]}"'
+                                        for position, _fields in enumerate(fields)),
+            }
+
+
+    def query(self,
+              inputs: Iterable[Dict[str, str]],
+              request_ids: List[str]=None,
+              priorities: List[int]=None,
+              retry: bool=False) -> List[Dict[str, str]]:
+
+        """
+        inputs: [{'source_lang', 'source_seg', 'target_lang', 'target_seg', 'candidates'}, {...}, ...]
+        request_ids: ids attached to the responses.
+        priorities: scheduling priority of each input, lower first.
+        retry: re-query of malformed responses, with a format reminder.
+        return: [{'prompt', 'generated_text', 'request_id'}, {...}, ...]
+        """
+
+        # generate query
+        outputs = self.generate(lambda batch: self.inference.build_prompts(TEMPLATE_VERIFIER_LISTWISE_RETRY if retry else TEMPLATE_VERIFIER_LISTWISE, batch),
+                                inputs,
+                                temperature=self.temperature,
+                                max_tokens=self.max_tokens,
+                                request_ids=request_ids,
+                                priorities=priorities)
+
+        return outputs
+
+
+    def postprocess(self,
+                    corpus: Corpus,
+                    groups: List[List[int]],
+                    responses: Dict[str, Dict[str, Any]]) -> Corpus:
+
+        """
+        extract per-candidate judgments from generated text and map them back to errors.
+
+        corpus: record model holding error annotations with APE translations.
+        groups: candidates of each segment.
+        responses: listwise outputs indexed by request_id, which may be partial or in any order.
+        return: corpus, with pairwise score for each error whose requests are all completed.
+        """
+
+        for candidates in groups:
+            _outputs = [responses.get(self.request_id(corpus, candidates, order)) for order in self.list_orders(candidates)]
+            if any(_output is None for _output in _outputs): # not completed yet
+                continue
+
+            # verdicts of each candidate, back in the order of candidates
+            verdicts = [[] for _ in candidates]
+            for order, _output in zip(self.list_orders(candidates), _outputs):
+                judgments = self.verifier_listwise(truncate_response(_output['generated_text'], ['<|eot_id|>', ]), len(candidates))
+                offset = self.rotation(len(candidates), order)
+                for position, judgment in enumerate(judgments):
+                    verdicts[(position + offset) % len(candidates)].append(judgment)
+
+            for error_id, error_verdicts in zip(candidates, verdicts):
+                if all(verdict == 'better' for verdict in error_verdicts): # pe best
+                    corpus.errors[error_id].pe_valid_score = 1
+                elif all(verdict == 'worse' for verdict in error_verdicts): # target best
+                    corpus.errors[error_id].pe_valid_score = 0
+                else: # tie or not judged
+                    corpus.errors[error_id].pe_valid_score = 0.5
+
+        return corpus
+
+
+    def malformed(self, _output: Dict[str, str], num_candidates: int) -> bool:
+        """some candidate is not judged."""
+        return None in self.verifier_listwise(truncate_response(_output['generated_text'], ['<|eot_id|>', ]), num_candidates)
+
+
+    def verifier_listwise(self, response: str, num_candidates: int) -> List[Optional[str]]:
+
+        """
+        return 'better', 'worse' or None (not judged) for each candidate position.
+        """
+
+        judgments = [None] * num_candidates
+        response = response.split('<|eot_id|>')[0]
+        for line in response.split('\n'):
+            match = re.match(r'^\W*(?:candidate\s*)?(\d+)\s*[:.)\-]\s*(.*)$', line.strip(), flags=re.I)
+            if match is None:
+                continue
+            position, text = int(match.group(1)) - 1, match.group(2).lower()
+            if position < 0 or position >= num_candidates or judgments[position] is not None:
+                continue
+            if 'worse' in text or 'not better' in text:
+                judgments[position] = 'worse'
+            elif 'better' in text:
+                judgments[position] = 'better'
+
+        return judgments
+
+
+if __name__ == "__main__":
+
+    # current dir settings
+    current_dir = osp.dirname(osp.abspath(__file__))
+
+    # read files
+    configs = load_yaml(osp.join(current_dir, "configs/llmconfig.yaml"))
+    inputs = read_json(osp.join(current_dir, "test/errorspans_ape.json"))
+    errors = [_input['error_dict'] for _input in inputs]
+
+    # init Inference
+    inference = build_inference(configs['inference'])
+    verifier_configs = {key: value for key, value in configs['verifier'].items() if key != 'listwise'}
+    verifier_module = Listwise_Quality_Verifier(inference=inference, **verifier_configs)
+
+    # evaluate samples
+    outputs, errors = verifier_module.pipeline(inputs, errors)
+
+    input_with_errors = [{**_input, 'error_dict': _error} for _input, _error in zip(inputs, errors)]
+
+    # save
+    save_json(input_with_errors, osp.join(current_dir, "test/errorspans_ape_verifier_listwise.json"))
@@ -1,21 +1,36 @@
 import os.path as osp
-from typing import Any, List, Dict, Tuple
+from typing import Any, Iterable, List, Dict, Optional, Tuple
 
 from basemodule import BaseModule
-from cometkiwi import COMETKiwi
+from records import Corpus, segment_request_id
 from utils import (
     read_json, 
     save_json,
     load_yaml,
 )
 
+def build_metric_scorer(metric_path: str, runtime: str='comet', num_threads: int=None):
+    """cometkiwi.COMETKiwi, or cometkiwi_cpu.COMETKiwiCPU serving an export with runtime 'cpu'."""
+    if runtime == 'comet':
+        from cometkiwi import COMETKiwi
+        return COMETKiwi(metric_path)
+    if runtime == 'cpu':
+        from cometkiwi_cpu import COMETKiwiCPU
+        return COMETKiwiCPU(metric_path, num_threads)
+    raise ValueError(f"Unknown metric runtime {runtime}")
+
+
 class Pairwise_Quality_Verifier_Metric(BaseModule):
     def __init__(self, # use metrics such as COMET-Kiwi to replace LLM verifier
                  metric_path: str,
-                 metric_threshold: float=0.03):
+                 metric_threshold: float=0.03,
+                 runtime: str='comet', # "cpu": export of cometkiwi_cpu.py, metric_path is the export directory
+                 num_threads: int=None, # intra-op threads of the cpu runtime
+                 batch_size: int=8):
         
         self.metric_threshold = metric_threshold
-        self.metric_scorer = COMETKiwi(metric_path)
+        self.batch_size = batch_size
+        self.metric_scorer = build_metric_scorer(metric_path, runtime, num_threads)
         
 
     def pipeline(self,
@@ -25,102 +40,131 @@ class Pairwise_Quality_Verifier_Metric(BaseModule):
         
         """pipeline of verifier"""
         
-        tgt_inputs, ape_inputs = self.preprocess(sample_inputs=sample_inputs, errors_ape=errors_ape)
+        corpus = Corpus.from_dicts(sample_inputs, errors_ape)
+        self.pipeline_records(corpus, range(len(corpus.errors)), seg_ids=range(len(corpus.segments)))
+        samples_inputs_scores = [corpus.sample_input(seg_id) for seg_id in range(len(corpus.segments))]
+        errors_ape_scores = [corpus.error_dict(seg_id) for seg_id in range(len(corpus.segments))]
+
+        return samples_inputs_scores, errors_ape_scores
+
+
+    def pipeline_records(self,
+                         corpus: Corpus,
+                         error_ids: Iterable[int],
+                         seg_ids: Optional[Iterable[int]]=None) -> Corpus:
+
+        """
+        pipeline of verifier on the record model.
+        seg_ids: segments whose target is scored, segments of error_ids by default.
+        Targets scored by an earlier call are not scored again. Errors without a post-edit (over
+        the APE budget) keep pe_valid_score 1, counted as annotated.
+        """
+        error_ids = list(error_ids)
+        for error_id in error_ids:
+            if corpus.errors[error_id].post_edit is None:
+                corpus.errors[error_id].pe_valid_score = 1
+        error_ids = [error_id for error_id in error_ids if corpus.errors[error_id].post_edit is not None]
+        tgt_inputs, ape_inputs = self.preprocess(corpus=corpus, error_ids=error_ids, seg_ids=seg_ids)
         tgt_scores = self.query(tgt_inputs)
         ape_scores = self.query(ape_inputs)
-        samples_inputs_scores, errors_ape_scores = self.postprocess(sample_inputs=sample_inputs, 
-                                                                    errors_ape=errors_ape, 
-                                                                    tgt_scores=tgt_scores, 
-                                                                    ape_scores=ape_scores)
+        self.postprocess(corpus=corpus,
+                         error_ids=error_ids,
+                         tgt_scores=tgt_scores,
+                         ape_scores=ape_scores)
 
-        return samples_inputs_scores, errors_ape_scores
+        return corpus
     
 
     def preprocess(self, 
-                   sample_inputs: List[Dict[str, str]],
-                   errors_ape: List[Dict[str, Dict[str, str]]]) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+                   corpus: Corpus,
+                   error_ids: List[int],
+                   seg_ids: Optional[Iterable[int]]=None) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
         
-        """return inputs dict with comparative translations"""
+        """return inputs dict of targets and of comparative translations, each with its request_id"""
 
-        tgt_inputs, ape_inputs = [], []
-        for sample_input, error_dict in zip(sample_inputs, errors_ape):
+        if seg_ids is None:
+            seg_ids = sorted(set(corpus.errors[error_id].segment for error_id in error_ids))
 
+        tgt_inputs, ape_inputs = [], []
+        for seg_id in seg_ids:
+            segment = corpus.segments[seg_id]
+            if segment.cometkiwi_score is not None:
+                continue
             tgt_inputs.append({
-                'source_seg': sample_input['source_seg'],
-                'target_seg': sample_input['target_seg'],
+                'request_id': segment_request_id(seg_id),
+                'source_seg': corpus.pool[segment.source_seg],
+                'target_seg': corpus.pool[segment.target_seg],
             })
 
-            for _error in error_dict['critical'] + error_dict['major'] + error_dict['minor']:
-                ape_inputs.append({
-                    'source_seg': sample_input['source_seg'],
-                    'target_seg': _error['post_edit'],
-                })
+        for error_id in error_ids:
+            ape_inputs.append({
+                'request_id': corpus.request_id(error_id),
+                'source_seg': corpus.pool[corpus.segments[corpus.errors[error_id].segment].source_seg],
+                'target_seg': corpus.post_edit(error_id),
+            })
 
         return tgt_inputs, ape_inputs
     
 
     def query(self, 
-              inputs: List[Dict[str, str]]) -> List[float]:
+              inputs: List[Dict[str, str]]) -> Dict[str, float]:
         
         """
-        inputs: [{'source_lang', 'source_seg', 'target_lang', 'target_seg'}, {...}, ...]
-        return: [{'transA': score, 'transB': score}]
+        inputs: [{'request_id', 'source_seg', 'target_seg'}, {...}, ...]
+        return: {request_id: score, ...}
         """
 
+        if len(inputs) == 0:
+            return {}
+
         # cometeval
         srcs = [_input['source_seg'] for _input in inputs]
         tgts = [_input['target_seg'] for _input in inputs]
 
-        scores, _ = self.metric_scorer.cometkiwi_eval(srcs=srcs, hyps=tgts)
+        scores, _ = self.metric_scorer.cometkiwi_eval(srcs=srcs, hyps=tgts, batch_size=self.batch_size)
 
-        return scores
+        return {_input['request_id']: score for _input, score in zip(inputs, scores)}
     
 
     def postprocess(self, 
-                    sample_inputs: List[Dict[str, str]],
-                    errors_ape: List[Dict[str, Dict[str, str]]], 
-                    tgt_scores: List[float],
-                    ape_scores: List[float]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Dict[str, Any]]]]:
+                    corpus: Corpus,
+                    error_ids: List[int],
+                    tgt_scores: Dict[str, float],
+                    ape_scores: Dict[str, float]) -> Corpus:
         
         """
-        extract error spans from generated text.
+        compare metric scores of APE translations with their target translations.
         
-        errors: A List of error annotations from Evaluator.
-        outputs: pairwise outputs list
-        return: A List of error annotations, with APE translation, pairwise score for each error annotation.
+        corpus: record model holding error annotations with APE translations.
+        error_ids: errors to fill in.
+        tgt_scores: target scores indexed by segment request_id.
+        ape_scores: APE scores indexed by error request_id, which may be partial or in any order.
+        return: corpus, with target scores, APE scores and pairwise score for each scored error.
         """
 
-        def list_generator(my_list):
-            for item in my_list:
-                yield item
-
-        # extract verifier results from error_list
-        verifier_results_generator = list_generator(ape_scores)
+        for rid, tgt_score in tgt_scores.items():
+            corpus.segments[int(rid)].cometkiwi_score = tgt_score
 
         # parse verifier judgments to error annotation
-        for _input, error_dict, tgt_score in zip(sample_inputs, errors_ape, tgt_scores):
-
-            _input['cometkiwi_score'] = tgt_score
-
-            for severity in 'critical', 'major', 'minor':
-                if len(error_dict[severity]) == 0:
-                    continue
-
-                for _error in error_dict[severity]:
-                    ape_score = next(verifier_results_generator) # tgt vs. ape
+        for error_id in error_ids:
+            error = corpus.errors[error_id]
+            ape_score = ape_scores.get(corpus.request_id(error_id))
+            tgt_score = corpus.segments[error.segment].cometkiwi_score
+            if ape_score is None or tgt_score is None: # not completed yet
+                continue
 
-                    _error['postedit_cometkiwi_score'] = ape_score
+            error.postedit_cometkiwi_score = ape_score
 
-                    if ape_score - tgt_score > self.metric_threshold: # ape better
-                        _error['pe_valid_score'] = 1
+            if ape_score - tgt_score > self.metric_threshold: # ape better
+                error.pe_valid_score = 1
 
-                    elif tgt_score - ape_score > self.metric_threshold: # tgt better
-                        _error['pe_valid_score'] = 0
+            elif tgt_score - ape_score > self.metric_threshold: # tgt better
+                error.pe_valid_score = 0
 
-                    else: # tie
-                        _error['pe_valid_score'] = 0.5
+            else: # tie
+                error.pe_valid_score = 0.5
 
-        return sample_inputs, errors_ape
+        return corpus
 
         
 if __name__ == "__main__":
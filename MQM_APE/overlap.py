@@ -0,0 +1,103 @@
+"""
+Overlap of prompt building and response parsing with generation.
+
+A stage otherwise builds all prompts, generates them, then parses all responses, so the CPU
+phases before and after generation sit on the critical path. With `overlap` in a stage config,
+its inputs go to the engine in batches of `batch_size`: while batch k generates, the prompts
+of batch k+1 are built on a worker thread and the responses of batch k-1 are parsed on a pool
+of `workers` threads, or processes with `processes: true` where parsing holds the GIL.
+
+Batches are cut in the priority order of the inputs and responses are returned in the order of
+the inputs, so the same batch_size gives the same requests and results on every run. Parsing is
+a pure function of the responses, keyed by their text.
+"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, List, Tuple
+
+PER_INPUT = ('request_ids', 'priorities') # inference arguments given for each input
+
+
+class OverlapRunner():
+    """double-buffered batches of one stage: build the next batch and parse the previous one while a batch generates."""
+
+    def __init__(self,
+                 batch_size: int=256, # inputs per batch, large enough to keep the engine busy
+                 workers: int=2, # threads or processes parsing responses
+                 processes: bool=False): # parse in processes (spawned, safe next to CUDA) instead of threads
+
+        self.batch_size = batch_size
+        self.workers = workers
+        self.processes = processes
+        self.stats = {'batches': 0, 'render_seconds': 0.0, 'waited_seconds': 0.0}
+
+
+    def batches(self, num_inputs: int, priorities: List[int]=None) -> List[List[int]]:
+        """input indices of each batch, in priority order (stable within a priority) as the engine would submit them."""
+        order = list(range(num_inputs)) if priorities is None else sorted(range(num_inputs), key=priorities.__getitem__)
+        return [order[begin:begin + self.batch_size] for begin in range(0, num_inputs, self.batch_size)]
+
+
+    def parse_pool(self):
+        if self.processes is True:
+            return ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'))
+        return ThreadPoolExecutor(self.workers)
+
+
+    def run(self,
+            inputs: List[Dict[str, str]],
+            render: Callable[[List[Dict[str, str]]], List[Any]],
+            generate: Callable[..., List[Dict[str, Any]]],
+            parse: Callable[[List[Dict[str, Any]]], Dict[str, Any]]=None,
+            **kwargs) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        inputs: template fields of each request.
+        render: prompts of a batch of inputs.
+        generate: responses of a batch of prompts, called with kwargs; request_ids and priorities
+        are sliced to the batch.
+        parse: parsed responses of a batch, by text; must be picklable with processes.
+        return: responses in the order of inputs, and the parse results of each batch in batch order.
+        """
+        batches = self.batches(len(inputs), kwargs.get('priorities'))
+        if len(batches) == 0:
+            return [], []
+
+        def render_batch(batch: List[int]) -> Tuple[List[Any], float]:
+            timer = time.time()
+            prompts = render([inputs[idx] for idx in batch])
+            return prompts, time.time() - timer
+
+        responses, parse_futures, waited = [None] * len(inputs), [], 0.0
+        with ThreadPoolExecutor(1) as render_pool, (self.parse_pool() if parse is not None else nullcontext()) as parse_pool:
+            prompts, rendered = render_batch(batches[0]) # on the calling thread, which loads the engine
+
+            for idx, batch in enumerate(batches):
+                next_render = render_pool.submit(render_batch, batches[idx + 1]) if idx + 1 < len(batches) else None
+
+                batch_kwargs = {key: [value[position] for position in batch] if key in PER_INPUT and value is not None else value
+                                for key, value in kwargs.items()}
+                outputs = generate(prompts, **batch_kwargs)
+                for position, _output in zip(batch, outputs):
+                    responses[position] = _output
+                if parse is not None:
+                    parse_futures.append(parse_pool.submit(parse, outputs))
+
+                if next_render is not None:
+                    timer = time.time()
+                    prompts, seconds = next_render.result()
+                    waited += time.time() - timer
+                    rendered += seconds
+
+            timer = time.time()
+            parsed = [future.result() for future in parse_futures]
+            waited += time.time() - timer
+
+        self.stats['batches'] += len(batches)
+        self.stats['render_seconds'] += rendered
+        self.stats['waited_seconds'] += waited
+        print(f"[INFO] Overlapped {len(batches)} batches: {rendered:.2f}s building prompts, "
+              f"{waited:.2f}s of building and parsing left on the critical path.")
+        return responses, parsed
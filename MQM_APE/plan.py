@@ -0,0 +1,323 @@
+"""
+Dry-run cost planner: token volume and GPU-hours of an MQM-APE run, without loading model weights.
+
+Evaluator prompts are built exactly as in a run (routed engine's tokenizer and chat template,
+packing and few-shot selection), one per prompt that would be sent. Which segments get errors
+is only known after evaluation, so the APE and verifier fan-out and all generated tokens are
+estimated from earlier runs (--history): per language pair, the errors per segment by severity,
+the share of segments with errors, and the generated tokens per request of each stage. Language
+pairs without history use the statistics pooled over all history.
+
+Re-queries of retries, sentence chunking of prompts over the budget and QE triage are not
+modelled: stages are planned without retries, over-budget prompts whole, and every segment as
+going through the LLM pipeline. The plan lists those of the config under `not_modelled`.
+
+GPU-hours of a stage = (prompt tokens / prefill tok/s + generated tokens / decode tok/s) x tp of
+the stage's engine, with the throughput of --prefill_tps / --decode_tps or of a --profile YAML
+keyed by engine name:
+
+    default: {prefill_tps: 20000, decode_tps: 1500}
+    small: {prefill_tps: 60000, decode_tps: 4000}
+"""
+
+import argparse
+import os.path as osp
+from typing import Any, Dict, List
+
+from chunking import prompt_budget
+from engines import EnginePool, build_prompt_engine
+from manifest import build_corpus, load_manifest
+from module_evaluator import Error_Analysis_Evaluator
+from prompts.prompts import TEMPLATE_POSTEDIT, TEMPLATE_VERIFIER, TEMPLATE_VERIFIER_LISTWISE
+from records import Corpus, SEVERITIES, request_segment
+from main import module_configs
+from utils import load_yaml, read_json, readlines_txt, save_json
+
+POOLED = '*'
+STAGES = ('evaluator', 'ape', 'verifier')
+DEFAULT_HISTORY = osp.join(osp.dirname(osp.abspath(__file__)), 'test/outs/llm_verifier')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="Path of configuration yaml.")
+    parser.add_argument("--src", type=str, default=None, help="Path of src.")
+    parser.add_argument("--tgt", type=str, default=None, help="Path of tgt.")
+    parser.add_argument("--srclang", type=str, default=None, help="Source Language, such as English, German, Chinese.")
+    parser.add_argument("--tgtlang", type=str, default=None, help="Target Language, such as English, German, Chinese.")
+    parser.add_argument("--manifest", type=str, default=None, help="YAML/JSONL list of (system, lp, src, tgt) jobs planned as one run.")
+    parser.add_argument("--history", type=str, nargs='*', default=[DEFAULT_HISTORY],
+                        help="Directories of earlier runs with results.json and saved llm responses.")
+    parser.add_argument("--prefill_tps", type=float, default=20000, help="Prompt tokens per second of an engine.")
+    parser.add_argument("--decode_tps", type=float, default=1500, help="Generated tokens per second of an engine.")
+    parser.add_argument("--profile", type=str, default=None, help="YAML of prefill_tps / decode_tps per engine name.")
+    parser.add_argument("--metric_verifier", action="store_true", default=False, help="Whether the verifier is cometkiwi (no LLM calls).")
+    parser.add_argument("--lazy_verify", action="store_true", default=False, help="Whether the run verifies lazily; the plan is then an upper bound.")
+    parser.add_argument("--out", type=str, default=None, help="Path of the plan JSON.")
+
+    args = parser.parse_args()
+    if args.manifest is None and None in (args.src, args.tgt, args.srclang, args.tgtlang):
+        parser.error("--src, --tgt, --srclang and --tgtlang are required without --manifest.")
+    return args
+
+
+def num_text_tokens(prompt_engine, text: str) -> int:
+    return len(prompt_engine.tokenizer.encode(text, add_special_tokens=False))
+
+
+def collect_stats(history: List[str], prompt_engines: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """
+    statistics of earlier runs per language pair ("Chinese-English") and pooled (POOLED).
+    Responses are attributed to a segment by request_id; responses saved without one count
+    for the language pair of the run when it has a single one, else only for the pooled stats.
+    Generated tokens are those of the raw responses, run-on text included.
+    """
+    totals = {}
+
+    def add(lp: str, key: str, value: float) -> None:
+        for _lp in {lp, POOLED}:
+            stats = totals.setdefault(_lp, {})
+            stats[key] = stats.get(key, 0) + value
+
+    for run_dir in history:
+        results_path = osp.join(run_dir, 'results.json')
+        if osp.exists(results_path) is False:
+            print(f"[WARNING] No results.json in {run_dir}, skipped.")
+            continue
+
+        results = read_json(results_path)
+        lps = [f"{result['source_lang']}-{result['target_lang']}" for result in results]
+        for result, lp in zip(results, lps):
+            errors = [error for severity in SEVERITIES for error in result['error_dict'].get(severity, [])]
+            add(lp, 'segments', 1)
+            add(lp, 'segments_with_errors', len(errors) > 0)
+            add(lp, 'segments_with_one_error', len(errors) == 1)
+            for severity in SEVERITIES:
+                add(lp, f'{severity}_errors', len(result['error_dict'].get(severity, [])))
+            for error in errors:
+                add(lp, 'error_tokens', num_text_tokens(prompt_engines['ape'], f"{error['category']} - {error['span']}"))
+                add(lp, 'error_target_tokens', num_text_tokens(prompt_engines['ape'], result['target_seg']))
+
+        run_lp = lps[0] if len(set(lps)) == 1 else POOLED
+        for stage in STAGES:
+            responses_path = osp.join(run_dir, f'llm_responses_{stage}.json')
+            if osp.exists(responses_path) is False:
+                continue
+            for response in read_json(responses_path):
+                lp = run_lp
+                try:
+                    seg_id = request_segment(response.get('request_id'))
+                    if ':pack:' not in response['request_id'] and seg_id < len(lps):
+                        lp = lps[seg_id]
+                except (AttributeError, TypeError, ValueError):
+                    pass
+                add(lp, f'{stage}_requests', 1)
+                add(lp, f'{stage}_generated_tokens', num_text_tokens(prompt_engines[stage], response['generated_text']))
+
+    return totals
+
+
+def lp_stats(totals: Dict[str, Dict[str, float]], lp: str) -> Dict[str, float]:
+    """per-segment / per-request rates of a language pair, pooled when it has no history."""
+    stats = totals.get(lp) if lp in totals else totals.get(POOLED, {})
+    segments = stats.get('segments', 0)
+    num_errors = sum(stats.get(f'{severity}_errors', 0) for severity in SEVERITIES)
+    rate = lambda key, count: stats.get(key, 0) / count if count > 0 else None
+
+    return {
+        'source': lp if lp in totals else POOLED,
+        'segments': segments,
+        'errors_per_segment': {severity: rate(f'{severity}_errors', segments) or 0 for severity in SEVERITIES},
+        'segments_with_errors': rate('segments_with_errors', segments) or 0,
+        'segments_with_one_error': rate('segments_with_one_error', segments) or 0,
+        'error_tokens': rate('error_tokens', num_errors) or 0,
+        'ape_target_ratio': rate('ape_generated_tokens', stats.get('error_target_tokens', 0)),
+        **{f'{stage}_generated_tokens': rate(f'{stage}_generated_tokens', stats.get(f'{stage}_requests', 0)) for stage in STAGES},
+    }
+
+
+class Planner():
+
+    def __init__(self,
+                 configs: Dict[Any, Any],
+                 verifier_type: str='llm',
+                 history: List[str]=None,
+                 profile: Dict[str, Dict[str, float]]=None):
+
+        self.configs = configs
+        self.verifier_type = verifier_type
+        self.profile = profile or {}
+        self.engine_pool = EnginePool(configs) # engine configs only, nothing is loaded
+
+        # one tokenizer / prompt engine per distinct engine config
+        prompt_engines, self.stage_engines, self.prompt_engines = {}, {}, {}
+        for stage in STAGES:
+            engine_name = configs[stage].get('engine') or 'default'
+            key = self.engine_pool.engine_key(engine_name)
+            if key not in prompt_engines:
+                print(f"[INFO] Loading tokenizer of engine {engine_name}: {self.engine_pool.engine_configs[engine_name].get('model_path')}")
+                prompt_engines[key] = build_prompt_engine(self.engine_pool.engine_configs[engine_name])
+            self.stage_engines[stage] = engine_name
+            self.prompt_engines[stage] = prompt_engines[key]
+
+        self.evaluator_module = Error_Analysis_Evaluator(self.prompt_engines['evaluator'], **module_configs(configs['evaluator'], 'engine'))
+        self.totals = collect_stats(history or [], self.prompt_engines)
+        if POOLED not in self.totals:
+            print("[WARNING] No history: evaluator responses are planned at max_tokens, APE and verifier without fan-out.")
+
+
+    def prompt_tokens(self, stage: str, template, inputs: List[Dict[str, str]]) -> List[int]:
+        prompt_engine = self.prompt_engines[stage]
+        return [prompt_engine.num_tokens(prompt) for prompt in prompt_engine.build_prompts(template, inputs)]
+
+
+    def plan_evaluator(self, corpus: Corpus) -> Dict[str, float]:
+        """exact prompts of packed and single-segment requests; generated tokens from history."""
+        evaluator = self.evaluator_module
+        packs = evaluator.packs(corpus) if evaluator.pack_size > 1 else [[seg_id] for seg_id in range(len(corpus.segments))]
+        packed = [pack for pack in packs if len(pack) > 1]
+        singles = [pack[0] for pack in packs if len(pack) == 1]
+
+        prompt_tokens = [self.prompt_engines['evaluator'].num_tokens(prompt) for prompt in
+                         evaluator.build_prompts([evaluator.packed_fields(corpus, pack) for pack in packed], packed=True)]
+        prompt_tokens += [self.prompt_engines['evaluator'].num_tokens(prompt) for prompt in
+                          evaluator.build_prompts([corpus.segment_fields(seg_id) for seg_id in singles])]
+
+        generated_tokens = 0
+        for pack in packs:
+            per_segment = [lp_stats(self.totals, corpus.lang_pair(seg_id))['evaluator_generated_tokens'] for seg_id in pack]
+            per_segment = [evaluator.max_tokens if tokens is None else tokens for tokens in per_segment]
+            generated_tokens += min(sum(per_segment), evaluator.max_tokens * len(pack))
+
+        budget = prompt_budget(self.prompt_engines['evaluator'], evaluator.max_prompt_tokens, evaluator.max_tokens)
+        return {
+            'requests': len(prompt_tokens),
+            'prompt_tokens': sum(prompt_tokens),
+            'generated_tokens': generated_tokens * evaluator.num_samples,
+            'over_budget': 0 if budget is None else sum(tokens > budget for tokens in prompt_tokens),
+        }
+
+
+    def plan_ape(self, corpus: Corpus) -> Dict[str, float]:
+        """one request per expected error, with the error of its average length."""
+        requests = prompt_tokens = generated_tokens = 0
+        fields = [{**corpus.segment_fields(seg_id), 'error_category': '', 'error_content': ''} for seg_id in range(len(corpus.segments))]
+        base_tokens = self.prompt_tokens('ape', TEMPLATE_POSTEDIT, fields)
+
+        for seg_id, tokens in enumerate(base_tokens):
+            stats = lp_stats(self.totals, corpus.lang_pair(seg_id))
+            num_errors = sum(stats['errors_per_segment'].values())
+            target_tokens = num_text_tokens(self.prompt_engines['ape'], fields[seg_id]['target_seg'])
+            requests += num_errors
+            prompt_tokens += num_errors * (tokens + stats['error_tokens'])
+            generated_tokens += num_errors * min(target_tokens * (stats['ape_target_ratio'] or 1), self.configs['ape'].get('max_tokens', 512))
+
+        return {'requests': requests, 'prompt_tokens': prompt_tokens, 'generated_tokens': generated_tokens}
+
+
+    def plan_verifier(self, corpus: Corpus) -> Dict[str, float]:
+        """
+        pairwise: one request per expected error and ordering, listwise: one per segment with
+        errors and ordering (one for a single error), each candidate costing the tokens of one
+        more translation. Post-edits
+        are planned at the length of the target.
+        """
+        config = self.configs['verifier']
+        num_orders = 2 if config.get('use_twice_verify', True) is True else 1
+        listwise = config.get('listwise', False) is True
+        fields = [corpus.segment_fields(seg_id) for seg_id in range(len(corpus.segments))]
+
+        if listwise:
+            base_tokens = self.prompt_tokens('verifier', TEMPLATE_VERIFIER_LISTWISE, [{**_fields, 'candidates': ''} for _fields in fields])
+        else:
+            base_tokens = self.prompt_tokens('verifier', TEMPLATE_VERIFIER,
+                                             [{**_fields, 'transA_seg': _fields['target_seg'], 'transB_seg': _fields['target_seg']} for _fields in fields])
+
+        requests = prompt_tokens = generated_tokens = 0
+        for seg_id, tokens in enumerate(base_tokens):
+            stats = lp_stats(self.totals, corpus.lang_pair(seg_id))
+            num_errors = sum(stats['errors_per_segment'].values())
+            per_request = stats['verifier_generated_tokens'] or config.get('max_tokens', 256)
+            if listwise:
+                candidate_tokens = num_text_tokens(self.prompt_engines['verifier'], f'1. "{fields[seg_id]["target_seg"]}"\n')
+                seg_requests = stats['segments_with_errors'] * num_orders - stats['segments_with_one_error'] * (num_orders - 1)
+                prompt_tokens += seg_requests * tokens + (num_errors * num_orders - stats['segments_with_one_error'] * (num_orders - 1)) * candidate_tokens
+            else:
+                seg_requests = num_errors * num_orders
+                prompt_tokens += seg_requests * tokens
+            requests += seg_requests
+            generated_tokens += seg_requests * per_request
+
+        return {'requests': requests, 'prompt_tokens': prompt_tokens, 'generated_tokens': generated_tokens}
+
+
+    def plan(self, corpus: Corpus) -> Dict[str, Any]:
+        stages = {'evaluator': self.plan_evaluator(corpus), 'ape': self.plan_ape(corpus)}
+        if self.verifier_type == 'llm':
+            stages['verifier'] = self.plan_verifier(corpus)
+
+        for stage, costs in stages.items():
+            engine_name = self.stage_engines[stage]
+            profile = self.profile.get(engine_name, self.profile.get('default', {}))
+            tp = self.engine_pool.engine_configs[engine_name].get('tp', 1)
+            seconds = costs['prompt_tokens'] / profile['prefill_tps'] + costs['generated_tokens'] / profile['decode_tps']
+            costs.update({'engine': engine_name, 'gpu_hours': seconds * tp / 3600})
+
+        lps = sorted({corpus.lang_pair(seg_id) for seg_id in range(len(corpus.segments))})
+        return {
+            'segments': len(corpus.segments),
+            'stages': stages,
+            'total': {key: sum(costs[key] for costs in stages.values()) for key in ('requests', 'prompt_tokens', 'generated_tokens', 'gpu_hours')},
+            'stats': {lp: lp_stats(self.totals, lp) for lp in lps},
+            'not_modelled': self.not_modelled(stages),
+        }
+
+
+    def not_modelled(self, stages: Dict[str, Dict[str, float]]) -> List[str]:
+        """features of the config that the plan leaves out."""
+        features = []
+        if any((self.configs[stage].get('retries') or 0) > 0 for stage in stages):
+            features.append('retries')
+        if stages['evaluator']['over_budget'] > 0:
+            features.append('chunking')
+        if self.configs.get('triage'):
+            features.append('triage')
+        return features
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    configs = load_yaml(args.config)
+    profile = load_yaml(args.profile) if args.profile is not None else {}
+    profile.setdefault('default', {'prefill_tps': args.prefill_tps, 'decode_tps': args.decode_tps})
+
+    if args.manifest is not None:
+        corpus, _ = build_corpus(load_manifest(args.manifest)[0])
+    else:
+        corpus = Corpus.from_texts(readlines_txt(args.src), readlines_txt(args.tgt), args.srclang, args.tgtlang)
+
+    planner = Planner(configs, 'llm' if args.metric_verifier is False else 'metric', args.history, profile)
+    plan = planner.plan(corpus)
+    plan['upper_bound'] = args.lazy_verify # lazy verification skips errors of clamped segments
+
+    for lp, stats in plan['stats'].items():
+        print(f"[INFO] {lp} (stats of {stats['source']}, {stats['segments']} segments): "
+              f"{sum(stats['errors_per_segment'].values()):.2f} errors per segment, "
+              f"{stats['segments_with_errors']:.0%} of segments with errors.")
+    for stage, costs in {**plan['stages'], 'total': {**plan['total'], 'engine': '-'}}.items():
+        print(f"[INFO] {stage:<9} engine {costs['engine']:<8} {costs['requests']:>10.1f} requests "
+              f"{costs['prompt_tokens']:>12.0f} prompt / {costs['generated_tokens']:>10.0f} generated tokens "
+              f"{costs['gpu_hours']:>8.4f} GPU-hours")
+    if args.lazy_verify is True:
+        print("[INFO] Lazy verification skips errors of clamped segments, APE and verifier costs are upper bounds.")
+    if 'retries' in plan['not_modelled']:
+        print("[WARNING] Retries are not modelled, re-queried requests are not counted.")
+    if 'chunking' in plan['not_modelled']:
+        print(f"[WARNING] Chunking is not modelled, {plan['stages']['evaluator']['over_budget']} evaluator prompts over the "
+              f"prompt budget are planned whole.")
+    if 'triage' in plan['not_modelled']:
+        print("[WARNING] QE triage is not modelled, all segments are planned through the LLM pipeline, costs are upper bounds.")
+
+    if args.out is not None:
+        save_json(plan, args.out)
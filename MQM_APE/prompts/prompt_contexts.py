@@ -51,12 +51,27 @@ style/awkward - "etc.,"
         },
 }
 
+# GEMBA_MQM prompt annotating several segments at once, answered with numbered sections
+GEMBA_MQM_PACKED_SEGMENT_PROMPT = """Segment {index}:
+{source_lang} source:
+```{source_seg}```
+{target_lang} translation:
+```{target_seg}```"""
+GEMBA_MQM_PACKED_INPUT_PROMPT = """{segments}
+
+Based on the source segments and machine translations surrounded with triple backticks, identify error types in each translation and classify them. The categories of errors are: accuracy (addition, mistranslation, omission, untranslated text), fluency (character encoding, grammar, inconsistency, punctuation, register, spelling), style (awkward), terminology (inappropriate for context, inconsistent use), non-translation, other, or no-error.\nEach error is classified as one of three categories: critical, major, and minor. Critical errors inhibit comprehension of the text. Major errors disrupt the flow, but what the text is trying to say is still understandable. Minor errors are technically errors, but do not disrupt the flow or hinder comprehension.\nAnnotate each of the {num_segments} translations separately, starting with a line "Segment N:"."""
+
 # PostEdit Prompt
 POST_EDIT_INPUT_PROMPT = '{source_lang} source: "{source_seg}"\n{target_lang} translation: "{target_seg}"\nPlease post-edit the translation to address the identified error: "{error_category} - {error_content}". Provide only the corrected {target_lang} translation after "Corrected Translation:" without adding any additional explanations or translation information.'
 
 # Pairwise Verifier Prompt
 VERIFIER_PAIRWISE_SELECT_PROMPT = '{source_lang} source: "{source_seg}"\nEvaluate the following translations:\n{target_lang} translation A: "{transA_seg}"\n{target_lang} translation B: "{transB_seg}"\nWhich translation is better? Please output either "A" or "B" only, without any additional explanation.\n\nAnswer:'
 
+# Listwise Verifier Prompt
+VERIFIER_LISTWISE_SELECT_PROMPT = '{source_lang} source: "{source_seg}"\n{target_lang} original translation: "{target_seg}"\nEvaluate the following candidate translations:\n{candidates}\nIs each candidate better or worse than the original translation? Please output one line per candidate in the form "1: better" or "1: worse", without any additional explanation.\n\nAnswer:'
 
-
-
+# Format reminders appended when a malformed response is re-queried
+GEMBA_MQM_RETRY_REMINDER = 'Reminder: answer only in the format of the examples. Start each severity with a line "Critical:", "Major:" or "Minor:", followed by one line per error in the form: category - "error span", or "no-error".'
+POST_EDIT_RETRY_REMINDER = 'Reminder: the answer must not be empty. Output one line "Corrected Translation: " followed by the full corrected translation.'
+VERIFIER_PAIRWISE_RETRY_REMINDER = 'Reminder: output exactly one letter, "A" or "B".'
+VERIFIER_LISTWISE_RETRY_REMINDER = 'Reminder: output exactly one line for every candidate, each in the form "N: better" or "N: worse".'
@@ -2,8 +2,15 @@ from .prompt_contexts import (
     GEMBA_MQM_INPUT_PROMPT, 
     GEMBA_MQM_SYSTEM_PROMPT, 
     GEMBA_MQM_FEW_SHOTS_PROMPT,
+    GEMBA_MQM_PACKED_SEGMENT_PROMPT,
+    GEMBA_MQM_PACKED_INPUT_PROMPT,
     POST_EDIT_INPUT_PROMPT,
-    VERIFIER_PAIRWISE_SELECT_PROMPT
+    VERIFIER_PAIRWISE_SELECT_PROMPT,
+    VERIFIER_LISTWISE_SELECT_PROMPT,
+    GEMBA_MQM_RETRY_REMINDER,
+    POST_EDIT_RETRY_REMINDER,
+    VERIFIER_PAIRWISE_RETRY_REMINDER,
+    VERIFIER_LISTWISE_RETRY_REMINDER
 )
 
 def simple_query(prompt: str):
@@ -48,6 +55,54 @@ TEMPLATE_GEMBA_MQM_FEWSHOT = gemba_mqm_fewshot([GEMBA_MQM_FEW_SHOTS_PROMPT['ende
                                                 GEMBA_MQM_FEW_SHOTS_PROMPT['encs'], 
                                                 GEMBA_MQM_FEW_SHOTS_PROMPT['zhen']])
 
+# several segments per prompt, the few shots are packed into one demonstration
+def gemba_mqm_packed_fewshot(few_shots):
+    prompts = [
+        {
+            "role": "system",
+            "content": GEMBA_MQM_SYSTEM_PROMPT
+        }
+    ]
+
+    if len(few_shots) > 0:
+        segments = '\n\n'.join(GEMBA_MQM_PACKED_SEGMENT_PROMPT.format(index=idx + 1, **shot) for idx, shot in enumerate(few_shots))
+        answer = ''.join(f"Segment {idx + 1}:\n{shot['answer']}" for idx, shot in enumerate(few_shots))
+
+        prompts.append({
+            "role": "user",
+            "content": GEMBA_MQM_PACKED_INPUT_PROMPT.format(segments=segments, num_segments=len(few_shots))
+        })
+        prompts.append({
+            "role": "assistant",
+            "content": answer
+        })
+
+    prompts.append({
+            "role": "user",
+            "content": GEMBA_MQM_PACKED_INPUT_PROMPT
+        })
+
+    return prompts
+
+TEMPLATE_GEMBA_MQM_PACKED_FEWSHOT = gemba_mqm_packed_fewshot([GEMBA_MQM_FEW_SHOTS_PROMPT['ende'], 
+                                                              GEMBA_MQM_FEW_SHOTS_PROMPT['encs'], 
+                                                              GEMBA_MQM_FEW_SHOTS_PROMPT['zhen']])
+
 # postedit
 TEMPLATE_POSTEDIT = simple_query(POST_EDIT_INPUT_PROMPT)
-TEMPLATE_VERIFIER = simple_query(VERIFIER_PAIRWISE_SELECT_PROMPT)
\ No newline at end of file
+TEMPLATE_VERIFIER = simple_query(VERIFIER_PAIRWISE_SELECT_PROMPT)
+TEMPLATE_VERIFIER_LISTWISE = simple_query(VERIFIER_LISTWISE_SELECT_PROMPT)
+
+# re-query of malformed responses: the last turn ends with a format reminder, before a trailing "Answer:"
+def with_reminder(template, reminder: str):
+    content = template[-1]['content']
+    if content.endswith('\n\nAnswer:'):
+        content = content[:-len('\n\nAnswer:')] + f"\n{reminder}\n\nAnswer:"
+    else:
+        content = f"{content}\n{reminder}"
+    return template[:-1] + [{**template[-1], 'content': content}]
+
+TEMPLATE_GEMBA_MQM_FEWSHOT_RETRY = with_reminder(TEMPLATE_GEMBA_MQM_FEWSHOT, GEMBA_MQM_RETRY_REMINDER)
+TEMPLATE_POSTEDIT_RETRY = with_reminder(TEMPLATE_POSTEDIT, POST_EDIT_RETRY_REMINDER)
+TEMPLATE_VERIFIER_RETRY = with_reminder(TEMPLATE_VERIFIER, VERIFIER_PAIRWISE_RETRY_REMINDER)
+TEMPLATE_VERIFIER_LISTWISE_RETRY = with_reminder(TEMPLATE_VERIFIER_LISTWISE, VERIFIER_LISTWISE_RETRY_REMINDER)
\ No newline at end of file
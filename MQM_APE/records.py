@@ -0,0 +1,315 @@
+"""
+Compact record model of a corpus flowing through evaluator, APE and verifier.
+
+Strings (languages, segments, categories, spans, post-edits) are stored once in a StringPool
+and referred to by index. Segments and errors are slotted records; the errors of a segment are
+stored contiguously (critical, major, then minor). Dicts in today's JSON shape are only built
+at the output boundary, or transiently as template fields.
+"""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+SEVERITIES = ('critical', 'major', 'minor')
+
+PRIORITIES = ('interactive', 'batch') # scheduling lanes, lower index is served first
+
+
+def request_id(seg_id: int, severity: str, index: int, order: int=0) -> str:
+    """
+    stable id of an error-level request: segment, severity, error index within the severity,
+    and ordering (0: target vs. post-edit, 1: swapped, for verifying twice).
+    """
+    return f"{seg_id}:{severity}:{index}:{order}"
+
+
+def parse_request_id(rid: str) -> Tuple[int, str, int, int]:
+    seg_id, severity, index, order = rid.split(':')
+    return int(seg_id), severity, int(index), int(order)
+
+
+def segment_request_id(seg_id: int) -> str:
+    """stable id of a segment-level (evaluator) request."""
+    return str(seg_id)
+
+
+def packed_request_id(seg_ids: List[int]) -> str:
+    """stable id of an evaluator request packing consecutive segments seg_ids."""
+    return f"{seg_ids[0]}:pack:{seg_ids[-1]}"
+
+
+def chunk_request_id(seg_id: int, chunk: int) -> str:
+    """stable id of an evaluator request annotating a sentence chunk of an over-budget segment."""
+    return f"{seg_id}:chunk:{chunk}"
+
+
+def request_segment(rid: str) -> int:
+    """segment of a segment-level or error-level request id."""
+    return int(rid.split(':', 1)[0])
+
+
+def index_responses(outputs: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """route responses by request_id. Retried completions come later and replace earlier ones."""
+    return {_output['request_id']: _output for _output in outputs if 'request_id' in _output}
+
+
+class StringPool():
+
+    __slots__ = ('strings', 'index')
+
+    def __init__(self) -> None:
+        self.strings = []
+        self.index = {}
+
+    def add(self, text: str) -> int:
+        idx = self.index.get(text)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings.append(text)
+            self.index[text] = idx
+        return idx
+
+    def __getitem__(self, idx: int) -> str:
+        return self.strings[idx]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+class Segment():
+    """
+    string fields are StringPool indices; errors are corpus.errors[error_begin:error_end].
+    priority indexes PRIORITIES and is carried to every request of the segment.
+    triage is 'good' or 'bad' for segments given a default outcome by QE triage, None otherwise.
+    over_budget marks segments with a sentence whose prompt is over the token budget of a stage.
+    """
+
+    __slots__ = ('source_lang', 'source_seg', 'target_lang', 'target_seg',
+                 'error_begin', 'error_end', 'cometkiwi_score', 'priority', 'triage', 'over_budget')
+
+    def __init__(self, source_lang: int, source_seg: int, target_lang: int, target_seg: int, priority: int=0) -> None:
+        self.source_lang = source_lang
+        self.source_seg = source_seg
+        self.target_lang = target_lang
+        self.target_seg = target_seg
+        self.error_begin = 0
+        self.error_end = 0
+        self.cometkiwi_score = None
+        self.priority = priority
+        self.triage = None
+        self.over_budget = False
+
+
+class Error():
+    """severity indexes SEVERITIES; category, span and post_edit are StringPool indices."""
+
+    __slots__ = ('segment', 'severity', 'category', 'span', 'post_edit',
+                 'pe_valid_score', 'postedit_cometkiwi_score', 'skipped')
+
+    def __init__(self, segment: int, severity: int, category: int, span: int) -> None:
+        self.segment = segment
+        self.severity = severity
+        self.category = category
+        self.span = span
+        self.post_edit = None
+        self.pe_valid_score = None
+        self.postedit_cometkiwi_score = None
+        self.skipped = False
+
+
+class Corpus():
+
+    def __init__(self) -> None:
+        self.pool = StringPool()
+        self.segments: List[Segment] = []
+        self.errors: List[Error] = []
+        self.error_chunks: Dict[int, Tuple[str, int, int]] = {} # source chunk and target offsets of errors post-edited in a chunk
+
+
+    @classmethod
+    def from_texts(cls, srcs: List[str], tgts: List[str], src_lang: str, tgt_lang: str) -> 'Corpus':
+        corpus = cls()
+        for src, tgt in zip(srcs, tgts):
+            corpus.add_segment(src_lang, src.strip(), tgt_lang, tgt.strip())
+        return corpus
+
+
+    @classmethod
+    def from_dicts(cls,
+                   sample_inputs: List[Dict[str, Any]],
+                   errors: Optional[List[Dict[str, List[Dict[str, Any]]]]]=None) -> 'Corpus':
+        """build from sample inputs and error dicts in the JSON shape."""
+        corpus = cls()
+        for seg_id, sample_input in enumerate(sample_inputs):
+            corpus.add_segment(sample_input['source_lang'], sample_input['source_seg'],
+                               sample_input['target_lang'], sample_input['target_seg'])
+            corpus.segments[seg_id].cometkiwi_score = sample_input.get('cometkiwi_score')
+            corpus.segments[seg_id].triage = sample_input.get('triage')
+            corpus.segments[seg_id].over_budget = sample_input.get('over_budget', False)
+            if errors is not None:
+                corpus.add_errors(seg_id, errors[seg_id])
+        return corpus
+
+
+    def add_segment(self, source_lang: str, source_seg: str, target_lang: str, target_seg: str, priority: int=0) -> int:
+        pool = self.pool
+        self.segments.append(Segment(pool.add(source_lang), pool.add(source_seg), pool.add(target_lang), pool.add(target_seg), priority))
+        return len(self.segments) - 1
+
+
+    def add_errors(self, seg_id: int, error_dict: Dict[str, List[Dict[str, Any]]]) -> None:
+        """
+        append the errors of a segment, replacing errors it had before.
+        error entries may already carry post_edit / pe_valid_score / postedit_cometkiwi_score / skipped.
+        """
+        segment = self.segments[seg_id]
+        segment.error_begin = len(self.errors)
+        for severity_id, severity in enumerate(SEVERITIES):
+            for _error in error_dict[severity]:
+                error = Error(seg_id, severity_id, self.pool.add(_error['category']), self.pool.add(_error['span']))
+                if _error.get('post_edit') is not None:
+                    error.post_edit = self.pool.add(_error['post_edit'])
+                error.pe_valid_score = _error.get('pe_valid_score')
+                error.postedit_cometkiwi_score = _error.get('postedit_cometkiwi_score')
+                error.skipped = _error.get('skipped', False)
+                self.errors.append(error)
+        segment.error_end = len(self.errors)
+
+
+    def segment_errors(self, seg_id: int) -> range:
+        segment = self.segments[seg_id]
+        return range(segment.error_begin, segment.error_end)
+
+
+    def iter_error_ids(self, severity: Optional[str]=None, seg_ids: Optional[Iterable[int]]=None) -> Iterator[int]:
+        """error ids in segment order, optionally restricted to a severity and to segments."""
+        seg_ids = range(len(self.segments)) if seg_ids is None else seg_ids
+        severity_id = None if severity is None else SEVERITIES.index(severity)
+        for seg_id in seg_ids:
+            for error_id in self.segment_errors(seg_id):
+                if severity_id is None or self.errors[error_id].severity == severity_id:
+                    yield error_id
+
+
+    def request_id(self, error_id: int, order: int=0) -> str:
+        error = self.errors[error_id]
+        index = 0
+        while error_id - index - 1 >= self.segments[error.segment].error_begin \
+                and self.errors[error_id - index - 1].severity == error.severity:
+            index += 1
+        return request_id(error.segment, SEVERITIES[error.severity], index, order)
+
+
+    def error_id(self, rid: str) -> Optional[int]:
+        """error id of a request id, None if the corpus has no such error."""
+        seg_id, severity, index, _ = parse_request_id(rid)
+        if seg_id >= len(self.segments) or severity not in SEVERITIES:
+            return None
+        severity_ids = list(self.iter_error_ids(severity, [seg_id]))
+        return severity_ids[index] if index < len(severity_ids) else None
+
+
+    def request_priorities(self, request_ids: Iterable[str]) -> List[int]:
+        """priority of each request, that of its segment."""
+        return [self.segments[request_segment(rid)].priority for rid in request_ids]
+
+
+    def set_post_edit(self, error_id: int, post_edit: str) -> None:
+        self.errors[error_id].post_edit = self.pool.add(post_edit)
+
+
+    def lang_pair(self, seg_id: int) -> str:
+        segment = self.segments[seg_id]
+        return f"{self.pool[segment.source_lang]}-{self.pool[segment.target_lang]}"
+
+
+    def segment_fields(self, seg_id: int) -> Dict[str, str]:
+        """template fields of a segment: source_lang, source_seg, target_lang, target_seg."""
+        segment, pool = self.segments[seg_id], self.pool
+        return {
+            'source_lang': pool[segment.source_lang],
+            'source_seg': pool[segment.source_seg],
+            'target_lang': pool[segment.target_lang],
+            'target_seg': pool[segment.target_seg],
+        }
+
+
+    def error_fields(self, error_id: int) -> Dict[str, str]:
+        """template fields of an error: segment fields with error_category and error_content."""
+        error = self.errors[error_id]
+        return {
+            **self.segment_fields(error.segment),
+            'error_category': self.pool[error.category],
+            'error_content': self.pool[error.span],
+        }
+
+
+    def post_edit(self, error_id: int) -> Optional[str]:
+        error = self.errors[error_id]
+        return None if error.post_edit is None else self.pool[error.post_edit]
+
+
+    def comparison_fields(self, error_id: int) -> Dict[str, str]:
+        """
+        segment fields of an error with its post_edit; errors post-edited in a sentence chunk
+        get the source chunk, and the target and post-edit of the chunk.
+        """
+        fields = {**self.segment_fields(self.errors[error_id].segment), 'post_edit': self.post_edit(error_id)}
+        if error_id in self.error_chunks and fields['post_edit'] is not None:
+            source_chunk, begin, end = self.error_chunks[error_id]
+            target, post_edit = fields['target_seg'], fields['post_edit']
+            fields.update(source_seg=source_chunk,
+                          target_seg=target[begin:end],
+                          post_edit=post_edit[begin:len(post_edit) - (len(target) - end)])
+        return fields
+
+
+    def error_json(self, error_id: int) -> Dict[str, Any]:
+        error = self.errors[error_id]
+        _error = {
+            'category': self.pool[error.category],
+            'span': self.pool[error.span],
+        }
+        if error.skipped is True:
+            _error.update({'post_edit': None, 'pe_valid_score': None, 'skipped': True})
+            return _error
+
+        if error.post_edit is not None:
+            _error['post_edit'] = self.pool[error.post_edit]
+        if error.postedit_cometkiwi_score is not None:
+            _error['postedit_cometkiwi_score'] = error.postedit_cometkiwi_score
+        if error.pe_valid_score is not None:
+            _error['pe_valid_score'] = error.pe_valid_score
+        return _error
+
+
+    def error_dict(self, seg_id: int) -> Dict[str, List[Dict[str, Any]]]:
+        error_dict = {severity: [] for severity in SEVERITIES}
+        for error_id in self.segment_errors(seg_id):
+            error_dict[SEVERITIES[self.errors[error_id].severity]].append(self.error_json(error_id))
+        return error_dict
+
+
+    def sample_input(self, seg_id: int) -> Dict[str, Any]:
+        sample_input = self.segment_fields(seg_id)
+        if self.segments[seg_id].cometkiwi_score is not None:
+            sample_input['cometkiwi_score'] = self.segments[seg_id].cometkiwi_score
+        if self.segments[seg_id].triage is not None:
+            sample_input['triage'] = self.segments[seg_id].triage
+        if self.segments[seg_id].over_budget is True:
+            sample_input['over_budget'] = True
+        return sample_input
+
+
+    def to_results(self,
+                   scores: Optional[List[float]]=None,
+                   seg_ids: Optional[Iterable[int]]=None) -> List[Dict[str, Any]]:
+        """serialize segments (all by default) into the results.json shape. scores follow seg_ids."""
+        seg_ids = range(len(self.segments)) if seg_ids is None else seg_ids
+        results = []
+        for idx, seg_id in enumerate(seg_ids):
+            result = self.sample_input(seg_id)
+            result['error_dict'] = self.error_dict(seg_id)
+            if scores is not None:
+                result['MQM_APE_score'] = scores[idx]
+            results.append(result)
+        return results
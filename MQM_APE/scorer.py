@@ -1,8 +1,13 @@
 import os
 import os.path as osp
-from typing import List, Dict, Literal
+from typing import Any, List, Dict, Literal
+from records import Corpus, SEVERITIES
 from utils import read_json, save_txt
 
+SEVERITY_WEIGHTS = {'critical': 25, 'major': 5, 'minor': 1}
+MIN_SCORE = -25
+
+
 class Scorer():
 
     def __init__(self,
@@ -16,22 +21,52 @@ class Scorer():
     def score(self, error_dict: List[Dict[str, Dict[str, str]]]) -> List[float]:
         
         if self.scorer_type == 'MQM':
-            num_of_critical = len(error_dict['critical'])
-            num_of_major = len(error_dict['major'])
-            num_of_minor = len(error_dict['minor'])
+            final_score = -sum(SEVERITY_WEIGHTS[severity] * len(error_dict[severity]) for severity in SEVERITIES)
 
-            final_score = -25 * num_of_critical - 5 * num_of_major - 1 * num_of_minor
-
-            return -25 if final_score < -25 else final_score
+            return MIN_SCORE if final_score < MIN_SCORE else final_score
         
         elif self.scorer_type == 'MQM-APE':
-            num_of_critical = sum([error['pe_valid_score'] for error in error_dict['critical']])
-            num_of_major = sum([error['pe_valid_score'] for error in error_dict['major']])
-            num_of_minor = sum([error['pe_valid_score'] for error in error_dict['minor']])
+            final_score = -sum(SEVERITY_WEIGHTS[severity] * sum([self.pe_valid_score(error) for error in error_dict[severity]])
+                               for severity in SEVERITIES)
+
+            return MIN_SCORE if final_score < MIN_SCORE else final_score
+
+    @staticmethod
+    def pe_valid_score(error: Dict[str, Any]) -> float:
+        """
+        verifier score of an error. Errors skipped by lazy verification carry
+        `pe_valid_score: None` and count as 0, which only happens once the clamp is reached.
+        """
+        score = error.get('pe_valid_score')
+        return 0 if score is None else score
+
+    def is_clamped(self, error_dict: Dict[str, List[Dict[str, Any]]]) -> bool:
+        """
+        whether the errors verified so far already push the score to the clamp.
+        pe_valid_score is never negative, so unverified errors can only lower the score further
+        and the final score is provably MIN_SCORE.
+        """
+        return self.score(error_dict) <= MIN_SCORE
+
+    def score_segment(self, corpus: Corpus, seg_id: int) -> float:
+        """score a segment of the record model, same as score(corpus.error_dict(seg_id))."""
+        final_score = 0
+        for error_id in corpus.segment_errors(seg_id):
+            error = corpus.errors[error_id]
+            weight = SEVERITY_WEIGHTS[SEVERITIES[error.severity]]
+            if self.scorer_type == 'MQM':
+                final_score -= weight
+            elif error.pe_valid_score is not None:
+                final_score -= weight * error.pe_valid_score
+
+        return MIN_SCORE if final_score < MIN_SCORE else final_score
 
-            final_score = -25 * num_of_critical -5 * num_of_major - 1 * num_of_minor
+    def score_corpus(self, corpus: Corpus) -> List[float]:
+        return [self.score_segment(corpus, seg_id) for seg_id in range(len(corpus.segments))]
 
-            return -25 if final_score < -25 else final_score
+    def is_segment_clamped(self, corpus: Corpus, seg_id: int) -> bool:
+        """is_clamped for a segment of the record model."""
+        return self.score_segment(corpus, seg_id) <= MIN_SCORE
         
 
 if __name__ == "__main__":
@@ -0,0 +1,361 @@
+"""
+Long-running MQM-APE scoring service with dynamic batching.
+
+The engine stays resident. Concurrent requests are queued and coalesced into one corpus per
+batch: a batch is closed when it holds max_batch_size segments, when a request has waited the
+window of its lane, or ahead of a request deadline. Each batch runs evaluator, APE and verifier once.
+
+Requests go to a lane, "interactive" (default) or "batch". Interactive segments are scheduled
+first, by earliest deadline, and carry their priority into every engine request of the three
+stages. Bulk requests are split into batch-sized chunks, so interactive traffic overtakes their
+remaining segments. Requests still queued after their deadline are dropped with 504.
+
+    POST /score    {"source_lang": "Chinese", "target_lang": "English",
+                    "priority": "interactive", "deadline_ms": 2000,
+                    "segments": [{"source": "...", "target": "..."}, ...]}
+                -> {"results": [{..., "error_dict": {...}, "MQM_APE_score": -1}, ...]}
+    GET /metrics   queue depth, batch sizes, and latency percentiles per lane
+    GET /health
+
+Run against the stand-in backend for testing:
+    python3 server.py --config ./configs/llmconfig_standin.yaml --port 8000
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from main import MQM_APE
+from records import PRIORITIES, Corpus
+from utils import load_yaml
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="Path of configuration yaml.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind.")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="Maximum number of segments per batch.")
+    parser.add_argument("--max_wait_ms", type=float, default=20.0, help="Maximum wait of an interactive request for its batch to fill.")
+    parser.add_argument("--batch_max_wait_ms", type=float, default=200.0, help="Maximum wait of a batch request for its batch to fill.")
+
+    parser.add_argument("--metric_verifier", action="store_true", default=False, help="Whether to replace verifier with cometkiwi.")
+    parser.add_argument("--lazy_verify", action="store_true", default=False, help="Whether to skip errors once the score is clamped.")
+
+    args = parser.parse_args()
+    return args
+
+
+def percentile(values: List[float], q: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ScoreRequest():
+    """
+    segments of one /score call. Bulk requests larger than a batch are scheduled in chunks;
+    segments before next_segment are already scheduled.
+    """
+
+    __slots__ = ('segments', 'priority', 'deadline', 'arrival', 'next_segment', 'num_scored',
+                 'done', 'results', 'error')
+
+    def __init__(self, segments: List[Dict[str, str]], priority: int=0, deadline: Optional[float]=None) -> None:
+        self.segments = segments # [{'source_lang', 'source_seg', 'target_lang', 'target_seg'}, ...]
+        self.priority = priority # index of PRIORITIES
+        self.deadline = deadline # absolute time.time(), None for no deadline
+        self.arrival = time.time()
+        self.next_segment = 0
+        self.num_scored = 0
+        self.done = threading.Event()
+        self.results = [None] * len(segments)
+        self.error = None
+
+    def schedule_key(self) -> Tuple[int, float, float]:
+        """lanes in order, earliest deadline first within a lane, then arrival."""
+        return (self.priority, self.deadline if self.deadline is not None else float('inf'), self.arrival)
+
+
+class DynamicBatcher():
+
+    def __init__(self,
+                 mqm_ape: MQM_APE,
+                 max_batch_size: int=64,
+                 max_wait_ms: float=20.0, # window of interactive requests
+                 batch_max_wait_ms: float=200.0, # window of batch requests
+                 metrics_window: int=1000):
+
+        self.mqm_ape = mqm_ape
+        self.max_batch_size = max_batch_size
+        self.max_wait = [max_wait_ms / 1000, batch_max_wait_ms / 1000] # by lane
+
+        self.queue: List[ScoreRequest] = []
+        self.queued_segments = 0
+        self.condition = threading.Condition()
+        self.batch_time = 0.0 # moving average of batch duration, to close batches before deadlines
+
+        # metrics
+        self.batch_sizes = deque(maxlen=metrics_window)
+        self.num_batches = 0
+        self.lane_metrics = [{
+            'latencies': deque(maxlen=metrics_window),
+            'num_requests': 0,
+            'num_expired': 0, # dropped in queue after their deadline
+            'num_late': 0, # scored after their deadline
+        } for _ in PRIORITIES]
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+
+    def submit(self,
+               segments: List[Dict[str, str]],
+               priority: int=0,
+               deadline: Optional[float]=None) -> List[Dict[str, Any]]:
+        """queue segments and block until they are scored."""
+        request = ScoreRequest(segments, priority, deadline)
+        if len(segments) == 0:
+            return []
+        with self.condition:
+            self.queue.append(request)
+            self.queued_segments += len(segments)
+            self.condition.notify()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+
+    def close_time(self) -> float:
+        """time to close the next batch: the earliest lane window or deadline (minus batch time) in queue."""
+        return min(min(request.arrival + self.max_wait[request.priority],
+                       request.deadline - self.batch_time if request.deadline is not None else float('inf'))
+                   for request in self.queue)
+
+
+    def finish(self, request: ScoreRequest, error: Optional[Exception]=None) -> None:
+        """release a waiting request and record its lane metrics."""
+        finish = time.time()
+        request.error = error
+        lane = self.lane_metrics[request.priority]
+        lane['num_requests'] += 1
+        if isinstance(error, DeadlineExceeded):
+            lane['num_expired'] += 1
+        elif error is None:
+            lane['latencies'].append(finish - request.arrival)
+            if request.deadline is not None and finish > request.deadline:
+                lane['num_late'] += 1
+        request.done.set()
+
+
+    def next_batch(self) -> List[Tuple[ScoreRequest, int, int]]:
+        """
+        wait until the batch is full or its window closes, then take segments in schedule order.
+        return: chunks (request, begin, end) of the batch.
+        Interactive segments take the batch first; bulk requests fill the rest chunk by chunk, so
+        their remaining segments queue behind interactive requests that arrive meanwhile.
+        """
+        with self.condition:
+            while True:
+                while len(self.queue) == 0:
+                    self.condition.wait()
+                while len(self.queue) > 0 and self.queued_segments < self.max_batch_size and time.time() < self.close_time():
+                    self.condition.wait(timeout=self.close_time() - time.time())
+
+                now = time.time()
+                for request in [request for request in self.queue if request.deadline is not None and request.deadline < now]:
+                    self.queue.remove(request)
+                    self.queued_segments -= len(request.segments) - request.next_segment
+                    if request.num_scored == request.next_segment: # no chunk in flight
+                        self.finish(request, DeadlineExceeded(f"Deadline passed before scoring {len(request.segments)} segments."))
+                    else:
+                        request.error = DeadlineExceeded("Deadline passed before scoring all segments.")
+                if len(self.queue) > 0:
+                    break
+
+            chunks, capacity = [], self.max_batch_size
+            for request in sorted(self.queue, key=ScoreRequest.schedule_key):
+                if capacity == 0:
+                    break
+                begin = request.next_segment
+                end = min(len(request.segments), begin + capacity)
+                chunks.append((request, begin, end))
+                request.next_segment = end
+                capacity -= end - begin
+                if end == len(request.segments):
+                    self.queue.remove(request)
+            self.queued_segments -= self.max_batch_size - capacity
+
+        return chunks
+
+
+    def score_batch(self, chunks: List[Tuple[ScoreRequest, int, int]]) -> None:
+        """score the chunks of a batch; any failure, from malformed segments to scoring, fails every request of the batch."""
+        batch_timer = time.time()
+        corpus = Corpus()
+        try:
+            chunk_results = []
+            for request, begin, end in chunks:
+                seg_begin = len(corpus.segments)
+                for segment in request.segments[begin:end]:
+                    corpus.add_segment(segment['source_lang'], segment['source_seg'],
+                                       segment['target_lang'], segment['target_seg'], request.priority)
+                chunk_results.append(range(seg_begin, len(corpus.segments)))
+
+            self.mqm_ape.eval_records(corpus)
+
+            for idx, seg_range in enumerate(chunk_results):
+                scores = [self.mqm_ape.scorer.score_segment(corpus, seg_id) for seg_id in seg_range]
+                chunk_results[idx] = corpus.to_results(scores, seg_range)
+            error = None
+        except Exception as batch_error: # report to every request of the batch, keep serving
+            error = batch_error
+
+        for idx, (request, begin, end) in enumerate(chunks):
+            if error is not None:
+                with self.condition:
+                    if request in self.queue: # drop the remaining chunks
+                        self.queue.remove(request)
+                        self.queued_segments -= len(request.segments) - request.next_segment
+                if request.done.is_set() is False:
+                    self.finish(request, error)
+                continue
+
+            request.results[begin:end] = chunk_results[idx]
+            request.num_scored += end - begin
+            if request.num_scored == len(request.segments):
+                self.finish(request)
+            elif request.num_scored == request.next_segment and request.error is not None: # expired meanwhile
+                self.finish(request, request.error)
+
+        self.num_batches += 1
+        self.batch_sizes.append(len(corpus.segments))
+        self.batch_time = 0.8 * self.batch_time + 0.2 * (time.time() - batch_timer)
+
+
+    def run(self) -> None:
+        while True:
+            self.score_batch(self.next_batch())
+
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.condition:
+            queue = list(self.queue)
+        batch_sizes = list(self.batch_sizes)
+
+        lanes = {}
+        for priority, lane in enumerate(PRIORITIES):
+            lane_queue = [request for request in queue if request.priority == priority]
+            latencies = list(self.lane_metrics[priority]['latencies'])
+            lanes[lane] = {
+                'queue_depth_requests': len(lane_queue),
+                'queue_depth_segments': sum(len(request.segments) - request.next_segment for request in lane_queue),
+                'num_requests': self.lane_metrics[priority]['num_requests'],
+                'num_expired': self.lane_metrics[priority]['num_expired'],
+                'num_late': self.lane_metrics[priority]['num_late'],
+                'latency_p50': percentile(latencies, 0.50),
+                'latency_p95': percentile(latencies, 0.95),
+                'latency_p99': percentile(latencies, 0.99),
+            }
+
+        return {
+            'queue_depth_requests': len(queue),
+            'queue_depth_segments': self.queued_segments,
+            'num_requests': sum(lane['num_requests'] for lane in self.lane_metrics),
+            'num_batches': self.num_batches,
+            'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) > 0 else 0.0,
+            'mean_batch_time': self.batch_time,
+            'lanes': lanes,
+            'stage_costs': self.mqm_ape.engines.cost_report(),
+        }
+
+
+def parse_priority(body: Dict[str, Any]) -> Tuple[int, Optional[float]]:
+    """request body to lane index and absolute deadline."""
+    priority = body.get('priority', PRIORITIES[0])
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority should be one of {PRIORITIES}.")
+    deadline_ms = body.get('deadline_ms')
+    return PRIORITIES.index(priority), None if deadline_ms is None else time.time() + float(deadline_ms) / 1000
+
+
+def parse_segments(body: Dict[str, Any]) -> List[Dict[str, str]]:
+    """request body to segments; languages may be given per request or per segment."""
+    segments = []
+    for segment in body['segments']:
+        segments.append({
+            'source_lang': segment.get('source_lang', body.get('source_lang')),
+            'source_seg': segment['source'].strip(),
+            'target_lang': segment.get('target_lang', body.get('target_lang')),
+            'target_seg': segment['target'].strip(),
+        })
+        if segments[-1]['source_lang'] is None or segments[-1]['target_lang'] is None:
+            raise ValueError("source_lang and target_lang are required.")
+    return segments
+
+
+def make_handler(batcher: DynamicBatcher):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, code: int, data: Dict[str, Any]) -> None:
+            payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, batcher.metrics())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                segments = parse_segments(body)
+                priority, deadline = parse_priority(body)
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {'error': f"Invalid request: {error}"})
+                return
+            try:
+                self.send_json(200, {'results': batcher.submit(segments, priority, deadline)})
+            except DeadlineExceeded as error:
+                self.send_json(504, {'error': str(error)})
+            except Exception as error:
+                self.send_json(500, {'error': str(error)})
+
+        def log_message(self, format, *args): # keep stdout for [INFO] logs
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    configs = load_yaml(args.config)
+    mqm_ape = MQM_APE(configs, 'llm' if args.metric_verifier is False else 'metric', args.lazy_verify)
+    batcher = DynamicBatcher(mqm_ape, args.max_batch_size, args.max_wait_ms, args.batch_max_wait_ms)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    print(f"[INFO] Serving MQM-APE on http://{args.host}:{args.port}")
+    server.serve_forever()
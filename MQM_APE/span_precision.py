@@ -0,0 +1,281 @@
+"""
+Error span precision against human MQM annotations: SP (all errors) and MP (major errors,
+critical included), per model, language pair, system and severity.
+
+Gold annotations are WMT MQM TSV files (system, doc, doc_id, seg_id, rater, source, target,
+category, severity), with each error span marked by <v>...</v> in the target. Spans of all
+raters are merged; "neutral" and "no-error" rows carry no error. Predicted spans of the
+error_dict of each results.json segment are located in target_seg with a multi-pattern
+(Aho-Corasick) matcher, at their first occurrence; spans missing from the target count as
+wrong. Precision is character-level: the share of predicted span characters covered by gold
+spans, looked up in an interval index of the merged gold spans of the segment.
+
+Each results file is scored twice: "MQM" counts every predicted error (GEMBA-MQM), "MQM-APE"
+weights each error by its pe_valid_score, as the MQM-APE score does. Results files are scored
+in parallel by a process pool. A spec YAML lists the gold files and the predictions:
+
+    gold:
+      en-de: /path/to/mqm_generalMT2022_ende.tsv
+    predictions: # results.json in segment order of the test set, e.g. `results` of manifest jobs
+      - {model: llama3-70b-inst, lp: en-de, system: Online-A, results: /path/to/en-de.Online-A.results.json}
+"""
+
+import argparse
+import csv
+import re
+from bisect import bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from records import SEVERITIES
+from scorer import Scorer
+from utils import load_yaml, read_json, save_json
+
+METHODS = ('MQM', 'MQM-APE')
+MAJOR_SEVERITIES = ('critical', 'major')
+GOLD_SEVERITIES = {'critical': 'critical', 'major': 'major', 'minor': 'minor'} # others (neutral, no-error) are no error
+
+_gold_cache: Dict[str, Dict[Tuple[str, int], Dict[str, Any]]] = {} # gold of each process, by path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spec", type=str, required=True, help="YAML with gold TSV files per lp and the predictions to score.")
+    parser.add_argument("--first_seg_id", type=int, default=1, help="Gold seg_id of the first segment of a results file.")
+    parser.add_argument("--workers", type=int, default=None, help="Processes scoring results files, one per CPU by default.")
+    parser.add_argument("--out", type=str, default=None, help="Path of the JSON report.")
+    return parser.parse_args()
+
+
+class AhoCorasick():
+    """multi-pattern matcher: the first occurrence of every pattern in one pass over a text."""
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[str]] = [[]]
+
+        for pattern in set(patterns):
+            if pattern == '':
+                continue
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(pattern)
+
+        # breadth-first failure links, outputs of the failure state are inherited
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def first_occurrences(self, text: str) -> Dict[str, int]:
+        """start offset of the first occurrence of each pattern found in text."""
+        found, state = {}, 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                if pattern not in found:
+                    found[pattern] = position - len(pattern) + 1
+        return found
+
+
+class IntervalIndex():
+    """merged, sorted [begin, end) intervals with covered-length queries by binary search."""
+
+    def __init__(self, intervals: Iterable[Tuple[int, int]]) -> None:
+        merged = []
+        for begin, end in sorted(interval for interval in intervals if interval[0] < interval[1]):
+            if merged and begin <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
+        self.begins = [begin for begin, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def overlap(self, begin: int, end: int) -> int:
+        """characters of [begin, end) covered by the intervals."""
+        covered = 0
+        idx = max(bisect_right(self.begins, begin) - 1, 0)
+        while idx < len(self.begins) and self.begins[idx] < end:
+            covered += max(0, min(end, self.ends[idx]) - max(begin, self.begins[idx]))
+            idx += 1
+        return covered
+
+
+def parse_marked_target(target: str) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """plain target and the [begin, end) offsets of the span marked with <v>...</v>, if any."""
+    match = re.search(r'<v>(.*?)</v>', target, flags=re.S)
+    plain = target.replace('<v>', '').replace('</v>', '')
+    if match is None:
+        return plain, None
+    begin = match.start()
+    return plain, (begin, begin + len(match.group(1)))
+
+
+def load_gold(path: str) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """
+    gold of a WMT MQM TSV file, keyed by (system, seg_id):
+    {'target': plain target, 'spans': {'critical' / 'major' / 'minor': [(begin, end), ...]}}
+    """
+    gold = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        for row in reader:
+            key = (row['system'], int(row['seg_id']))
+            target, span = parse_marked_target(row['target'])
+            segment = gold.setdefault(key, {'target': target, 'spans': {severity: [] for severity in SEVERITIES}})
+            severity = GOLD_SEVERITIES.get(row['severity'].strip().lower())
+            if severity is not None and span is not None:
+                segment['spans'][severity].append(span)
+    return gold
+
+
+def cached_gold(path: str) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    if path not in _gold_cache:
+        _gold_cache[path] = load_gold(path)
+    return _gold_cache[path]
+
+
+def locate_spans(target: str, spans: List[str]) -> Dict[str, int]:
+    """first offset of each predicted span in target, spans not found are left out."""
+    return AhoCorasick(spans).first_occurrences(target)
+
+
+def new_counts() -> Dict[str, float]:
+    """weighted predicted characters, of them covered by gold, and predicted spans not found in the target."""
+    return {'predicted_chars': 0.0, 'covered_chars': 0.0, 'spans': 0.0, 'unlocated_spans': 0.0}
+
+
+def score_predictions(prediction: Dict[str, Any], gold_path: str, first_seg_id: int=1) -> Dict[str, Any]:
+    """
+    counts of one results file, per method and group: 'SP' (all errors), 'MP' (major errors), and each predicted severity.
+    return: {'counts': {method: {group: counts}}, 'segments', 'misaligned'}
+    """
+    gold = cached_gold(gold_path)
+    results = read_json(prediction['results'])
+    counts = {method: defaultdict(new_counts) for method in METHODS}
+    num_segments = num_misaligned = 0
+
+    for idx, result in enumerate(results):
+        gold_segment = gold.get((prediction['system'], first_seg_id + idx))
+        if gold_segment is None or ' '.join(gold_segment['target'].split()) != ' '.join(result['target_seg'].split()):
+            num_misaligned += 1
+            continue
+        num_segments += 1
+
+        target = gold_segment['target']
+        gold_all = IntervalIndex(span for severity in SEVERITIES for span in gold_segment['spans'][severity])
+        gold_major = IntervalIndex(span for severity in MAJOR_SEVERITIES for span in gold_segment['spans'][severity])
+
+        errors = [(severity, error) for severity in SEVERITIES for error in result['error_dict'].get(severity, [])]
+        offsets = locate_spans(target, [error['span'] for _, error in errors])
+
+        for severity, error in errors:
+            span = error['span']
+            begin = offsets.get(span)
+            covered_all = gold_all.overlap(begin, begin + len(span)) if begin is not None else 0
+            covered_major = gold_major.overlap(begin, begin + len(span)) if begin is not None else 0
+
+            for method in METHODS:
+                weight = 1 if method == 'MQM' else Scorer.pe_valid_score(error)
+                groups = [('SP', covered_all), (severity, covered_all)]
+                if severity in MAJOR_SEVERITIES:
+                    groups.append(('MP', covered_major))
+                for group, covered in groups:
+                    group_counts = counts[method][group]
+                    group_counts['predicted_chars'] += weight * len(span)
+                    group_counts['covered_chars'] += weight * covered
+                    group_counts['spans'] += weight
+                    group_counts['unlocated_spans'] += weight * (begin is None)
+
+    return {
+        'counts': {method: dict(method_counts) for method, method_counts in counts.items()},
+        'segments': num_segments,
+        'misaligned': num_misaligned,
+    }
+
+
+def precision(counts: Dict[str, float]) -> Optional[float]:
+    return counts['covered_chars'] / counts['predicted_chars'] if counts['predicted_chars'] > 0 else None
+
+
+def merge_counts(scored: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    merged = {method: defaultdict(new_counts) for method in METHODS}
+    for _scored in scored:
+        for method, method_counts in _scored['counts'].items():
+            for group, counts in method_counts.items():
+                for key, value in counts.items():
+                    merged[method][group][key] += value
+    return merged
+
+
+def report_rows(merged: Dict[str, Dict[str, Dict[str, float]]]) -> Dict[str, Dict[str, Any]]:
+    """SP, MP and precision per predicted severity of each method."""
+    return {method: {
+        'SP': precision(method_counts['SP']),
+        'MP': precision(method_counts['MP']),
+        **{f'P_{severity}': precision(method_counts[severity]) for severity in SEVERITIES},
+        'spans': method_counts['SP']['spans'],
+        'unlocated_spans': method_counts['SP']['unlocated_spans'],
+    } for method, method_counts in merged.items()}
+
+
+def span_precision(spec: Dict[str, Any], first_seg_id: int=1, workers: int=None) -> Dict[str, Any]:
+    """report per (model, lp, system), per (model, lp) and per model."""
+    predictions = spec['predictions']
+    for prediction in predictions:
+        if prediction['lp'] not in spec['gold']:
+            raise ValueError(f"No gold annotations of {prediction['lp']} for {prediction['results']}.")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        scored = list(executor.map(score_predictions,
+                                   predictions,
+                                   [spec['gold'][prediction['lp']] for prediction in predictions],
+                                   [first_seg_id] * len(predictions)))
+
+    groups = {'systems': defaultdict(list), 'lps': defaultdict(list), 'models': defaultdict(list)}
+    for prediction, _scored in zip(predictions, scored):
+        if _scored['misaligned'] > 0:
+            print(f"[WARNING] {_scored['misaligned']} segments of {prediction['results']} do not match the gold "
+                  f"targets of {prediction['system']} and are skipped.")
+        groups['systems'][(prediction['model'], prediction['lp'], prediction['system'])].append(_scored)
+        groups['lps'][(prediction['model'], prediction['lp'])].append(_scored)
+        groups['models'][(prediction['model'], )].append(_scored)
+
+    report = {}
+    for level, level_groups in groups.items():
+        report[level] = [{
+            **dict(zip(('model', 'lp', 'system'), key)),
+            'segments': sum(_scored['segments'] for _scored in level_scored),
+            **report_rows(merge_counts(level_scored)),
+        } for key, level_scored in level_groups.items()]
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    report = span_precision(load_yaml(args.spec), args.first_seg_id, args.workers)
+
+    fmt = lambda value: '-' if value is None else f"{value:.3f}"
+    for row in report['lps'] + report['models']:
+        print(f"[INFO] {row['model']:<24} {row.get('lp', 'all'):<8} segments {row['segments']:>6} "
+              + ' '.join(f"{method} SP {fmt(row[method]['SP'])} MP {fmt(row[method]['MP'])}" for method in METHODS))
+
+    if args.out is not None:
+        save_json(report, args.out)
@@ -0,0 +1,136 @@
+"""
+Prompt-lookup (n-gram) speculative decoding for the post-editor.
+
+APE outputs are near-copies of the target segment, which is part of the APE prompt.
+vLLM's "[ngram]" speculative model drafts tokens by looking the last generated n-gram up
+in the prompt and the previous output, so most of the post-edit is accepted as a draft.
+
+With greedy decoding the speculative output equals the plain output, so the acceptance of
+every request can be replayed exactly from its prompt and output token ids.
+This is also the stand-in path when the engine runs without speculative decoding.
+"""
+
+from typing import Any, Dict, List, Optional
+
+DEFAULT_SPECULATIVE = {
+    'num_speculative_tokens': 5,
+    'ngram_prompt_lookup_max': 4,
+    'ngram_prompt_lookup_min': 1,
+}
+
+
+def speculative_engine_kwargs(speculative: Optional[Dict[str, int]]) -> Dict[str, Any]:
+    """convert the `speculative` config of inference into vLLM engine arguments."""
+    if not speculative:
+        return {}
+
+    configs = {**DEFAULT_SPECULATIVE, **speculative}
+    return {
+        'speculative_model': '[ngram]',
+        'num_speculative_tokens': configs['num_speculative_tokens'],
+        'ngram_prompt_lookup_max': configs['ngram_prompt_lookup_max'],
+        'ngram_prompt_lookup_min': configs['ngram_prompt_lookup_min'],
+        'use_v2_block_manager': True,
+    }
+
+
+def prompt_lookup_propose(context_ids: List[int],
+                          num_speculative_tokens: int,
+                          ngram_max: int,
+                          ngram_min: int) -> List[int]:
+    """
+    propose draft tokens by matching the trailing n-gram of context_ids against earlier context.
+    Longer n-grams are tried first, and the most recent earlier occurrence wins.
+    """
+    for n in range(min(ngram_max, len(context_ids) - 1), ngram_min - 1, -1):
+        pattern = context_ids[-n:]
+        for start in range(len(context_ids) - n - 1, -1, -1):
+            if context_ids[start:start + n] == pattern:
+                draft_start = start + n
+                return context_ids[draft_start:draft_start + num_speculative_tokens]
+    return []
+
+
+def simulate_prompt_lookup(prompt_ids: List[int],
+                           output_ids: List[int],
+                           num_speculative_tokens: int=5,
+                           ngram_prompt_lookup_max: int=4,
+                           ngram_prompt_lookup_min: int=1) -> Dict[str, int]:
+    """
+    replay prompt-lookup decoding of a greedy output.
+
+    return: {'output_tokens', 'steps', 'proposed', 'accepted'}, where steps is the number of
+    target model forward passes (each one yields the accepted drafts plus one token).
+    """
+    context = list(prompt_ids)
+    position, steps, proposed, accepted = 0, 0, 0, 0
+
+    while position < len(output_ids):
+        draft = prompt_lookup_propose(context, num_speculative_tokens,
+                                      ngram_prompt_lookup_max, ngram_prompt_lookup_min)
+        num_accepted = 0
+        for token in draft:
+            if position + num_accepted < len(output_ids) and output_ids[position + num_accepted] == token:
+                num_accepted += 1
+            else:
+                break
+
+        # accepted drafts plus the token produced by the verification pass
+        num_new = min(num_accepted + 1, len(output_ids) - position)
+        context += output_ids[position:position + num_new]
+        position += num_new
+        steps += 1
+        proposed += len(draft)
+        accepted += num_accepted
+
+    return {
+        'output_tokens': len(output_ids),
+        'steps': steps,
+        'proposed': proposed,
+        'accepted': accepted,
+    }
+
+
+def accumulate(totals: Dict[str, Dict[str, int]],
+               lang_pairs: List[str],
+               stats: List[Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+    """add per-request replay stats into running totals per language pair, in place."""
+    for lang_pair, stat in zip(lang_pairs, stats):
+        total = totals.setdefault(lang_pair, {'requests': 0, 'output_tokens': 0, 'steps': 0, 'proposed': 0, 'accepted': 0})
+        total['requests'] += 1
+        for key in 'output_tokens', 'steps', 'proposed', 'accepted':
+            total[key] += stat[key]
+    return totals
+
+
+def acceptance_report(lang_pairs: List[str],
+                      stats: List[Dict[str, int]],
+                      totals: Dict[str, Dict[str, int]]=None) -> Dict[str, Dict[str, float]]:
+    """
+    aggregate per-request replay stats into acceptance rates per language pair, on top of
+    running totals if given (updated in place).
+
+    acceptance_rate: accepted / proposed draft tokens.
+    speedup: output tokens / target forward passes, an upper bound of the decoding speedup.
+    """
+    totals = accumulate({} if totals is None else totals, lang_pairs, stats)
+
+    report = {}
+    for lang_pair, total in totals.items():
+        report[lang_pair] = {
+            **total,
+            'acceptance_rate': total['accepted'] / total['proposed'] if total['proposed'] > 0 else 0.0,
+            'speedup': total['output_tokens'] / total['steps'] if total['steps'] > 0 else 1.0,
+        }
+    return report
+
+
+if __name__ == "__main__":
+
+    # an example of replaying a near-copy post-edit
+    prompt = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+    output = [5, 6, 7, 20, 9, 10, 11, 12, 2]
+
+    stat = simulate_prompt_lookup(prompt, output, num_speculative_tokens=5, ngram_prompt_lookup_max=2)
+    print(f"{stat=}")
+    print(acceptance_report(['English-German'], [stat]))
@@ -0,0 +1,235 @@
+"""
+Multi-configuration sweep: run GEMBA-MQM / MQM-APE variants (verifier type, use_twice_verify,
+stage settings, ...) on the same inputs, computing each distinct stage once.
+
+The variants form a DAG over the evaluator, APE, verifier and scorer stages. A stage node is
+keyed by its section of the config and its parent node, so variants sharing the evaluator (or
+evaluator and APE) share those nodes, and their results are fanned out to every dependent
+node. GEMBA-MQM (`scorer: MQM`) only depends on the evaluator. LLM verifier nodes that differ
+only in use_twice_verify share their responses, so verifying once after verifying twice costs
+nothing and the reverse only the swapped requests.
+
+A sweep YAML (e.g. configs/sweep_example.yaml) lists the variants; stage sections update the
+sections of --config (with `verifier_type: metric`, the verifier section replaces it):
+
+    variants:
+      - name: gemba-mqm
+        scorer: MQM
+      - name: mqm-ape
+      - name: mqm-ape-once
+        verifier: {use_twice_verify: false}
+      - name: mqm-ape-cometkiwi
+        verifier_type: metric
+        verifier: {metric_path: /path/to/model.ckpt, metric_threshold: 0.03}
+
+Each variant writes <out>/<name>/results.json, scores.txt (segment scores) and sys_score.txt
+(mean), or with --manifest the per-job score files of manifest mode with the variant as metric.
+"""
+
+import argparse
+import copy
+import json
+import os
+import os.path as osp
+from typing import Any, Dict, List, Optional
+
+from engines import EnginePool
+from main import module_configs
+from manifest import build_corpus, load_manifest, save_job_scores
+from module_ape import Automatic_Post_Editor
+from module_evaluator import Error_Analysis_Evaluator
+from records import Corpus
+from scorer import Scorer
+from utils import load_yaml, readlines_txt, save_json, save_txt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="Path of the base configuration yaml.")
+    parser.add_argument("--sweep", type=str, required=True, help="YAML list of variants.")
+    parser.add_argument("--src", type=str, default=None, help="Path of src.")
+    parser.add_argument("--tgt", type=str, default=None, help="Path of tgt.")
+    parser.add_argument("--srclang", type=str, default=None, help="Source Language, such as English, German, Chinese.")
+    parser.add_argument("--tgtlang", type=str, default=None, help="Target Language, such as English, German, Chinese.")
+    parser.add_argument("--manifest", type=str, default=None, help="YAML/JSONL list of (system, lp, src, tgt) jobs.")
+    parser.add_argument("--out", type=str, required=True, help="Save directory, or root of metric-scores with --manifest.")
+
+    args = parser.parse_args()
+    if args.manifest is None and None in (args.src, args.tgt, args.srclang, args.tgtlang):
+        parser.error("--src, --tgt, --srclang and --tgtlang are required without --manifest.")
+    return args
+
+
+def variant_sections(configs: Dict[str, Any], variant: Dict[str, Any]) -> Dict[str, Any]:
+    """evaluator, ape and verifier sections of a variant, on top of the base config."""
+    sections = {}
+    for stage in 'evaluator', 'ape', 'verifier':
+        if stage == 'verifier' and variant.get('verifier_type', 'llm') == 'metric':
+            sections[stage] = dict(variant.get(stage) or {})
+        else:
+            sections[stage] = {**(configs.get(stage) or {}), **(variant.get(stage) or {})}
+    return sections
+
+
+class SweepNode():
+    """one stage of the DAG: its section, parent node, and once run, its corpus and responses."""
+
+    def __init__(self, name: str, stage: str, section: Dict[str, Any], parent: Optional['SweepNode'], key: str) -> None:
+        self.name = name
+        self.stage = stage
+        self.section = section
+        self.parent = parent
+        self.key = key
+        self.children: List['SweepNode'] = []
+        self.corpus: Optional[Corpus] = None
+        self.outputs: List[Dict[str, Any]] = []
+        self.scores: List[float] = []
+        self.results: List[Dict[str, Any]] = []
+
+
+class Sweep():
+
+    def __init__(self,
+                 configs: Dict[Any, Any],
+                 variants: List[Dict[str, Any]]):
+
+        self.engines = EnginePool(configs) # one engine per model, shared by all variants
+        self.nodes: Dict[str, SweepNode] = {} # key -> node, in topological order
+        self.variant_nodes: Dict[str, SweepNode] = {} # variant name -> scorer node
+        self.shared_responses: Dict[str, List[Dict[str, Any]]] = {} # LLM verifier responses by node key without use_twice_verify
+
+        for variant in variants:
+            if variant['name'] in self.variant_nodes:
+                raise ValueError(f"Variant {variant['name']} is defined twice.")
+            sections = variant_sections(configs, variant)
+            node = self.node('evaluator', sections['evaluator'], None)
+
+            scorer_type = variant.get('scorer', 'MQM-APE')
+            if scorer_type == 'MQM-APE':
+                node = self.node('ape', sections['ape'], node)
+                node = self.node('verifier', {'verifier_type': variant.get('verifier_type', 'llm'), **sections['verifier']}, node)
+            elif scorer_type != 'MQM':
+                raise ValueError(f"Unknown scorer {scorer_type} of variant {variant['name']}")
+            self.variant_nodes[variant['name']] = self.node('scorer', {'scorer_type': scorer_type}, node)
+
+        num_stages = sum(1 + 2 * (node.section['scorer_type'] == 'MQM-APE') for node in self.variant_nodes.values())
+        num_nodes = sum(node.stage != 'scorer' for node in self.nodes.values())
+        print(f"[INFO] Sweep of {len(variants)} variants: {num_nodes} distinct stages instead of {num_stages}.")
+
+
+    def node(self, stage: str, section: Dict[str, Any], parent: Optional[SweepNode]) -> SweepNode:
+        """node of a stage section below parent, created once."""
+        key = json.dumps([parent.key if parent is not None else None, stage, section], sort_keys=True)
+        if key not in self.nodes:
+            name = f"{stage}{sum(node.stage == stage for node in self.nodes.values())}"
+            self.nodes[key] = SweepNode(name, stage, section, parent, key)
+            if parent is not None:
+                parent.children.append(self.nodes[key])
+        return self.nodes[key]
+
+
+    def take_corpus(self, node: SweepNode) -> Corpus:
+        """corpus of the parent of node, copied unless node is its last child to run."""
+        parent = node.parent
+        if node is parent.children[-1]:
+            corpus, parent.corpus = parent.corpus, None
+            return corpus
+        return copy.deepcopy(parent.corpus)
+
+
+    def run(self, corpus: Corpus) -> Dict[str, List[float]]:
+        """run every node once, parents first. return: segment scores of each variant."""
+        for node in self.nodes.values():
+            node_corpus = copy.deepcopy(corpus) if node.parent is None else self.take_corpus(node)
+            getattr(self, f"run_{node.stage}")(node, node_corpus)
+            node.corpus = node_corpus if len(node.children) > 0 else None
+
+        return {name: node.scores for name, node in self.variant_nodes.items()}
+
+
+    def run_evaluator(self, node: SweepNode, corpus: Corpus) -> None:
+        module = Error_Analysis_Evaluator(self.engines.stage(node.name, node.section.get('engine')),
+                                          **module_configs(node.section, 'engine'))
+        node.outputs, _ = module.pipeline_records(corpus)
+        print(f"[INFO] Node {node.name}: {len(corpus.errors)} errors in {len(corpus.segments)} segments.")
+
+
+    def run_ape(self, node: SweepNode, corpus: Corpus) -> None:
+        module = Automatic_Post_Editor(self.engines.stage(node.name, node.section.get('engine')),
+                                       **module_configs(node.section, 'engine'))
+        node.outputs = module.pipeline_records(corpus, range(len(corpus.errors)))
+
+
+    def run_verifier(self, node: SweepNode, corpus: Corpus) -> None:
+        error_ids = range(len(corpus.errors))
+        if node.section['verifier_type'] == 'metric':
+            from module_verifier_metric import Pairwise_Quality_Verifier_Metric
+            module = Pairwise_Quality_Verifier_Metric(**module_configs(node.section, 'verifier_type'))
+            module.pipeline_records(corpus, error_ids, seg_ids=range(len(corpus.segments)))
+            return
+
+        inference = self.engines.stage(node.name, node.section.get('engine'))
+        verifier_configs = module_configs(node.section, 'verifier_type', 'engine', 'listwise')
+        if node.section.get('listwise', False) is True:
+            from module_verifier_listwise import Listwise_Quality_Verifier
+            module = Listwise_Quality_Verifier(inference, **verifier_configs)
+        else:
+            from module_verifier import Pairwise_Quality_Verifier
+            module = Pairwise_Quality_Verifier(inference, **verifier_configs)
+
+        # ordering 0 of verifying twice is the request of verifying once
+        shared_key = json.dumps([node.parent.key, module_configs(node.section, 'use_twice_verify')], sort_keys=True)
+        shared = self.shared_responses.setdefault(shared_key, [])
+        node.outputs = module.pipeline_records(corpus, error_ids, shared)
+        shared += node.outputs
+
+
+    def run_scorer(self, node: SweepNode, corpus: Corpus) -> None:
+        scorer = Scorer(scorer_type=node.section['scorer_type'])
+        node.scores = scorer.score_corpus(corpus)
+        node.results = corpus.to_results(node.scores)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    configs = load_yaml(args.config)
+    variants = load_yaml(args.sweep)['variants']
+
+    if args.manifest is not None:
+        jobs, _ = load_manifest(args.manifest)
+        corpus, job_ranges = build_corpus(jobs)
+    else:
+        srcs, tgts = readlines_txt(args.src), readlines_txt(args.tgt)
+        assert len(srcs) == len(tgts), "length of src and tgt should be the same!"
+        corpus = Corpus.from_texts(srcs, tgts, args.srclang, args.tgtlang)
+
+    sweep = Sweep(configs, variants)
+    variant_scores = sweep.run(corpus)
+
+    stage_costs = sweep.engines.cost_report()
+    for stage, costs in stage_costs.items():
+        print(f"[INFO] Node {stage} on engine {costs['engine']}: {costs['requests']} requests, "
+              f"{costs['prompt_tokens']} prompt / {costs['generated_tokens']} generated tokens, "
+              f"{costs['gpu_seconds']:.1f} GPU seconds.")
+
+    if osp.exists(args.out) is False:
+        os.makedirs(args.out)
+
+    for name, scores in variant_scores.items():
+        print(f"[INFO] Variant {name}: system score {sum(scores) / len(scores) if len(scores) > 0 else 0:.3f}")
+        if args.manifest is not None:
+            save_job_scores(jobs, [[scores[seg_id] for seg_id in job_range] for job_range in job_ranges], args.out, name)
+        else:
+            variant_dir = osp.join(args.out, name)
+            if osp.exists(variant_dir) is False:
+                os.makedirs(variant_dir)
+            save_json(sweep.variant_nodes[name].results, osp.join(variant_dir, "results.json"))
+            save_txt([str(score) + '\n' for score in scores], osp.join(variant_dir, "scores.txt"))
+            save_txt([f"{sum(scores) / len(scores) if len(scores) > 0 else 0}\n"], osp.join(variant_dir, "sys_score.txt"))
+
+    save_json({'nodes': {node.name: {'stage': node.stage, 'parent': node.parent.name if node.parent else None, 'section': node.section}
+                         for node in sweep.nodes.values()},
+               'variants': {name: node.name for name, node in sweep.variant_nodes.items()},
+               'stage_costs': stage_costs},
+              osp.join(args.out, "sweep.json"))
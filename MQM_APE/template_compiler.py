@@ -0,0 +1,217 @@
+"""
+Precompiled prompt templates.
+
+A template (a prompt string or a conversation, see prompts/prompts.py) is rendered through the
+chat template once with placeholder sentinels. Rendering a request then only splices the
+per-segment fields between static chunks, and the static prefix (system prompt and few-shot
+turns) is tokenized once, so only the tail of each prompt is tokenized per request.
+
+Both shortcuts are checked against the plain path on probe inputs when compiling;
+a template that does not reproduce the plain path falls back to it. Chat templates may also
+trim message contents (Llama-3 `| trim`), which changes fields at the edge of a turn: if probes
+with leading or trailing whitespace differ, inputs with such fields take the plain path.
+"""
+
+import re
+from string import Formatter
+from typing import Any, Dict, List, Optional, Union
+
+from jinja2.exceptions import TemplateError
+
+from utils import apply_template
+
+PROBE_INPUTS = [ # cover boundaries of letters, CJK, quotes and braces
+    'Probe',
+    '"Probe" {text}, 探针文本.',
+    '探针 -- probe\nline',
+]
+EDGE_PROBE_INPUTS = [ # whitespace at the edges of a field
+    ' Probe ',
+    '\n探针文本.\n',
+]
+MAX_SPLIT_RETRIES = 32
+
+
+class TokenizedPrompt():
+    """prompt string with its token ids, accepted by Inference.inference."""
+
+    __slots__ = ('prompt', 'prompt_token_ids')
+
+    def __init__(self, prompt: str, prompt_token_ids: List[int]) -> None:
+        self.prompt = prompt
+        self.prompt_token_ids = prompt_token_ids
+
+
+def chat_prompt(tokenizer, sample: Union[str, List[Dict[str, str]]]) -> str:
+    """
+    convert input into prompt str.
+
+    input format 1: Prompt string. e.g. "Input String" -> "Input String"
+    input format 2: Dict with system prompt.
+    input format 3: Dict with system prompt, for chat templates without system role.
+    """
+    if isinstance(sample, str): # input format 1
+        return sample
+
+    try: # input format 2
+        return tokenizer.apply_chat_template(
+            sample,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+    except TemplateError: # input format 3, e.g. "System role not supported"
+        if sample[0]['role'] != 'system':
+            raise
+        return 'system:' + sample[0]['content'] + tokenizer.apply_chat_template(
+            sample[1:],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+
+def template_fields(template: Union[str, List[Dict[str, str]]]) -> List[str]:
+    """names of format fields in a template, in order of first appearance."""
+    contents = [template] if isinstance(template, str) else [turn['content'] for turn in template]
+    fields = []
+    for content in contents:
+        for _, name, _, _ in Formatter().parse(content):
+            if name is not None and name not in fields:
+                fields.append(name)
+    return fields
+
+
+class CompiledTemplate():
+
+    def __init__(self,
+                 template: Union[str, List[Dict[str, str]]],
+                 tokenizer) -> None:
+
+        self.template = template
+        self.tokenizer = tokenizer
+        self.fields = template_fields(template)
+
+        # render once with sentinels and cut the prompt into static chunks
+        sentinels = {name: f"@@MQM_APE_FIELD_{name}@@" for name in self.fields}
+        rendered = chat_prompt(tokenizer, apply_template(template, sentinels))
+        pattern = '|'.join(re.escape(sentinel) for sentinel in sentinels.values())
+        pieces = re.split(f"({pattern})", rendered) if pattern else [rendered]
+        self.chunks = pieces[0::2]
+        self.slots = [piece[len('@@MQM_APE_FIELD_'):-len('@@')] for piece in pieces[1::2]]
+
+        self.valid = all(self.render(probe) == self.render_plain(probe) for probe in self.probes())
+        self.edge_safe = all(self.render(probe) == self.render_plain(probe) for probe in self.probes(EDGE_PROBE_INPUTS))
+        self.prefix_len, self.prefix_ids = self.split_prefix() if self.valid else (0, [])
+
+
+    def probes(self, values: List[str]=PROBE_INPUTS) -> List[Dict[str, str]]:
+        return [{name: value for name in self.fields} for value in values]
+
+
+    def splices(self, data: Dict[str, Any]) -> bool:
+        """whether splicing reproduces the plain path for data: always, unless the chat template trims fields with whitespace edges."""
+        return self.edge_safe or all(str(data[name]) == str(data[name]).strip() for name in self.fields)
+
+
+    def render_plain(self, data: Dict[str, Any]) -> str:
+        """uncompiled path: format every turn and apply the chat template."""
+        return chat_prompt(self.tokenizer, apply_template(self.template, data))
+
+
+    def render(self, data: Dict[str, Any]) -> str:
+        """splice fields between static chunks."""
+        pieces = [self.chunks[0]]
+        for name, chunk in zip(self.slots, self.chunks[1:]):
+            pieces.append(str(data[name]))
+            pieces.append(chunk)
+        return ''.join(pieces)
+
+
+    def split_prefix(self):
+        """
+        find the longest static prefix whose cached token ids plus the tokens of the rest equal
+        the tokens of the whole prompt. Cut points fall back to earlier line breaks, since
+        tokens may merge across the first field.
+        return: (prefix length in characters, prefix token ids)
+        """
+        prompts = [self.render(probe) for probe in self.probes()]
+        cut = len(self.chunks[0])
+
+        for _ in range(MAX_SPLIT_RETRIES):
+            if cut <= 0:
+                break
+            prefix_ids = self.tokenizer.encode(self.chunks[0][:cut])
+            if all(prefix_ids + self.tokenizer.encode(prompt[cut:], add_special_tokens=False) == self.tokenizer.encode(prompt)
+                   for prompt in prompts):
+                return cut, prefix_ids
+            cut = self.chunks[0].rfind('\n', 0, cut - 1) + 1
+
+        return 0, []
+
+
+    def tokenize(self, data: Dict[str, Any]) -> TokenizedPrompt:
+        if self.splices(data) is False:
+            prompt = self.render_plain(data)
+            return TokenizedPrompt(prompt, self.tokenizer.encode(prompt))
+        prompt = self.render(data)
+        if self.prefix_len == 0:
+            return TokenizedPrompt(prompt, self.tokenizer.encode(prompt))
+        return TokenizedPrompt(prompt, self.prefix_ids + self.tokenizer.encode(prompt[self.prefix_len:], add_special_tokens=False))
+
+
+class TemplateCache():
+    """compiled templates of one tokenizer, keyed by template content."""
+
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self.compiled = {}
+
+    def get(self, template: Union[str, List[Dict[str, str]]]) -> Optional[CompiledTemplate]:
+        key = template if isinstance(template, str) else tuple((turn['role'], turn['content']) for turn in template)
+        if key not in self.compiled:
+            compiled = CompiledTemplate(template, self.tokenizer)
+            if compiled.valid is False:
+                print(f"[INFO] Template can not be compiled, fields {compiled.fields} use the plain path.")
+            self.compiled[key] = compiled if compiled.valid else None
+        return self.compiled[key]
+
+    def build_prompts(self,
+                      template: Union[str, List[Dict[str, str]]],
+                      inputs: List[Dict[str, Any]]) -> List[Union[TokenizedPrompt, str, List[Dict[str, str]]]]:
+        """tokenized prompts of inputs, or formatted templates if the template can not be compiled."""
+        compiled = self.get(template)
+        if compiled is None:
+            return [apply_template(template, _input) for _input in inputs]
+        return [compiled.tokenize(_input) for _input in inputs]
+
+
+class PromptEngine():
+    """
+    prompt building of an engine without model weights: tokenizer, chat template and compiled
+    templates only, with the prompt interface of inference.Inference (e.g. for planning runs).
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 compile_templates: bool=True,
+                 **engine_kwargs) -> None: # tp, speculative, ...: engine options, unused without a model
+
+        from transformers import AutoTokenizer
+
+        self.model_path = model_path
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        self.compile_templates = compile_templates
+        self.template_cache = TemplateCache(self.tokenizer)
+
+    def input2prompt(self, sample) -> str:
+        return chat_prompt(self.tokenizer, sample)
+
+    def build_prompts(self, template, inputs: List[Dict[str, Any]]) -> List[Any]:
+        if self.compile_templates is False:
+            return [apply_template(template, _input) for _input in inputs]
+        return self.template_cache.build_prompts(template, inputs)
+
+    def num_tokens(self, prompt) -> int:
+        """tokens of a built prompt."""
+        if isinstance(prompt, TokenizedPrompt):
+            return len(prompt.prompt_token_ids)
+        return len(self.tokenizer.encode(self.input2prompt(prompt)))
@@ -28,10 +28,26 @@ def save_json(data, path):
     print(f'Saved to {path}.')
     return
 
+def read_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+def append_jsonl(data: List, path: str) -> None:
+    with open(path, 'a', encoding='utf-8') as f:
+        f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in data)
+        f.flush()
+    return
+
 def load_yaml(file: str):
     with open(file) as reader:
         return yaml.safe_load(reader)
 
+def save_yaml(data, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(data, f, sort_keys=False, allow_unicode=True)
+    print(f'Saved to {path}.')
+    return
+
 def truncate_response(response: str, truncate_list: List[str], start_truncation_len: int=0) -> str:
     """
     response: the raw response requires truncating.
@@ -0,0 +1,271 @@
+"""
+Durable work queue of segment batches for pull-based workers (see worker.py).
+
+Items are leased by a worker for lease_seconds and acked with their result. A worker extends
+its leases while it works; items whose lease expires (e.g. the worker crashed) are handed out
+again, and an item leased max_attempts times without an ack is marked failed. Acks are
+idempotent: the first result of an item is kept. Items are leased by priority, then in order.
+
+    sqlite:///path/to/queue.db (or a plain path): SQLiteWorkQueue, a local file shared by the
+        worker processes of one host or a shared filesystem.
+    redis://host:port/db: RedisWorkQueue, requires the redis package.
+"""
+
+import json
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+STATUSES = ('pending', 'leased', 'done', 'failed')
+
+
+class WorkQueue(ABC):
+    """interface of the queue backends. Payloads and results are JSON-serializable."""
+
+    def __init__(self, lease_seconds: float=600, max_attempts: int=3) -> None:
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def enqueue(self, payloads: List[Dict[str, Any]], priorities: List[int]=None) -> List[int]:
+        """add items, return their ids."""
+
+    @abstractmethod
+    def lease(self, worker: str, max_items: int=1) -> List[Tuple[int, Dict[str, Any]]]:
+        """lease up to max_items pending items (re-queueing expired leases first), return (id, payload)."""
+
+    @abstractmethod
+    def extend(self, worker: str, item_ids: List[int]) -> int:
+        """renew leases of a worker, return the number still held."""
+
+    @abstractmethod
+    def ack(self, worker: str, item_id: int, result: Any) -> bool:
+        """store the result of an item, False if it was done already."""
+
+    @abstractmethod
+    def nack(self, worker: str, item_id: int, error: str) -> None:
+        """give a leased item back after a failure, failed once it reached max_attempts."""
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """items per status."""
+
+    @abstractmethod
+    def results(self) -> List[Tuple[int, Dict[str, Any], Any]]:
+        """(id, payload, result) of done items, in id order."""
+
+    @abstractmethod
+    def set_meta(self, key: str, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    def get_meta(self, key: str, default: Any=None) -> Any:
+        pass
+
+    def finished(self) -> bool:
+        """no pending or leased items are left."""
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['leased'] == 0
+
+
+class SQLiteWorkQueue(WorkQueue):
+
+    def __init__(self, path: str, lease_seconds: float=600, max_attempts: int=3) -> None:
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+        with self.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS items ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, priority INTEGER NOT NULL DEFAULT 0, "
+                         "payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', worker TEXT, "
+                         "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS items_status ON items (status, priority, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """one connection per operation, so threads and processes can share the file."""
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE") # take the write lock up front, leases must not race
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def enqueue(self, payloads: List[Dict[str, Any]], priorities: List[int]=None) -> List[int]:
+        priorities = priorities or [0] * len(payloads)
+        with self.transaction() as conn:
+            return [conn.execute("INSERT INTO items (priority, payload) VALUES (?, ?)",
+                                 (priority, json.dumps(payload, ensure_ascii=False))).lastrowid
+                    for payload, priority in zip(payloads, priorities)]
+
+    def lease(self, worker: str, max_items: int=1) -> List[Tuple[int, Dict[str, Any]]]:
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("UPDATE items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "worker = NULL, error = COALESCE(error, 'lease expired') "
+                         "WHERE status = 'leased' AND lease_expires < ?", (self.max_attempts, now))
+            rows = conn.execute("SELECT id, payload FROM items WHERE status = 'pending' ORDER BY priority, id LIMIT ?",
+                                (max_items,)).fetchall()
+            conn.executemany("UPDATE items SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                             [(worker, now + self.lease_seconds, item_id) for item_id, _ in rows])
+        return [(item_id, json.loads(payload)) for item_id, payload in rows]
+
+    def extend(self, worker: str, item_ids: List[int]) -> int:
+        with self.transaction() as conn:
+            return sum(conn.execute("UPDATE items SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                    (time.time() + self.lease_seconds, item_id, worker)).rowcount
+                       for item_id in item_ids)
+
+    def ack(self, worker: str, item_id: int, result: Any) -> bool:
+        with self.transaction() as conn:
+            return conn.execute("UPDATE items SET status = 'done', worker = ?, result = ?, error = NULL "
+                                "WHERE id = ? AND status != 'done'",
+                                (worker, json.dumps(result, ensure_ascii=False), item_id)).rowcount == 1
+
+    def nack(self, worker: str, item_id: int, error: str) -> None:
+        with self.transaction() as conn:
+            conn.execute("UPDATE items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "worker = NULL, error = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                         (self.max_attempts, error, item_id, worker))
+
+    def counts(self) -> Dict[str, int]:
+        with self.transaction() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def results(self) -> List[Tuple[int, Dict[str, Any], Any]]:
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT id, payload, result FROM items WHERE status = 'done' ORDER BY id").fetchall()
+        return [(item_id, json.loads(payload), json.loads(result)) for item_id, payload, result in rows]
+
+    def set_meta(self, key: str, value: Any) -> None:
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def get_meta(self, key: str, default: Any=None) -> Any:
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+
+# KEYS: pending (zset id -> rank), leases (zset id -> expiry), owners, attempts, failed, ranks (hashes)
+# ARGV: now, lease_seconds, max_items, worker, max_attempts
+REDIS_LEASE_SCRIPT = """
+local now, lease_seconds, max_items = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('HDEL', KEYS[3], id)
+    if tonumber(redis.call('HGET', KEYS[4], id) or '0') >= tonumber(ARGV[5]) then
+        redis.call('HSET', KEYS[5], id, 'lease expired')
+    else
+        redis.call('ZADD', KEYS[1], redis.call('HGET', KEYS[6], id), id)
+    end
+end
+local leased = {}
+local popped = redis.call('ZPOPMIN', KEYS[1], max_items)
+for idx = 1, #popped, 2 do
+    local id = popped[idx]
+    redis.call('ZADD', KEYS[2], now + lease_seconds, id)
+    redis.call('HSET', KEYS[3], id, ARGV[4])
+    redis.call('HINCRBY', KEYS[4], id, 1)
+    table.insert(leased, id)
+end
+return leased
+"""
+
+
+class RedisWorkQueue(WorkQueue):
+    """the same queue on redis, items leased atomically by a Lua script."""
+
+    def __init__(self, url: str, lease_seconds: float=600, max_attempts: int=3, prefix: str='mqm_ape') -> None:
+        import redis
+
+        super().__init__(lease_seconds, max_attempts)
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.keys = {name: f"{prefix}:{name}" for name in
+                     ('pending', 'leases', 'owners', 'attempts', 'failed', 'ranks', 'items', 'results', 'meta', 'next_id')}
+        self.lease_script = self.client.register_script(REDIS_LEASE_SCRIPT)
+
+    def enqueue(self, payloads: List[Dict[str, Any]], priorities: List[int]=None) -> List[int]:
+        priorities = priorities or [0] * len(payloads)
+        last_id = self.client.incrby(self.keys['next_id'], len(payloads))
+        item_ids = list(range(last_id - len(payloads) + 1, last_id + 1))
+        pipe = self.client.pipeline()
+        for item_id, payload, priority in zip(item_ids, payloads, priorities):
+            rank = priority * 2 ** 32 + item_id
+            pipe.hset(self.keys['items'], item_id, json.dumps(payload, ensure_ascii=False))
+            pipe.hset(self.keys['ranks'], item_id, rank)
+            pipe.zadd(self.keys['pending'], {item_id: rank})
+        pipe.execute()
+        return item_ids
+
+    def lease(self, worker: str, max_items: int=1) -> List[Tuple[int, Dict[str, Any]]]:
+        keys = [self.keys[name] for name in ('pending', 'leases', 'owners', 'attempts', 'failed', 'ranks')]
+        item_ids = self.lease_script(keys=keys, args=[time.time(), self.lease_seconds, max_items, worker, self.max_attempts])
+        if len(item_ids) == 0:
+            return []
+        payloads = self.client.hmget(self.keys['items'], item_ids)
+        return [(int(item_id), json.loads(payload)) for item_id, payload in zip(item_ids, payloads)]
+
+    def extend(self, worker: str, item_ids: List[int]) -> int:
+        held = [item_id for item_id, owner in zip(item_ids, self.client.hmget(self.keys['owners'], item_ids) if item_ids else [])
+                if owner == worker]
+        if len(held) > 0:
+            self.client.zadd(self.keys['leases'], {item_id: time.time() + self.lease_seconds for item_id in held}, xx=True)
+        return len(held)
+
+    def ack(self, worker: str, item_id: int, result: Any) -> bool:
+        if self.client.hsetnx(self.keys['results'], item_id, json.dumps(result, ensure_ascii=False)) == 0:
+            return False
+        pipe = self.client.pipeline()
+        pipe.zrem(self.keys['leases'], item_id)
+        pipe.zrem(self.keys['pending'], item_id)
+        pipe.hdel(self.keys['owners'], item_id)
+        pipe.hdel(self.keys['failed'], item_id)
+        pipe.execute()
+        return True
+
+    def nack(self, worker: str, item_id: int, error: str) -> None:
+        if self.client.hget(self.keys['owners'], item_id) != worker or self.client.zrem(self.keys['leases'], item_id) == 0:
+            return
+        self.client.hdel(self.keys['owners'], item_id)
+        if int(self.client.hget(self.keys['attempts'], item_id) or 0) >= self.max_attempts:
+            self.client.hset(self.keys['failed'], item_id, error)
+        else:
+            self.client.zadd(self.keys['pending'], {item_id: self.client.hget(self.keys['ranks'], item_id)})
+
+    def counts(self) -> Dict[str, int]:
+        pipe = self.client.pipeline()
+        for name in ('pending', 'leases'):
+            pipe.zcard(self.keys[name])
+        for name in ('results', 'failed'):
+            pipe.hlen(self.keys[name])
+        return dict(zip(STATUSES, pipe.execute()))
+
+    def results(self) -> List[Tuple[int, Dict[str, Any], Any]]:
+        results = self.client.hgetall(self.keys['results'])
+        item_ids = sorted(results, key=int)
+        payloads = self.client.hmget(self.keys['items'], item_ids) if item_ids else []
+        return [(int(item_id), json.loads(payload), json.loads(results[item_id])) for item_id, payload in zip(item_ids, payloads)]
+
+    def set_meta(self, key: str, value: Any) -> None:
+        self.client.hset(self.keys['meta'], key, json.dumps(value, ensure_ascii=False))
+
+    def get_meta(self, key: str, default: Any=None) -> Any:
+        value = self.client.hget(self.keys['meta'], key)
+        return default if value is None else json.loads(value)
+
+
+def build_queue(url: str, lease_seconds: float=600, max_attempts: int=3) -> WorkQueue:
+    """queue of a URL: redis://..., sqlite:///path or a plain path of a SQLite file."""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisWorkQueue(url, lease_seconds, max_attempts)
+    return SQLiteWorkQueue(url[len('sqlite:///'):] if url.startswith('sqlite:///') else url, lease_seconds, max_attempts)
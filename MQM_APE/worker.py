@@ -0,0 +1,228 @@
+"""
+Queue-backed execution: segments are enqueued in batches into a durable work queue
+(work_queue.py), any number of worker processes lease batches, run evaluator, APE and verifier
+and ack the results, and the results are collected once the queue is drained.
+
+    python3 worker.py enqueue --queue ./queue.db --src ... --tgt ... --srclang Chinese --tgtlang English
+    python3 worker.py work --queue ./queue.db --config ./configs/llmconfig.yaml     # on each GPU, any time
+    python3 worker.py status --queue ./queue.db
+    python3 worker.py collect --queue ./queue.db --out ./outs
+
+Workers may join or leave mid-run. A worker keeps its engine loaded, leases --max_items batches
+at a time and renews the leases while it works; batches of a worker that crashed are handed to
+other workers once their lease expires. SIGTERM / Ctrl-C lets a worker finish its current
+batches and leave. With --manifest, collect writes the per-job score files of manifest mode.
+"""
+
+import argparse
+import os
+import os.path as osp
+import signal
+import socket
+import threading
+from typing import Any, Dict, List, Tuple
+
+from main import MQM_APE
+from manifest import load_manifest, save_job_scores
+from records import PRIORITIES, Corpus
+from utils import load_yaml, readlines_txt, save_json, save_txt
+from work_queue import WorkQueue, build_queue
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, choices=['enqueue', 'work', 'status', 'collect'])
+    parser.add_argument("--queue", type=str, required=True, help="Queue URL: path of a SQLite file, sqlite:///path or redis://host:port/db.")
+    parser.add_argument("--lease_seconds", type=float, default=600, help="Seconds a leased batch stays with a worker without renewal.")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Leases of a batch before it is marked failed.")
+
+    # enqueue
+    parser.add_argument("--src", type=str, default=None, help="Path of src.")
+    parser.add_argument("--tgt", type=str, default=None, help="Path of tgt.")
+    parser.add_argument("--srclang", type=str, default=None, help="Source Language, such as English, German, Chinese.")
+    parser.add_argument("--tgtlang", type=str, default=None, help="Target Language, such as English, German, Chinese.")
+    parser.add_argument("--manifest", type=str, default=None, help="YAML/JSONL list of (system, lp, src, tgt) jobs.")
+    parser.add_argument("--metric_name", type=str, default=None, help="Metric name of score files in manifest mode.")
+    parser.add_argument("--priority", type=str, default=PRIORITIES[0], choices=PRIORITIES, help="Lane of the segments without --manifest.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Segments per queue item.")
+
+    # work
+    parser.add_argument("--config", type=str, default=None, help="Path of configuration yaml.")
+    parser.add_argument("--worker_id", type=str, default=None, help="Name of the worker, host:pid by default.")
+    parser.add_argument("--max_items", type=int, default=4, help="Batches leased and evaluated together.")
+    parser.add_argument("--poll_seconds", type=float, default=5, help="Wait between polls of an empty queue.")
+    parser.add_argument("--wait", action="store_true", default=False, help="Keep polling for new work once the queue is drained.")
+    parser.add_argument("--metric_verifier", action="store_true", default=False, help="Whether to replace verifier with cometkiwi.")
+    parser.add_argument("--lazy_verify", action="store_true", default=False, help="Whether to post-edit and verify errors by severity.")
+
+    # collect
+    parser.add_argument("--out", type=str, default=None, help="Save directory, or root of metric-scores with --manifest.")
+    parser.add_argument("--partial", action="store_true", default=False, help="Collect although batches are pending or failed.")
+
+    args = parser.parse_args()
+    if args.command == 'enqueue' and args.manifest is None and None in (args.src, args.tgt, args.srclang, args.tgtlang):
+        parser.error("--src, --tgt, --srclang and --tgtlang are required without --manifest.")
+    if args.command == 'work' and args.config is None:
+        parser.error("--config is required by work.")
+    if args.command == 'collect' and args.out is None:
+        parser.error("--out is required by collect.")
+    return args
+
+
+def enqueue_jobs(queue: WorkQueue, jobs: List[Dict[str, Any]], batch_size: int) -> int:
+    """enqueue the segments of each job in batches of batch_size. return: number of batches."""
+    payloads, priorities = [], []
+    for job_idx, job in enumerate(jobs):
+        srcs = readlines_txt(job['src'])
+        tgts = readlines_txt(job['tgt'])
+        assert len(srcs) == len(tgts), f"length of src and tgt of {job.get('system')} {job['lp']} should be the same!"
+
+        for begin in range(0, len(srcs), batch_size):
+            payloads.append({
+                'job': job_idx,
+                'begin': begin,
+                'srclang': job['srclang'],
+                'tgtlang': job['tgtlang'],
+                'priority': job['priority'],
+                'srcs': srcs[begin:begin + batch_size],
+                'tgts': tgts[begin:begin + batch_size],
+            })
+            priorities.append(PRIORITIES.index(job['priority']))
+        print(f"[INFO] Job {job['lp']} {job.get('system')}: {len(srcs)} segments.")
+
+    queue.enqueue(payloads, priorities)
+    return len(payloads)
+
+
+class LeaseHeartbeat():
+    """renew the leases of a worker from a background thread while its batches are evaluated."""
+
+    def __init__(self, queue: WorkQueue, worker: str, item_ids: List[int]) -> None:
+        self.queue = queue
+        self.worker = worker
+        self.item_ids = item_ids
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self) -> None:
+        while self.stopped.wait(self.queue.lease_seconds / 3) is False:
+            held = self.queue.extend(self.worker, self.item_ids)
+            if held < len(self.item_ids):
+                print(f"[WARNING] Worker {self.worker} lost {len(self.item_ids) - held} leases, their results may be discarded.")
+
+    def __enter__(self) -> 'LeaseHeartbeat':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+
+def evaluate_items(mqm_ape: MQM_APE, items: List[Tuple[int, Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+    """evaluate leased batches in one corpus. return: results of each batch."""
+    corpus, item_ranges = Corpus(), []
+    for _, payload in items:
+        begin = len(corpus.segments)
+        for src, tgt in zip(payload['srcs'], payload['tgts']):
+            corpus.add_segment(payload['srclang'], src.strip(), payload['tgtlang'], tgt.strip(), PRIORITIES.index(payload['priority']))
+        item_ranges.append(range(begin, len(corpus.segments)))
+
+    mqm_ape.eval_records(corpus)
+
+    return [corpus.to_results([mqm_ape.scorer.score_segment(corpus, seg_id) for seg_id in item_range], item_range)
+            for item_range in item_ranges]
+
+
+def work(queue: WorkQueue, mqm_ape: MQM_APE, worker: str, max_items: int, poll_seconds: float, wait: bool) -> int:
+    """lease, evaluate and ack batches until the queue is drained or the worker is stopped. return: batches acked."""
+    stopping = threading.Event()
+    for signum in signal.SIGINT, signal.SIGTERM:
+        signal.signal(signum, lambda *_: stopping.set())
+
+    num_acked = 0
+    while stopping.is_set() is False:
+        items = queue.lease(worker, max_items)
+        if len(items) == 0:
+            if wait is False and queue.finished():
+                break
+            stopping.wait(poll_seconds)
+            continue
+
+        item_ids = [item_id for item_id, _ in items]
+        print(f"[INFO] Worker {worker} leased batches {item_ids}.")
+        with LeaseHeartbeat(queue, worker, item_ids):
+            try:
+                item_results = evaluate_items(mqm_ape, items)
+            except Exception as error: # give the batches back, other workers retry them
+                print(f"[WARNING] Worker {worker} failed on batches {item_ids}: {error!r}")
+                for item_id in item_ids:
+                    queue.nack(worker, item_id, repr(error))
+                continue
+
+        for item_id, results in zip(item_ids, item_results):
+            num_acked += queue.ack(worker, item_id, results)
+
+    print(f"[INFO] Worker {worker} leaves after acking {num_acked} batches.")
+    return num_acked
+
+
+def collect(queue: WorkQueue, out: str, partial: bool=False) -> None:
+    """write results of the queue in the layout of main.py (results.json, scores.txt, or manifest score files)."""
+    counts = queue.counts()
+    if counts['done'] < sum(counts.values()):
+        message = f"Queue is not complete: {counts}."
+        if partial is False:
+            raise RuntimeError(message + " Wait for the workers, or collect with --partial.")
+        print(f"[WARNING] {message} Missing batches are left out.")
+
+    jobs = queue.get_meta('jobs')
+    job_results = [[] for _ in jobs]
+    for _, payload, results in sorted(queue.results(), key=lambda row: (row[1]['job'], row[1]['begin'])):
+        job_results[payload['job']] += results
+
+    if osp.exists(out) is False:
+        os.makedirs(out)
+
+    if queue.get_meta('manifest') is True:
+        job_scores = [[result['MQM_APE_score'] for result in results] for results in job_results]
+        save_job_scores(jobs, job_scores, out, queue.get_meta('metric'))
+        for job, results in zip(jobs, job_results):
+            if job.get('results') is not None:
+                save_json(results, job['results'])
+    else:
+        save_json(job_results[0], osp.join(out, "results.json"))
+        save_txt([str(result['MQM_APE_score']) + '\n' for result in job_results[0]], osp.join(out, "scores.txt"))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    queue = build_queue(args.queue, args.lease_seconds, args.max_attempts)
+
+    if args.command == 'enqueue':
+        if args.manifest is not None:
+            jobs, defaults = load_manifest(args.manifest)
+        else:
+            jobs = [{'lp': f"{args.srclang}-{args.tgtlang}", 'src': args.src, 'tgt': args.tgt,
+                     'srclang': args.srclang, 'tgtlang': args.tgtlang, 'priority': args.priority}]
+        if queue.get_meta('jobs') is not None:
+            raise RuntimeError(f"Queue {args.queue} holds a run already, enqueue into a new queue.")
+        if args.manifest is not None:
+            queue.set_meta('metric', args.metric_name or defaults.get('metric', 'MQM-APE'))
+        queue.set_meta('jobs', jobs)
+        queue.set_meta('manifest', args.manifest is not None)
+        num_items = enqueue_jobs(queue, jobs, args.batch_size)
+        print(f"[INFO] Enqueued {num_items} batches into {args.queue}.")
+
+    elif args.command == 'work':
+        configs = load_yaml(args.config)
+        mqm_ape = MQM_APE(configs, 'llm' if args.metric_verifier is False else 'metric', args.lazy_verify)
+        worker = args.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        work(queue, mqm_ape, worker, args.max_items, args.poll_seconds, args.wait)
+
+    elif args.command == 'status':
+        print(f"[INFO] Queue {args.queue}: {queue.counts()}")
+
+    else:
+        collect(queue, args.out, args.partial)